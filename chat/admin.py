@@ -4,11 +4,32 @@ from django.shortcuts import redirect, get_object_or_404
 from django.urls import path, reverse
 from django.contrib import admin
 from django.utils.html import format_html
-from .models import Project, Message, UserProfile
+from .models import Project, Message, RetentionPolicy, UserProfile
+from .routers import pin_to_primary, reads_from_replica
+
+
+class ReplicaListMixin:
+    """Change lists read from a replica; the admin's own saves pin them to the primary"""
+
+    @reads_from_replica
+    def changelist_view(self, request, extra_context=None):
+        return super().changelist_view(request, extra_context)
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        pin_to_primary(request.user.pk)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        pin_to_primary(request.user.pk)
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        pin_to_primary(request.user.pk)
 
 
 @admin.register(Message)
-class MessageAdmin(admin.ModelAdmin):
+class MessageAdmin(ReplicaListMixin, admin.ModelAdmin):
 
     # WHAT YOU SEE IN LIST VIEW
     list_display = [
@@ -82,7 +103,7 @@ class MessageAdmin(admin.ModelAdmin):
 
 # --- PROJECT ADMIN (unchanged) ---
 @admin.register(Project)
-class ProjectAdmin(admin.ModelAdmin):
+class ProjectAdmin(ReplicaListMixin, admin.ModelAdmin):
     list_display = ['name', 'member_count', 'created_at', 'created_by']
     search_fields = ['name', 'description']
     filter_horizontal = ['members']
@@ -98,9 +119,17 @@ class ProjectAdmin(admin.ModelAdmin):
         super().save_model(request, obj, form, change)
 
 
+# --- RETENTION POLICY ADMIN ---
+@admin.register(RetentionPolicy)
+class RetentionPolicyAdmin(ReplicaListMixin, admin.ModelAdmin):
+    list_display = ['conversation_key', 'keep_days', 'last_purged_at', 'purged_count']
+    search_fields = ['conversation_key']
+    readonly_fields = ['created_at', 'last_purged_at', 'purged_count']
+
+
 # --- USER PROFILE ADMIN (unchanged) ---
 @admin.register(UserProfile)
-class UserProfileAdmin(admin.ModelAdmin):
+class UserProfileAdmin(ReplicaListMixin, admin.ModelAdmin):
     list_display = ['user', 'is_online_badge', 'last_seen']
     list_filter = ['is_online', 'last_seen']
     search_fields = ['user__username', 'user__email']
@@ -150,7 +179,7 @@ class MeetingInvitationInline(admin.TabularInline):
 
 
 @admin.register(Meeting)
-class MeetingAdmin(admin.ModelAdmin):
+class MeetingAdmin(ReplicaListMixin, admin.ModelAdmin):
     list_display = ('id', 'title', 'host', 'status', 'scheduled_at',
                     'created_at', 'invited_count', 'started_button','ended')
     list_display_links = ('title',)  # click title to open meeting detail
@@ -284,7 +313,7 @@ class MeetingAdmin(admin.ModelAdmin):
 
 
 @admin.register(MeetingInvitation)
-class MeetingInvitationAdmin(admin.ModelAdmin):
+class MeetingInvitationAdmin(ReplicaListMixin, admin.ModelAdmin):
     list_display = ('id', 'meeting', 'user', 'accepted',
                     'invited_at', 'responded_at')
     list_filter = ('accepted',)
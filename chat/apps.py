@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from .utils.sqlite_mode import configure_connection
+        connection_created.connect(configure_connection, dispatch_uid='chat.sqlite_mode')
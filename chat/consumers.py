@@ -2,30 +2,150 @@
 # Rewritten, cleaned and upgraded for OPTION A (PURE WEBSOCKET)
 import json
 from datetime import datetime
+import functools
 import logging
 import base64
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
-from django.core.files.base import ContentFile
 from django.db import transaction
-from .models import Message, Project
+from . import metrics
+from .models import Attachment, Message, Project, dm_key
+from .utils import db_executor, file_io, uploads
+from .utils.uploads import attachment_from_token, write_blob
 
 logger = logging.getLogger(__name__)
 
 
 def _dm_group_name(a, b):
-    """Deterministic DM group name for a pair of user ids"""
-    low = min(int(a), int(b))
-    high = max(int(a), int(b))
-    return f"dm_{low}_{high}"
+    """Deterministic DM group name for a pair of user ids (= Message.conversation_key)"""
+    return dm_key(a, b)
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+def db_thread(fn, to_async=None):
+    """
+    database_sync_to_async for consumer methods: runs on the shared DB
+    thread, or on the CONSUMER_DB_THREADS pool (utils/db_executor.py), and
+    records how long the call waited and how many calls were ahead of it
+    (chat_ws_db_queue_seconds / chat_ws_db_queue_depth).
+    """
+    to_async = to_async or db_executor.sync_to_async
+
+    def timed(queued, self, *args, **kwargs):
+        self._m_db_wait.observe(metrics.perf_counter() - queued)
+        return fn(self, *args, **kwargs)
+
+    @functools.wraps(fn)
+    async def wrapper(self, *args, **kwargs):
+        self._m_db_depth.observe(metrics.db_thread_pending)
+        metrics.db_thread_pending += 1
+        try:
+            return await to_async(timed)(metrics.perf_counter(), self, *args, **kwargs)
+        finally:
+            metrics.db_thread_pending -= 1
+    return wrapper
+
+
+def db_write(fn):
+    """db_thread for methods that write: in SQLite embedded mode they run on
+    the single writer thread, batched into shared transactions"""
+    return db_thread(fn, db_executor.write_to_async)
+
+
+def _store_inline_file(file_url, file_name, file_type):
+    """I/O pool job: decode a file inlined as a data URI and write its blob"""
+    if isinstance(file_url, str) and file_url.startswith("data:"):
+        _, b64 = file_url.split(",", 1)
+        raw = base64.b64decode(b64)
+    else:
+        raw = file_url.encode() if isinstance(file_url, str) else file_url
+    return write_blob(raw, file_name, file_type)
+
+
+async def _write_inline_file(file_url, file_name, file_type):
+    """StoredBlob for an inline file sent over the socket, or None"""
+    if not (file_url and file_name):
+        return None
+    try:
+        return await file_io.run(_store_inline_file, file_url, file_name, file_type, op='inline_upload')
+    except Exception:
+        logger.exception("_write_inline_file: storing %r failed", file_name)
+        return None
+
+
+def _attach_file(message, user, blob, file_name, attachment_token):
+    """
+    Attach a file sent over the socket to a saved message, through the
+    deduplicating Attachment store: either a token from /api/attachments/
+    or (older clients) a file inlined as a data URI, already written by
+    _write_inline_file, so only the database row is linked here.
+    """
+    if attachment_token:
+        attachment = attachment_from_token(attachment_token, user)
+        if attachment is None:
+            logger.warning("_attach_file: rejected attachment token from user %s", user.id)
+            return
+        file_name = file_name or attachment.upload_name
+    elif blob is not None:
+        attachment, created = Attachment.link(*blob)
+        uploads.count(created)
+    else:
+        return
+    message.attach(attachment, file_name)
+
+
+class InstrumentedConsumer(AsyncWebsocketConsumer):
+    """
+    Base consumer that records hot-path timings in chat.metrics.
+    Subclasses set metrics_label and use self.group_send/group_add/
+    group_discard/decode instead of calling the channel layer directly.
+    """
+
+    metrics_label = 'base'
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Resolve labelled series once per class, not per event
+        cls._m_decode = metrics.WS_DECODE.labels(cls.metrics_label)
+        cls._m_db_save = metrics.WS_DB_SAVE.labels(cls.metrics_label)
+        cls._m_db_wait = metrics.WS_DB_QUEUE_WAIT.labels(cls.metrics_label)
+        cls._m_db_depth = metrics.WS_DB_QUEUE_DEPTH.labels(cls.metrics_label)
+        cls._m_group_send = metrics.WS_GROUP_SEND.labels(cls.metrics_label)
+        cls._m_send = metrics.WS_SEND.labels(cls.metrics_label)
+        cls._m_group_size = metrics.WS_GROUP_SIZE.labels(cls.metrics_label)
+
+    def decode(self, text_data):
+        start = metrics.perf_counter()
+        data = json.loads(text_data)
+        self._m_decode.observe(metrics.perf_counter() - start)
+        return data
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        start = metrics.perf_counter()
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+        self._m_send.observe(metrics.perf_counter() - start)
+
+    async def group_add(self, group, channel):
+        await self.channel_layer.group_add(group, channel)
+        metrics.group_joined(group)
+
+    async def group_discard(self, group, channel):
+        await self.channel_layer.group_discard(group, channel)
+        metrics.group_left(group)
+
+    async def group_send(self, group, message):
+        self._m_group_size.observe(metrics.local_group_members.get(group, 0))
+        start = metrics.perf_counter()
+        await self.channel_layer.group_send(group, message)
+        self._m_group_send.observe(metrics.perf_counter() - start)
+
+
+class ChatConsumer(InstrumentedConsumer):
     """
     DM Chat consumer (ws/chat/user/<user_id>/)
     """
 
+    metrics_label = 'dm'
+
     async def connect(self):
         # partner id comes from URL: ws/chat/user/<user_id>/
         try:
@@ -43,13 +163,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.conversation_group = _dm_group_name(self.user.id, partner_id)
         self.partner_id = partner_id
 
-        await self.channel_layer.group_add(self.conversation_group, self.channel_name)
+        await self.group_add(self.conversation_group, self.channel_name)
         await self.accept()
 
         await self.set_user_online(True)
 
         try:
-            await self.channel_layer.group_send(
+            await self.group_send(
                 self.conversation_group,
                 {
                     "type": "user_status",
@@ -70,7 +190,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             logger.exception("disconnect: set_user_online failed")
 
         try:
-            await self.channel_layer.group_send(
+            await self.group_send(
                 self.conversation_group,
                 {
                     "type": "user_status",
@@ -83,7 +203,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             logger.exception("disconnect: failed to broadcast offline status")
 
         try:
-            await self.channel_layer.group_discard(self.conversation_group, self.channel_name)
+            await self.group_discard(self.conversation_group, self.channel_name)
         except Exception:
             logger.exception("disconnect: failed to discard group")
 
@@ -94,7 +214,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
 
         try:
-            data = json.loads(text_data)
+            data = self.decode(text_data)
         except Exception:
             logger.warning("receive: invalid json")
             return
@@ -133,8 +253,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
             logger.warning("handle_message: missing receiver or empty text")
             return
 
+        attachment_token = data.get('attachment_token')
+        # Decode/write inline files on the I/O pool, not the shared DB thread
+        blob = None if attachment_token else await _write_inline_file(file_url, file_name, file_type)
+
         # Save message (DB op) — uses model setter to encrypt
-        msg = await self._save_message(receiver_id, text, file_url=file_url, file_name=file_name, file_type=file_type, reply_to_id=reply_to_id)
+        start = metrics.perf_counter()
+        msg = await self._save_message(receiver_id, text, blob=blob, file_name=file_name, reply_to_id=reply_to_id, attachment_token=attachment_token)
+        self._m_db_save.observe(metrics.perf_counter() - start)
 
         if not msg:
             logger.error("handle_message: failed to save message to DB")
@@ -159,7 +285,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         }
 
         try:
-            await self.channel_layer.group_send(group, payload)
+            await self.group_send(group, payload)
             logger.debug("handle_message: broadcasted message %s to group %s with temp_id %s", msg.id, group, temp_id)
         except Exception:
             logger.exception("handle_message: failed to group_send")
@@ -199,7 +325,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             logger.exception("handle_read_receipt: db update failed")
 
         try:
-            await self.channel_layer.group_send(
+            await self.group_send(
                 self.conversation_group,
                 {
                     "type": "read_receipt",
@@ -222,7 +348,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def handle_typing(self, data):
         try:
-            await self.channel_layer.group_send(
+            await self.group_send(
                 self.conversation_group,
                 {
                     "type": "typing_indicator",
@@ -276,11 +402,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 "candidate": data.get('candidate'),
                 "call_type": data.get('call_type'),
             }
-            await self.channel_layer.group_send(self.conversation_group, payload)
+            await self.group_send(self.conversation_group, payload)
             # Also notify the target user's notification channel so they see the call even if not in DM
             to_id = int(data.get('to') or 0)
             if to_id:
-                await self.channel_layer.group_send(
+                await self.group_send(
                     f"user_notify_{to_id}",
                     {
                         "type": "rtc_signal_notify",
@@ -313,10 +439,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
     # Database helpers
     # -----------------------
 
-    @database_sync_to_async
-    def _save_message(self, receiver_id, text, file_url=None, file_name=None, file_type=None, reply_to_id=None):
+    @db_write
+    def _save_message(self, receiver_id, text, blob=None, file_name=None, reply_to_id=None, attachment_token=None):
         """
-        Save a Message instance. If file_url is a data URI, decode it and save.
+        Save a Message instance and link its file: blob is an inline file
+        already written by _write_inline_file; attachment_token refers to a
+        file streamed to /api/attachments/.
         Uses the Message.text setter to encrypt.
         """
         try:
@@ -338,23 +466,17 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 except Exception:
                     logger.exception("_save_message: setting reply_to failed")
 
-            if file_url and file_name:
-                try:
-                    if isinstance(file_url, str) and file_url.startswith("data:"):
-                        _, b64 = file_url.split(",", 1)
-                        raw = base64.b64decode(b64)
-                    else:
-                        raw = file_url.encode() if isinstance(file_url, str) else file_url
-                    message.file.save(file_name, ContentFile(raw))
-                except Exception:
-                    logger.exception("_save_message: saving file failed")
+            try:
+                _attach_file(message, self.user, blob, file_name, attachment_token)
+            except Exception:
+                logger.exception("_save_message: saving file failed")
             return message
 
         except Exception:
             logger.exception("_save_message: creating message failed")
             return None
 
-    @database_sync_to_async
+    @db_write
     def _mark_messages_read(self, message_ids):
         """
         Concurrency-safe read marking: use atomic transaction and select_for_update
@@ -370,7 +492,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         except Exception:
             logger.exception("_mark_messages_read: DB update failed")
 
-    @database_sync_to_async
+    @db_write
     def set_user_online(self, is_online):
         """
         Best-effort: update the user's profile is_online field if available.
@@ -379,7 +501,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             profile = getattr(self.user, "profile", None)
             if profile is not None:
                 profile.is_online = bool(is_online)
-                profile.save()
+                profile.save(update_fields=['is_online', 'last_seen'])
                 return
         except Exception:
             logger.exception("set_user_online: profile update failed")
@@ -393,7 +515,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             try:
                 profile, created = UserProfile.objects.get_or_create(user=self.user)
                 profile.is_online = bool(is_online)
-                profile.save()
+                profile.save(update_fields=['is_online', 'last_seen'])
             except Exception:
                 logger.exception("set_user_online: UserProfile update failed")
 
@@ -401,12 +523,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
 # ----------------------------
 # Project chat consumer (with temp_id support)
 # ----------------------------
-class ProjectChatConsumer(AsyncWebsocketConsumer):
+class ProjectChatConsumer(InstrumentedConsumer):
     """
     Project chat consumer for project groups: ws/chat/project/<project_id>/
     Broadcasts messages to chat_project_<project_id>
     """
 
+    metrics_label = 'project'
+
     async def connect(self):
         try:
             self.project_id = int(self.scope['url_route']['kwargs'].get('project_id'))
@@ -422,7 +546,7 @@ class ProjectChatConsumer(AsyncWebsocketConsumer):
             logger.warning("connect: user %s is not a member of project %s", self.user.username, self.project_id)
             return await self.close()
 
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.group_add(self.room_group_name, self.channel_name)
         await self.accept()
 
         try:
@@ -431,7 +555,7 @@ class ProjectChatConsumer(AsyncWebsocketConsumer):
             logger.exception("project connect: set_user_online failed")
 
         try:
-            await self.channel_layer.group_send(
+            await self.group_send(
                 self.room_group_name,
                 {
                     "type": "user_status",
@@ -452,7 +576,7 @@ class ProjectChatConsumer(AsyncWebsocketConsumer):
             logger.exception("project disconnect: set_user_online failed")
 
         try:
-            await self.channel_layer.group_send(
+            await self.group_send(
             
                 self.room_group_name,
                 {
@@ -466,7 +590,7 @@ class ProjectChatConsumer(AsyncWebsocketConsumer):
             logger.exception("project disconnect: failed to broadcast offline status")
 
         try:
-            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+            await self.group_discard(self.room_group_name, self.channel_name)
         except Exception:
             logger.exception("disconnect: failed to discard project group")
         logger.info("User %s disconnected from project %s", getattr(self.user, "username", ""), self.project_id)
@@ -475,7 +599,7 @@ class ProjectChatConsumer(AsyncWebsocketConsumer):
         if not text_data:
             return
         try:
-            data = json.loads(text_data)
+            data = self.decode(text_data)
         except Exception:
             logger.warning("receive (project): invalid json")
             return
@@ -503,7 +627,12 @@ class ProjectChatConsumer(AsyncWebsocketConsumer):
         temp_id = data.get('temp_id')
         reply_to_id = data.get('reply_to_id')
 
-        msg = await self._save_project_message(text, file_url=file_url, file_name=file_name, reply_to_id=reply_to_id)
+        attachment_token = data.get('attachment_token')
+        blob = None if attachment_token else await _write_inline_file(file_url, file_name, data.get('file_type'))
+
+        start = metrics.perf_counter()
+        msg = await self._save_project_message(text, blob=blob, file_name=file_name, reply_to_id=reply_to_id, attachment_token=attachment_token)
+        self._m_db_save.observe(metrics.perf_counter() - start)
         if not msg:
             logger.error("_handle_project_message: failed to save")
             return
@@ -524,7 +653,7 @@ class ProjectChatConsumer(AsyncWebsocketConsumer):
         }
 
         try:
-            await self.channel_layer.group_send(self.room_group_name, payload)
+            await self.group_send(self.room_group_name, payload)
             logger.debug("_handle_project_message: broadcasted message %s to project %s with temp_id %s", msg.id, self.project_id, temp_id)
         except Exception:
             logger.exception("_handle_project_message: broadcast failed")
@@ -550,7 +679,7 @@ class ProjectChatConsumer(AsyncWebsocketConsumer):
 
     async def _handle_project_typing(self, data):
         try:
-            await self.channel_layer.group_send(
+            await self.group_send(
                 self.room_group_name,
                 {
                     "type": "project_typing",
@@ -586,7 +715,7 @@ class ProjectChatConsumer(AsyncWebsocketConsumer):
                 "sdp": data.get("sdp"),
                 "candidate": data.get("candidate"),
             }
-            await self.channel_layer.group_send(self.room_group_name, payload)
+            await self.group_send(self.room_group_name, payload)
         except Exception:
             logger.exception("_handle_project_rtc: failed")
 
@@ -614,7 +743,7 @@ class ProjectChatConsumer(AsyncWebsocketConsumer):
         except Exception:
             logger.exception("project user_status: send failed")
 
-    @database_sync_to_async
+    @db_thread
     def _is_member(self):
         try:
             project = Project.objects.get(id=self.project_id)
@@ -625,8 +754,8 @@ class ProjectChatConsumer(AsyncWebsocketConsumer):
             logger.exception("_is_member: error")
             return False
 
-    @database_sync_to_async
-    def _save_project_message(self, text, file_url=None, file_name=None, reply_to_id=None):
+    @db_write
+    def _save_project_message(self, text, blob=None, file_name=None, reply_to_id=None, attachment_token=None):
         try:
             project = Project.objects.get(id=self.project_id)
         except Project.DoesNotExist:
@@ -646,28 +775,22 @@ class ProjectChatConsumer(AsyncWebsocketConsumer):
                 except Exception:
                     logger.exception("_save_project_message: setting reply_to failed")
 
-            if file_url and file_name:
-                try:
-                    if isinstance(file_url, str) and file_url.startswith("data:"):
-                        _, b64 = file_url.split(",", 1)
-                        raw = base64.b64decode(b64)
-                    else:
-                        raw = file_url.encode() if isinstance(file_url, str) else file_url
-                    msg.file.save(file_name, ContentFile(raw))
-                except Exception:
-                    logger.exception("_save_project_message: save file failed")
+            try:
+                _attach_file(msg, self.user, blob, file_name, attachment_token)
+            except Exception:
+                logger.exception("_save_project_message: save file failed")
 
             return msg
         except Exception:
             logger.exception("_save_project_message: DB create failed")
             return None
-    @database_sync_to_async
+    @db_write
     def set_user_online(self, is_online):
         try:
             profile = getattr(self.user, "profile", None)
             if profile is not None:
                 profile.is_online = bool(is_online)
-                profile.save()
+                profile.save(update_fields=['is_online', 'last_seen'])
                 return
         except Exception:
             logger.exception("project set_user_online: profile update failed")
@@ -681,7 +804,7 @@ class ProjectChatConsumer(AsyncWebsocketConsumer):
             try:
                 profile, created = UserProfile.objects.get_or_create(user=self.user)
                 profile.is_online = bool(is_online)
-                profile.save()
+                profile.save(update_fields=['is_online', 'last_seen'])
             except Exception:
                 logger.exception("project set_user_online: UserProfile update failed")
 
@@ -689,25 +812,27 @@ class ProjectChatConsumer(AsyncWebsocketConsumer):
 # ----------------------------
 # Notification consumer (user-scoped WebSocket)
 # ----------------------------
-class NotifyConsumer(AsyncWebsocketConsumer):
+class NotifyConsumer(InstrumentedConsumer):
     """
     User notification channel. Clients connect at ws/notify/ once and
     stay subscribed to a per-user group (user_notify_<id>). Used to deliver
     RTC call invites and other alerts regardless of which chat is open.
     """
 
+    metrics_label = 'notify'
+
     async def connect(self):
         self.user = self.scope.get('user')
         if not self.user or not getattr(self.user, 'is_authenticated', False):
             return await self.close()
 
         self.group_name = f"user_notify_{self.user.id}"
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.group_add(self.group_name, self.channel_name)
         await self.accept()
 
     async def disconnect(self, close_code):
         try:
-            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            await self.group_discard(self.group_name, self.channel_name)
         except Exception:
             logger.exception("notify disconnect: group_discard failed")
 
@@ -715,7 +840,7 @@ class NotifyConsumer(AsyncWebsocketConsumer):
         if not text_data:
             return
         try:
-            data = json.loads(text_data)
+            data = self.decode(text_data)
         except Exception:
             return
 
@@ -731,7 +856,7 @@ class NotifyConsumer(AsyncWebsocketConsumer):
         if not to_id:
             return
         try:
-            await self.channel_layer.group_send(
+            await self.group_send(
                 f"user_notify_{to_id}",
                 {
                     "type": "rtc_signal_notify",
@@ -765,11 +890,14 @@ class NotifyConsumer(AsyncWebsocketConsumer):
 # ----------------------------
 # Meeting Consumer (Dedicated Host Meeting)
 # ----------------------------
-class MeetingConsumer(AsyncWebsocketConsumer):
+class MeetingConsumer(InstrumentedConsumer):
     """
     Consumer for dedicated meetings (Host Meeting feature).
     URL: ws/meeting/<meeting_id>/
     """
+
+    metrics_label = 'meeting'
+
     async def connect(self):
         self.meeting_id = self.scope['url_route']['kwargs']['meeting_id']
         self.room_group_name = f'meeting_{self.meeting_id}'
@@ -779,14 +907,14 @@ class MeetingConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
-        await self.channel_layer.group_add(
+        await self.group_add(
             self.room_group_name,
             self.channel_name
         )
         await self.accept()
 
         # Notify others that I have joined
-        await self.channel_layer.group_send(
+        await self.group_send(
             self.room_group_name,
             {
                 'type': 'user_joined',
@@ -797,20 +925,20 @@ class MeetingConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
         # Notify others that I have left
-        await self.channel_layer.group_send(
+        await self.group_send(
             self.room_group_name,
             {
                 'type': 'user_left',
                 'user_id': self.user.id
             }
         )
-        await self.channel_layer.group_discard(
+        await self.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
     async def receive(self, text_data):
-        data = json.loads(text_data)
+        data = self.decode(text_data)
         message_type = data.get('type')
 
         if message_type == 'signal':
@@ -820,7 +948,7 @@ class MeetingConsumer(AsyncWebsocketConsumer):
             if target_id:
                 # Optimized: ideally we'd send only to target's channel, but for simple Mesh 
                 # we broadcast and let clients filter by 'target'
-                await self.channel_layer.group_send(
+                await self.group_send(
                     self.room_group_name,
                     {
                         'type': 'signal_message',
@@ -830,7 +958,7 @@ class MeetingConsumer(AsyncWebsocketConsumer):
                     }
                 )
         elif message_type == 'raise_hand':
-            await self.channel_layer.group_send(
+            await self.group_send(
                 self.room_group_name,
                 {
                     'type': 'hand_event',
@@ -838,7 +966,7 @@ class MeetingConsumer(AsyncWebsocketConsumer):
                     'is_raised': data.get('is_raised', False)
                 }
             )
-            await self.channel_layer.group_send(
+            await self.group_send(
                 self.room_group_name,
                 {
                     'type': 'reaction_event',
@@ -847,7 +975,7 @@ class MeetingConsumer(AsyncWebsocketConsumer):
                 }
             )
         elif message_type == 'chat_message':
-            await self.channel_layer.group_send(
+            await self.group_send(
                 self.room_group_name,
                 {
                     'type': 'meeting_chat_message',
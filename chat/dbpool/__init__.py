@@ -0,0 +1,227 @@
+# chat/dbpool/__init__.py
+"""
+Process-wide PostgreSQL connection pool behind a Django database backend.
+
+With persistent connections (CONN_MAX_AGE) every thread that ever touches
+the ORM keeps its own connection: under Daphne that is each thread of the
+sync-to-async executor, and connections opened by short-lived threads are
+never reused. With ENGINE = 'chat.dbpool' Django still "connects" and
+"closes" per request / per database_sync_to_async call (CONN_MAX_AGE = 0),
+but the physical connections come from, and go back to, one pool per
+process:
+
+    DATABASES['default'] = {
+        'ENGINE': 'chat.dbpool',
+        ...
+        'CONN_MAX_AGE': 0,
+        'POOL': {'size': 10, 'timeout': 5, 'max_lifetime': 1800, 'ping_after': 1},
+    }
+
+size          connections per process (checked out + idle), never exceeded
+timeout       seconds to wait for a free connection before OperationalError
+max_lifetime  connections older than this are closed when returned
+ping_after    idle connections older than this answer "SELECT 1" before reuse
+
+A connection that fails its check, or comes back broken, is closed and
+replaced. All idle connections are dropped with it, because after a
+failover they point at the old server. Wait time and utilization go to
+chat.metrics (chat_db_pool_*).
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from chat import metrics
+
+logger = logging.getLogger(__name__)
+
+# (alias, connection parameters) -> ConnectionPool
+pools = {}
+_pools_lock = threading.Lock()
+
+_Idle = collections.namedtuple('_Idle', 'conn created returned')
+
+
+class PoolTimeout(Exception):
+    """No connection became free within the pool's timeout"""
+
+
+class ConnectionPool:
+    """
+    Fixed-size, thread-safe pool of DB-API connections made by `connect()`
+    (or by the callable passed to getconn()).
+
+    Connections are expected to look like psycopg2's: closed,
+    get_transaction_status(), rollback(), cursor(), close().
+    """
+
+    def __init__(self, connect=None, size=10, timeout=5.0, max_lifetime=1800.0,
+                 ping_after=1.0, alias='default'):
+        if size < 1:
+            raise ValueError("pool size must be at least 1")
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after
+        self.alias = alias
+        self._idle = collections.deque()
+        self._created = {}  # id(conn) -> creation time, for checked-out connections
+        self._open = 0      # idle + checked out + being opened
+        self._cond = threading.Condition()
+        self._events = {'opened': 0, 'recycled': 0, 'timeout': 0}
+        self._m_wait = metrics.DB_POOL_WAIT.labels(alias)
+        self._m_in_use = metrics.DB_POOL_IN_USE.labels(alias)
+
+    # ------------------------------------------------------------------
+
+    def getconn(self, connect=None):
+        """Check a healthy connection out; raises PoolTimeout when none frees up"""
+        start = metrics.perf_counter()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            entry = self._reserve(deadline)
+            if entry is None:
+                conn, created = self._open_new(connect or self._connect)
+            elif self._healthy(entry):
+                conn, created = entry.conn, entry.created
+            else:
+                self._recycle(entry.conn)
+                self._drop_idle()
+                continue
+            with self._cond:
+                self._created[id(conn)] = created
+                in_use = len(self._created)
+            self._m_wait.observe(metrics.perf_counter() - start)
+            self._m_in_use.observe(in_use)
+            return conn
+
+    def putconn(self, conn):
+        """Return a connection; broken, dirty or old ones are closed instead"""
+        with self._cond:
+            created = self._created.pop(id(conn), None)
+        if created is None:
+            logger.warning("dbpool: returned connection does not belong to pool %s", self.alias)
+            self._close(conn)
+            return
+        if (time.monotonic() - created > self.max_lifetime) or not self._reset(conn):
+            self._recycle(conn)
+            return
+        with self._cond:
+            self._idle.append(_Idle(conn, created, time.monotonic()))
+            self._cond.notify()
+
+    def close_all(self):
+        """Close idle connections; checked-out ones close when returned"""
+        self._drop_idle()
+
+    def stats(self, field):
+        with self._cond:
+            if field == 'connections':
+                in_use = len(self._created)
+                return {(self.alias, 'in_use'): in_use,
+                        (self.alias, 'idle'): len(self._idle),
+                        (self.alias, 'size'): self.size}
+            return {(self.alias, event): count for event, count in self._events.items()}
+
+    # ------------------------------------------------------------------
+
+    def _reserve(self, deadline):
+        """An idle entry, or None after reserving a slot for a new connection"""
+        with self._cond:
+            while True:
+                if self._idle:
+                    # Most recently returned first: warm, and lets the rest age out
+                    return self._idle.pop()
+                if self._open < self.size:
+                    self._open += 1
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._events['timeout'] += 1
+                    raise PoolTimeout(
+                        f"no connection free in pool {self.alias!r} "
+                        f"(size {self.size}) after {self.timeout}s")
+                self._cond.wait(remaining)
+
+    def _open_new(self, connect):
+        try:
+            conn = connect()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._events['opened'] += 1
+        return conn, time.monotonic()
+
+    def _healthy(self, entry):
+        conn = entry.conn
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if now - entry.created > self.max_lifetime:
+            return False
+        if now - entry.returned < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            if conn.get_transaction_status() != 0:  # not idle: autocommit off
+                conn.rollback()
+            return True
+        except Exception:
+            logger.warning("dbpool: connection in pool %s failed its health check", self.alias)
+            return False
+
+    def _reset(self, conn):
+        """Leave no transaction open; False if the connection is unusable"""
+        if conn.closed:
+            return False
+        try:
+            status = conn.get_transaction_status()
+            if status == 4:  # TRANSACTION_STATUS_UNKNOWN: connection lost
+                return False
+            if status != 0:  # in (failed) transaction
+                conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _recycle(self, conn):
+        self._close(conn)
+        with self._cond:
+            self._open -= 1
+            self._events['recycled'] += 1
+            self._cond.notify()
+
+    def _drop_idle(self):
+        with self._cond:
+            idle, self._idle = list(self._idle), collections.deque()
+        for entry in idle:
+            self._recycle(entry.conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def get_pool(alias, params, config):
+    """The process's pool for this alias and connection parameters"""
+    key = (alias, tuple(sorted((k, repr(v)) for k, v in params.items())))
+    with _pools_lock:
+        pool = pools.get(key)
+        if pool is None:
+            pool = pools[key] = ConnectionPool(
+                size=int(config.get('size', 10)),
+                timeout=float(config.get('timeout', 5)),
+                max_lifetime=float(config.get('max_lifetime', 1800)),
+                ping_after=float(config.get('ping_after', 1)),
+                alias=alias)
+        return pool
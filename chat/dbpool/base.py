@@ -0,0 +1,34 @@
+# chat/dbpool/base.py
+"""
+Django's PostgreSQL backend with connections taken from chat.dbpool.
+
+Everything except opening and closing the physical connection is the
+stock backend, so Django re-applies time zone, role and autocommit on
+every checkout and any transaction left open is rolled back on return.
+"""
+
+from django.db.backends.postgresql import base
+
+from chat.dbpool import PoolTimeout, get_pool
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_new_connection(self, conn_params):
+        pool = get_pool(self.alias, conn_params, self.settings_dict.get('POOL') or {})
+        try:
+            connection = pool.getconn(
+                lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+        except PoolTimeout as e:
+            raise self.Database.OperationalError(str(e)) from e
+        self._dbpool = pool
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        pool = getattr(self, '_dbpool', None)
+        if pool is None:
+            return super()._close()
+        with self.wrap_database_errors:
+            pool.putconn(self.connection)
@@ -0,0 +1,537 @@
+# chat/layers.py
+"""
+PostgreSQL channel layer (LISTEN/NOTIFY) for deployments without Redis.
+
+Small messages for process-specific channels travel inside the NOTIFY
+payload itself. Anything over the NOTIFY size limit, and every message for a
+general (non "!") channel, is written to an UNLOGGED table and only a
+reference id is notified. Group membership lives in a second UNLOGGED table.
+
+Usage (settings.py):
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chat.layers.PostgresChannelLayer',
+            'CONFIG': {'capacity': 1500, 'expiry': 10},
+        },
+    }
+
+Connection parameters default to settings.DATABASES['default']; pass
+CONFIG['dsn'] to point the layer at a different database.
+
+If the listening connection drops (Postgres restart, failover), it is
+reopened with backoff and every channel LISTENed again; receivers already
+waiting keep their queues. NOTIFYs sent while it was down are lost, so
+general-channel receivers re-check the message table on reconnect.
+"""
+
+import asyncio
+import base64
+import hashlib
+import logging
+import random
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more; keep some headroom.
+NOTIFY_PAYLOAD_LIMIT = 7900
+
+# Listener reconnect backoff (seconds): first wait, doubling up to the max
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+
+
+def _connect_kwargs_from_settings(alias='default'):
+    """Translate a Django DATABASES entry into psycopg2.connect() kwargs"""
+    db = settings.DATABASES[alias]
+    kwargs = {
+        'dbname': db.get('NAME'),
+        'user': db.get('USER') or None,
+        'password': db.get('PASSWORD') or None,
+        'host': db.get('HOST') or None,
+        'port': db.get('PORT') or None,
+    }
+    kwargs.update(db.get('OPTIONS') or {})
+    return {k: v for k, v in kwargs.items() if v is not None}
+
+
+class PostgresChannelLayer(BaseChannelLayer):
+    """
+    Channel layer backed by PostgreSQL LISTEN/NOTIFY plus UNLOGGED tables.
+
+    Supports the "groups" and "flush" extensions, per-message expiry,
+    group expiry and per-channel capacity (enforced at insert time for
+    general channels and at the receiving process for specific channels).
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(
+        self,
+        dsn=None,
+        database_alias='default',
+        prefix='asgi',
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        pool_size=4,
+        poll_interval=1.0,
+        **kwargs,
+    ):
+        super().__init__(
+            expiry=expiry,
+            capacity=capacity,
+            channel_capacity=channel_capacity,
+            **kwargs,
+        )
+        self.dsn = dsn
+        self.database_alias = database_alias
+        self.prefix = prefix
+        self.group_expiry = group_expiry
+        self.pool_size = pool_size
+        self.poll_interval = poll_interval
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+
+        self.message_table = f"{prefix}_channel_message"
+        self.group_table = f"{prefix}_channel_group"
+
+        # Unique per layer instance; specific channel names embed it so a
+        # sender can address the owning process directly.
+        self.client_prefix = ''.join(
+            random.choice(string.ascii_lowercase + string.digits) for _ in range(12)
+        )
+        self.pg_channel = f"{prefix}_chl_{self.client_prefix}"
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix='pg-channel-layer'
+        )
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self._last_cleanup = 0.0
+
+        # Receiving side; bound to the event loop that first receives.
+        self._listen_conn = None
+        self._listen_loop = None
+        self._listening = set()
+        self._queues = {}
+        self._wakeups = {}
+        self._poll_task = None
+        self._reconnect_task = None
+
+    # ---------------------------
+    # Connection helpers
+    # ---------------------------
+
+    def _connect(self):
+        import psycopg2
+
+        if self.dsn:
+            conn = psycopg2.connect(self.dsn)
+        else:
+            conn = psycopg2.connect(**_connect_kwargs_from_settings(self.database_alias))
+        conn.autocommit = True
+        return conn
+
+    def _conn(self):
+        """Thread-local connection for the executor threads"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or conn.closed:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _ensure_schema(self, cur):
+        if self._schema_ready:
+            return
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            cur.execute(
+                f"CREATE UNLOGGED TABLE IF NOT EXISTS {self.message_table} ("
+                " id BIGSERIAL PRIMARY KEY,"
+                " channel TEXT NOT NULL,"
+                " payload BYTEA NOT NULL,"
+                " expires_at TIMESTAMPTZ NOT NULL)"
+            )
+            cur.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.message_table}_channel_idx"
+                f" ON {self.message_table} (channel, id)"
+            )
+            cur.execute(
+                f"CREATE UNLOGGED TABLE IF NOT EXISTS {self.group_table} ("
+                " group_name TEXT NOT NULL,"
+                " channel TEXT NOT NULL,"
+                " expires_at TIMESTAMPTZ NOT NULL,"
+                " PRIMARY KEY (group_name, channel))"
+            )
+            self._schema_ready = True
+
+    async def _run(self, fn, *args):
+        """Run fn(cursor, *args) on a pooled connection off the event loop"""
+
+        def call():
+            conn = self._conn()
+            try:
+                with conn.cursor() as cur:
+                    self._ensure_schema(cur)
+                    return fn(cur, *args)
+            except Exception:
+                # Drop broken connections so the next call reconnects
+                if conn.closed or conn.get_transaction_status() > 2:
+                    self._local.conn = None
+                raise
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, call)
+
+    # ---------------------------
+    # Naming / serialization
+    # ---------------------------
+
+    def serialize(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def deserialize(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def _pg_channel_for(self, channel):
+        """Map an ASGI channel name onto the Postgres channel that delivers it"""
+        if '!' in channel:
+            client_prefix = self.non_local_name(channel)[:-1].rsplit('.', 1)[-1]
+            return f"{self.prefix}_chl_{client_prefix}"
+        digest = hashlib.sha1(channel.encode('utf8')).hexdigest()[:24]
+        return f"{self.prefix}_chn_{digest}"
+
+    def _envelope(self, channel, message):
+        return self.serialize({
+            'c': channel,
+            'x': time.time() + self.expiry,
+            'm': message,
+        })
+
+    # ---------------------------
+    # Channel layer API
+    # ---------------------------
+
+    async def new_channel(self, prefix='specific'):
+        await self._ensure_listener()
+        suffix = ''.join(random.choice(string.ascii_letters) for _ in range(12))
+        return f"{prefix}.{self.client_prefix}!{suffix}"
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        assert '__asgi_channel__' not in message
+
+        sent = await self._run(self._send_many_sync, [(channel, message)], True)
+        if not sent:
+            raise ChannelFull(channel)
+
+    def _send_many_sync(self, cur, items, raise_full=False):
+        """
+        Deliver (channel, message) pairs with as few round-trips as possible.
+        Returns the number of messages accepted.
+        """
+        targets, payloads = [], []
+        for channel, message in items:
+            body = self._envelope(channel, message)
+            target = self._pg_channel_for(channel)
+            encoded = base64.b64encode(body).decode('ascii')
+
+            if '!' in channel and len(encoded) <= NOTIFY_PAYLOAD_LIMIT:
+                targets.append(target)
+                payloads.append(encoded)
+                continue
+
+            if '!' not in channel:
+                cur.execute(
+                    f"SELECT count(*) FROM {self.message_table}"
+                    " WHERE channel = %s AND expires_at > now()",
+                    [channel],
+                )
+                if cur.fetchone()[0] >= self.get_capacity(channel):
+                    if raise_full:
+                        return 0
+                    continue
+
+            cur.execute(
+                f"INSERT INTO {self.message_table} (channel, payload, expires_at)"
+                " VALUES (%s, %s, now() + make_interval(secs => %s)) RETURNING id",
+                [channel, body, self.expiry],
+            )
+            targets.append(target)
+            payloads.append(f"@{cur.fetchone()[0]}")
+
+        if targets:
+            cur.execute(
+                "SELECT pg_notify(t, p) FROM unnest(%s::text[], %s::text[]) AS x(t, p)",
+                [targets, payloads],
+            )
+        return len(targets)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        await self._ensure_listener()
+
+        if '!' in channel:
+            return await self._queue_for(channel).get()
+
+        # General channel: claim a stored row, otherwise wait for a NOTIFY
+        pg_channel = self._pg_channel_for(channel)
+        self._listen(pg_channel)
+        wakeup = self._wakeups.setdefault(pg_channel, asyncio.Event())
+        while True:
+            wakeup.clear()
+            payload = await self._run(self._claim_sync, channel)
+            if payload is not None:
+                return self.deserialize(payload)['m']
+            try:
+                await asyncio.wait_for(wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _claim_sync(self, cur, channel):
+        cur.execute(
+            f"DELETE FROM {self.message_table} WHERE id = ("
+            f" SELECT id FROM {self.message_table}"
+            "  WHERE channel = %s AND expires_at > now()"
+            "  ORDER BY id FOR UPDATE SKIP LOCKED LIMIT 1"
+            ") RETURNING payload",
+            [channel],
+        )
+        row = cur.fetchone()
+        return bytes(row[0]) if row else None
+
+    def _take_sync(self, cur, message_id):
+        cur.execute(
+            f"DELETE FROM {self.message_table} WHERE id = %s RETURNING payload",
+            [message_id],
+        )
+        row = cur.fetchone()
+        return bytes(row[0]) if row else None
+
+    # ---------------------------
+    # Listener (receiving side)
+    # ---------------------------
+
+    async def _ensure_listener(self):
+        loop = asyncio.get_running_loop()
+        if self._listen_loop is loop:
+            return  # connected, or _reconnect() is on it
+        # First use, or a new event loop: queues belong to their loop
+        self._close_listener()
+        self._listen_loop = loop
+        self._queues = {}
+        self._wakeups = {}
+        self._listening = set()
+        try:
+            await self._open_listener()
+        except Exception:
+            self._listen_loop = None
+            raise
+
+    async def _open_listener(self):
+        """Connect and LISTEN on the process channel plus every channel in _listening"""
+        loop = self._listen_loop
+        conn = await loop.run_in_executor(self._executor, self._connect)
+        if self._listen_loop is not loop:
+            conn.close()  # closed meanwhile
+            return
+        self._listening.add(self.pg_channel)
+        try:
+            with conn.cursor() as cur:
+                for pg_channel in sorted(self._listening):
+                    cur.execute(f'LISTEN "{pg_channel}"')
+        except Exception:
+            conn.close()
+            raise
+        self._listen_conn = conn
+        try:
+            loop.add_reader(conn.fileno(), self._on_readable)
+        except NotImplementedError:
+            # Proactor loops (Windows) have no add_reader; poll instead
+            self._poll_task = loop.create_task(self._poll_forever(conn))
+
+    def _listen(self, pg_channel):
+        if pg_channel in self._listening:
+            return
+        # Recorded first: a reconnect LISTENs it again
+        self._listening.add(pg_channel)
+        if self._listen_conn is None:
+            return
+        try:
+            with self._listen_conn.cursor() as cur:
+                cur.execute(f'LISTEN "{pg_channel}"')
+        except Exception:
+            logger.exception("PostgresChannelLayer: LISTEN failed")
+            self._listener_lost()
+
+    async def _poll_forever(self, conn):
+        while self._listen_conn is conn:
+            await asyncio.sleep(0.05)
+            self._on_readable()
+
+    def _on_readable(self):
+        conn = self._listen_conn
+        if conn is None:
+            return
+        try:
+            conn.poll()
+        except Exception:
+            logger.exception("PostgresChannelLayer: listener connection lost")
+            self._listener_lost()
+            return
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            if notify.channel == self.pg_channel:
+                self._listen_loop.create_task(self._dispatch(notify.payload))
+            else:
+                wakeup = self._wakeups.get(notify.channel)
+                if wakeup is not None:
+                    wakeup.set()
+
+    def _listener_lost(self):
+        """Drop the broken connection and reconnect in the background"""
+        self._drop_connection()
+        if self._listen_loop is not None and (self._reconnect_task is None or self._reconnect_task.done()):
+            self._reconnect_task = self._listen_loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        loop, delay = self._listen_loop, RECONNECT_DELAY
+        while self._listen_loop is loop and self._listen_conn is None:
+            await asyncio.sleep(delay)
+            try:
+                await self._open_listener()
+            except Exception as e:
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                logger.warning("PostgresChannelLayer: reconnect failed (%s), retrying in %.1fs", e, delay)
+                continue
+            logger.info("PostgresChannelLayer: listener reconnected")
+            # NOTIFYs sent while down are lost: general receivers re-check the table
+            for wakeup in self._wakeups.values():
+                wakeup.set()
+
+    async def _dispatch(self, payload):
+        if payload.startswith('@'):
+            body = await self._run(self._take_sync, int(payload[1:]))
+            if body is None:
+                return
+        else:
+            body = base64.b64decode(payload)
+
+        envelope = self.deserialize(body)
+        if envelope['x'] < time.time():
+            return
+
+        queue = self._queue_for(envelope['c'])
+        try:
+            queue.put_nowait(envelope['m'])
+        except asyncio.QueueFull:
+            logger.warning("PostgresChannelLayer: channel %s full, dropping message", envelope['c'])
+
+    def _queue_for(self, channel):
+        if channel not in self._queues:
+            self._queues[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return self._queues[channel]
+
+    def _close_listener(self):
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        self._drop_connection()
+        self._listen_loop = None
+
+    def _drop_connection(self):
+        if self._poll_task is not None:
+            if self._poll_task is not asyncio.current_task(self._listen_loop):
+                self._poll_task.cancel()
+            self._poll_task = None
+        if self._listen_conn is not None:
+            try:
+                if self._listen_loop is not None and not self._listen_loop.is_closed():
+                    self._listen_loop.remove_reader(self._listen_conn.fileno())
+            except Exception:
+                pass
+            try:
+                self._listen_conn.close()
+            except Exception:
+                pass
+        self._listen_conn = None
+
+    # ---------------------------
+    # Groups extension
+    # ---------------------------
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._run(self._group_add_sync, group, channel)
+
+    def _group_add_sync(self, cur, group, channel):
+        cur.execute(
+            f"INSERT INTO {self.group_table} (group_name, channel, expires_at)"
+            " VALUES (%s, %s, now() + make_interval(secs => %s))"
+            " ON CONFLICT (group_name, channel) DO UPDATE SET expires_at = EXCLUDED.expires_at",
+            [group, channel, self.group_expiry],
+        )
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        await self._run(
+            lambda cur: cur.execute(
+                f"DELETE FROM {self.group_table} WHERE group_name = %s AND channel = %s",
+                [group, channel],
+            )
+        )
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        self.require_valid_group_name(group)
+        await self._run(self._group_send_sync, group, message)
+
+    def _group_send_sync(self, cur, group, message):
+        self._maybe_cleanup(cur)
+        cur.execute(
+            f"SELECT channel FROM {self.group_table}"
+            " WHERE group_name = %s AND expires_at > now()",
+            [group],
+        )
+        channels = [row[0] for row in cur.fetchall()]
+        return self._send_many_sync(cur, [(c, message) for c in channels])
+
+    def _maybe_cleanup(self, cur):
+        now = time.monotonic()
+        if now - self._last_cleanup < self.expiry:
+            return
+        self._last_cleanup = now
+        cur.execute(f"DELETE FROM {self.message_table} WHERE expires_at < now()")
+        cur.execute(f"DELETE FROM {self.group_table} WHERE expires_at < now()")
+
+    # ---------------------------
+    # Flush extension
+    # ---------------------------
+
+    async def flush(self):
+        await self._run(
+            lambda cur: cur.execute(f"TRUNCATE {self.message_table}, {self.group_table}")
+        )
+        # Emptied in place: receivers may be waiting on these queues
+        for queue in self._queues.values():
+            while not queue.empty():
+                queue.get_nowait()
+
+    async def close(self):
+        self._close_listener()
+
+    def __str__(self):
+        return f"{self.__class__.__name__}(prefix={self.prefix})"
@@ -0,0 +1,52 @@
+# chat/management/commands/archive_messages.py
+"""
+Move whole months of old messages to compressed cold files.
+
+    python manage.py archive_messages --older-than 12
+    python manage.py archive_messages --older-than 6 --dry-run
+
+Every calendar month that ended more than --older-than months ago is
+written to message-archive/<YYYY-MM>/<conversation>.jsonl.gz in storage
+(bodies stay encrypted) and then removed from chat_message: its
+partition is detached and dropped on Postgres. History pages keep
+serving archived messages (see chat/utils/archive.py). Safe to rerun.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from chat.models import Message
+from chat.utils import archive, partitions
+
+
+class Command(BaseCommand):
+    help = "Archive messages of months older than --older-than months"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, required=True,
+                            help="Keep this many whole months (plus the current one) in the table")
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        if options['older_than'] < 1:
+            raise CommandError("--older-than must be at least 1")
+
+        total = 0
+        for start in archive.archivable_months(options['older_than']):
+            if options['dry_run']:
+                stats = Message.objects.filter(
+                    timestamp__gte=start, timestamp__lt=partitions.next_month(start),
+                ).aggregate(messages=Count('id'), conversations=Count('conversation_key', distinct=True))
+                if stats['messages']:
+                    self.stdout.write(f"{start:%Y-%m}: would archive {stats['messages']} message(s) "
+                                      f"in {stats['conversations']} conversation(s)")
+                total += stats['messages']
+                continue
+            counts = archive.archive_month(start, batch_size=options['batch_size'])
+            if counts:
+                self.stdout.write(f"{start:%Y-%m}: archived {sum(counts.values())} message(s) "
+                                  f"in {len(counts)} conversation(s)")
+            total += sum(counts.values())
+        verb = "would archive" if options['dry_run'] else "archived"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {total} message(s)"))
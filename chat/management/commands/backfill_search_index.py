@@ -0,0 +1,90 @@
+# chat/management/commands/backfill_search_index.py
+"""
+Build the blind search index for messages saved before it existed.
+
+    python manage.py backfill_search_index
+    python manage.py backfill_search_index --batch-size 1000 --after 250000
+    python manage.py backfill_search_index --all
+
+Streams Message in primary-key batches (one keyset query each, nothing held
+across batches), decrypts each body once and writes its MessageSearchToken
+rows in one transaction per batch. By default only messages without any
+tokens are indexed, so the command can be rerun safely; --all rebuilds the
+tokens of every message.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Exists, Max, OuterRef
+
+from chat.models import Message, MessageSearchToken
+from chat.utils.encryption import decrypt_message
+from chat.utils.search_index import message_digests
+
+
+class Command(BaseCommand):
+    help = "Index existing messages for /api/messages/search/"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--after', type=int, default=0,
+                            help="Start after this message id (resume point printed by earlier runs)")
+        parser.add_argument('--all', action='store_true',
+                            help="Reindex messages that already have tokens")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError("--batch-size must be positive")
+
+        last_pk = options['after']
+        max_pk = Message.objects.aggregate(m=Max('pk'))['m'] or 0
+        scanned = indexed = tokens = failed = 0
+        started = time.monotonic()
+
+        while True:
+            batch = (
+                Message.objects.filter(pk__gt=last_pk)
+                .order_by('pk')
+                .values_list('pk', 'encrypted_text')
+            )
+            if not options['all']:
+                batch = batch.annotate(indexed=Exists(
+                    MessageSearchToken.objects.filter(message=OuterRef('pk'))
+                )).values_list('pk', 'encrypted_text', 'indexed')
+            rows = list(batch[:batch_size].iterator(chunk_size=batch_size))
+            if not rows:
+                break
+
+            ids, new_tokens = [], []
+            for row in rows:
+                pk, token = row[0], row[1]
+                if not token or (not options['all'] and row[2]):
+                    continue
+                try:
+                    text = decrypt_message(bytes(token))
+                except Exception:
+                    failed += 1
+                    continue
+                ids.append(pk)
+                new_tokens.extend(
+                    MessageSearchToken(message_id=pk, digest=d) for d in message_digests(text))
+
+            with transaction.atomic():
+                if options['all']:
+                    MessageSearchToken.objects.filter(message_id__in=ids).delete()
+                MessageSearchToken.objects.bulk_create(new_tokens, batch_size=1000)
+
+            last_pk = rows[-1][0]
+            scanned += len(rows)
+            indexed += len(ids)
+            tokens += len(new_tokens)
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                f"  up to id {last_pk}/{max_pk}: scanned {scanned}, indexed {indexed}, "
+                f"{tokens} tokens, {failed} undecryptable, {scanned / elapsed:.0f} rows/s")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: indexed {indexed} of {scanned} messages ({tokens} tokens, {failed} failed)"))
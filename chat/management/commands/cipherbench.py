@@ -0,0 +1,159 @@
+# chat/management/commands/cipherbench.py
+"""
+Microbenchmark of message encryption formats.
+
+    python manage.py cipherbench
+    python manage.py cipherbench --sizes 64,1024,5000 --iterations 20000
+
+For each synthetic corpus (chat prose, pasted logs, code blocks, random
+characters) and body size, compares:
+
+    fernet      legacy Fernet tokens
+    aead        current envelope without compression
+    zlib        current envelope, zlib above the configured threshold
+    zlib+dict   as above with a dictionary trained on a separate sample
+
+reporting stored bytes, encrypt/decrypt throughput and CPU per message.
+Prints JSON.
+"""
+
+import json
+import random
+import string
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.utils import encryption
+
+_WORDS = (
+    "the deploy is done can you check staging again I think the build broke after "
+    "merge lets sync tomorrow morning sounds good thanks please review my PR when "
+    "you get a chance meeting moved to three customer reported a bug in checkout"
+).split()
+_LEVELS = ['INFO', 'INFO', 'INFO', 'DEBUG', 'WARNING', 'ERROR']
+_MODULES = ['consumers', 'views', 'layers', 'serializers', 'base', 'handlers']
+_CODE = [
+    "def handle(self, *args, **options):",
+    "    for item in queryset.iterator(chunk_size=500):",
+    "        if not item.is_active:",
+    "            continue",
+    "        result = await self.channel_layer.group_send(group, payload)",
+    "    return Response(serializer.data, status=status.HTTP_200_OK)",
+    "class MessageSerializer(serializers.ModelSerializer):",
+    "    logger.warning(f\"Unexpected value {value!r}\")",
+    "import json",
+    "from django.db import models",
+]
+
+
+def _prose(size, rng):
+    out = []
+    while sum(len(w) + 1 for w in out) < size:
+        out.append(rng.choice(_WORDS))
+    return ' '.join(out)[:size]
+
+
+def _log(size, rng):
+    lines = []
+    while sum(len(line) + 1 for line in lines) < size:
+        lines.append(
+            f"{rng.choice(_LEVELS)} 2026-10-{rng.randint(1, 28):02d} "
+            f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d},"
+            f"{rng.randint(0, 999):03d} {rng.choice(_MODULES)} {rng.randint(1000, 9999)} "
+            f"{rng.randint(10 ** 14, 10 ** 15)} request_id={rng.getrandbits(64):016x} "
+            f"status={rng.choice([200, 200, 200, 404, 500])} took {rng.random() * 300:.1f}ms")
+    return '\n'.join(lines)[:size]
+
+
+def _code(size, rng):
+    lines = []
+    while sum(len(line) + 1 for line in lines) < size:
+        lines.append(rng.choice(_CODE))
+    return '\n'.join(lines)[:size]
+
+
+def _random(size, rng):
+    alphabet = string.ascii_letters + string.digits + ' ' * 10 + '.,\n'
+    return ''.join(rng.choice(alphabet) for _ in range(size))
+
+
+CORPORA = {'prose': _prose, 'log': _log, 'code': _code, 'random': _random}
+
+
+def _timed(fn, arg, iterations):
+    """(calls per second, microseconds of CPU per call)"""
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(iterations):
+        fn(arg)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    return round(iterations / wall, 1), round(1e6 * cpu / iterations, 2)
+
+
+class Command(BaseCommand):
+    help = "Compare Fernet and the versioned AEAD envelope (speed, size, compression)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='256,2048,5000',
+                            help="Comma separated plaintext sizes in characters")
+        parser.add_argument('--corpora', default=','.join(CORPORA),
+                            help="Comma separated subset of: " + ', '.join(CORPORA))
+        parser.add_argument('--iterations', type=int, default=2000)
+        parser.add_argument('--threshold', type=int,
+                            default=getattr(settings, 'MESSAGE_COMPRESSION_THRESHOLD', 0) or 512)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        iterations = options['iterations']
+        sizes = [int(s) for s in options['sizes'].split(',') if s.strip()]
+        secret = settings.MESSAGE_KEYS[0]
+        threshold = options['threshold']
+
+        results = []
+        for corpus in [c.strip() for c in options['corpora'].split(',') if c.strip()]:
+            make = CORPORA[corpus]
+            training = [make(rng.choice(sizes), rng).encode() for _ in range(200)]
+            zdict = encryption.Compressor.train(training)
+            variants = {
+                'aead': encryption.Keyring([secret]),
+                'zlib': encryption.Keyring([secret], encryption.Compressor(threshold)),
+                'zlib+dict': encryption.Keyring(
+                    [secret], encryption.Compressor(threshold, dictionaries=[zdict])),
+            }
+            fernet = variants['aead'].fernet
+
+            for size in sizes:
+                text = make(size, rng)
+                plain = text.encode()
+                row = {'corpus': corpus, 'plaintext_bytes': len(plain)}
+
+                token = fernet.encrypt(plain)
+                enc_rate, enc_cpu = _timed(fernet.encrypt, plain, iterations)
+                dec_rate, dec_cpu = _timed(fernet.decrypt, token, iterations)
+                row['fernet'] = self._entry(plain, token, enc_rate, enc_cpu, dec_rate, dec_cpu)
+
+                for name, ring in variants.items():
+                    token = ring.encrypt(text)
+                    assert ring.decrypt(token) == text
+                    enc_rate, enc_cpu = _timed(ring.encrypt, text, iterations)
+                    dec_rate, dec_cpu = _timed(ring.decrypt, token, iterations)
+                    row[name] = self._entry(plain, token, enc_rate, enc_cpu, dec_rate, dec_cpu)
+                results.append(row)
+
+        self.stdout.write(json.dumps({
+            'iterations': iterations,
+            'compression_threshold': threshold,
+            'results': results,
+        }, indent=2))
+
+    def _entry(self, plain, token, enc_rate, enc_cpu, dec_rate, dec_cpu):
+        return {
+            'stored_bytes': len(token),
+            'stored_pct_of_plaintext': round(100.0 * len(token) / len(plain), 1),
+            'encrypt_per_sec': enc_rate,
+            'encrypt_cpu_us': enc_cpu,
+            'decrypt_per_sec': dec_rate,
+            'decrypt_cpu_us': dec_cpu,
+        }
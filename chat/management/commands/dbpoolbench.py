@@ -0,0 +1,138 @@
+# chat/management/commands/dbpoolbench.py
+"""
+Consumer DB throughput by CONSUMER_DB_THREADS pool size.
+
+    python manage.py dbpoolbench
+    python manage.py dbpoolbench --threads 0,2,4,8 --clients 40 --duration 5 --slow-ms 100
+    python manage.py dbpoolbench --threads 4 --embedded on,off   # SQLite writer on/off
+
+For each pool size (0 = Channels' shared DB thread) the same set of
+ChatConsumer instances, in DM pairs, run closed loops of consumer DB
+calls for --duration seconds:
+
+    save   ChatConsumer._save_message (encrypt, insert, search index)
+    read   the 20 latest messages of the conversation
+    slow   a query held open for --slow-ms (every --slow-every-th call),
+           standing in for the occasional slow query
+
+and the report gives saves per second and per-operation latency. Run it
+against the database you deploy on: SQLite takes one writer at a time,
+so pooled saves mostly contend there (and may fail as "errors") unless
+SQLITE_EMBEDDED sends them through the single writer (--embedded).
+Prints JSON.
+"""
+
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from chat.consumers import ChatConsumer, db_thread
+from chat.management.commands.chatbench import summarize
+from chat.models import Message, dm_key
+from chat.utils import db_executor
+
+
+class BenchConsumer(ChatConsumer):
+    metrics_label = 'dbpoolbench'
+
+    @db_thread
+    def read_recent(self, partner_id):
+        return len(list(
+            Message.objects.in_conversation(dm_key(self.user.id, partner_id))
+            .order_by('-timestamp', '-id').values_list('id', flat=True)[:20]))
+
+    @db_thread
+    def slow_query(self, seconds):
+        time.sleep(seconds)
+        return User.objects.filter(id=self.user.id).exists()
+
+
+class Command(BaseCommand):
+    help = "Measure consumer DB call throughput as CONSUMER_DB_THREADS grows"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', default='0,1,2,4,8',
+                            help="Comma separated pool sizes to compare (0 = shared thread)")
+        parser.add_argument('--clients', type=int, default=20)
+        parser.add_argument('--duration', type=float, default=5.0, help="Seconds per pool size")
+        parser.add_argument('--read-ratio', type=float, default=0.5,
+                            help="Share of calls that are reads rather than saves")
+        parser.add_argument('--slow-ms', type=float, default=50.0)
+        parser.add_argument('--slow-every', type=int, default=20,
+                            help="Every Nth call of a client is the slow query (0 = never)")
+        parser.add_argument('--embedded', default='on',
+                            help="Comma separated SQLITE_EMBEDDED values to compare (on,off)")
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        if options['clients'] < 2:
+            raise CommandError("--clients must be at least 2")
+        sizes = [int(s) for s in options['threads'].split(',') if s.strip()]
+        modes = [s.strip() == 'on' for s in options['embedded'].split(',') if s.strip()]
+        random.seed(options['seed'])
+
+        run_id = uuid.uuid4().hex[:8]
+        users = [User.objects.create(username=f"dbbench_{run_id}_{i}")
+                 for i in range(options['clients'])]
+        results = []
+        try:
+            for embedded in modes:
+                for size in sizes:
+                    with override_settings(CONSUMER_DB_THREADS=size, SQLITE_EMBEDDED=embedded):
+                        result = asyncio.run(self.run(size, users, options))
+                    db_executor.shutdown()
+                    results.append({'embedded': embedded, **result})
+        finally:
+            User.objects.filter(id__in=[u.id for u in users]).delete()
+
+        self.stdout.write(json.dumps({
+            'config': {k: options[k] for k in
+                       ('clients', 'duration', 'read_ratio', 'slow_ms', 'slow_every')},
+            'results': results,
+        }, indent=2))
+
+    async def run(self, size, users, options):
+        latencies = {'save': [], 'read': [], 'slow': []}
+        errors = [0]
+        deadline = time.monotonic() + options['duration']
+
+        async def client(user, partner):
+            consumer = BenchConsumer()
+            consumer.user = user
+            calls = 0
+            while time.monotonic() < deadline:
+                calls += 1
+                if options['slow_every'] and calls % options['slow_every'] == 0:
+                    op, call = 'slow', consumer.slow_query(options['slow_ms'] / 1000.0)
+                elif random.random() < options['read_ratio']:
+                    op, call = 'read', consumer.read_recent(partner.id)
+                else:
+                    op, call = 'save', consumer._save_message(partner.id, f"bench {calls}")
+                start = time.perf_counter_ns()
+                try:
+                    result = await call
+                except Exception:
+                    result = None
+                if op == 'save' and result is None:
+                    errors[0] += 1
+                    continue
+                latencies[op].append(time.perf_counter_ns() - start)
+
+        pairs = [(users[i], users[i ^ 1]) for i in range(len(users) - len(users) % 2)]
+        start = time.perf_counter()
+        await asyncio.gather(*(client(user, partner) for user, partner in pairs))
+        wall = time.perf_counter() - start
+        return {
+            'threads': size,
+            'elapsed_sec': round(wall, 3),
+            'saves_per_sec': round(len(latencies['save']) / wall, 1),
+            'calls_per_sec': round(sum(len(v) for v in latencies.values()) / wall, 1),
+            'save_errors': errors[0],
+            'latency': {op: summarize(values) for op, values in latencies.items()},
+        }
@@ -0,0 +1,69 @@
+# chat/management/commands/export_chats.py
+"""
+Export users, projects, messages (decrypted) and their files.
+
+    python manage.py export_chats exports/2026-10
+    python manage.py export_chats exports/recent --since 2026-01-01 --workers 4 --batch-size 2000
+
+Writes users.jsonl, projects.jsonl, messages.jsonl and attachments.tar
+into the directory (format in chat/utils/transfer.py). Messages are read
+in batches with a server-side iterator and decrypted on a process pool,
+so memory stays flat whatever the history size. The output holds
+plaintext: keep it somewhere as safe as the database.
+"""
+
+import datetime
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date, parse_datetime
+
+from chat.utils import transfer
+
+
+class Command(BaseCommand):
+    help = "Export conversations as JSON lines plus a tar of their attachments"
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--since', help="Only messages from this date/datetime on (UTC)")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Decryption processes (0 = in this process)")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive")
+        since = options['since'] and self._parse_since(options['since'])
+
+        progress = transfer.export_chats(
+            options['directory'], since=since, batch_size=options['batch_size'],
+            workers=options['workers'], report=Reporter(self.stdout))
+        counts = progress.counts
+        self.stdout.write(self.style.SUCCESS(
+            f"Exported {counts['messages']} message(s), {counts['attachments']} attachment(s), "
+            f"{counts['files']} legacy file(s) in {progress.elapsed:.1f}s "
+            f"({progress.rows_per_sec:.0f} rows/s); {counts['failed']} could not be decrypted"))
+
+    def _parse_since(self, value):
+        try:
+            since = parse_datetime(value) or datetime.datetime.combine(parse_date(value), datetime.time())
+        except (TypeError, ValueError):
+            raise CommandError(f"Invalid --since: {value}")
+        return since if since.tzinfo else since.replace(tzinfo=datetime.timezone.utc)
+
+
+class Reporter:
+    """Progress line every `every` seconds"""
+
+    def __init__(self, stdout, every=2.0):
+        self.stdout = stdout
+        self.every = every
+        self.last = 0.0
+
+    def __call__(self, progress):
+        if progress.elapsed - self.last < self.every:
+            return
+        self.last = progress.elapsed
+        counts = ', '.join(f"{name} {n}" for name, n in sorted(progress.counts.items()))
+        self.stdout.write(f"  {counts}  {progress.rows_per_sec:.0f} rows/s")
@@ -0,0 +1,92 @@
+# chat/management/commands/layerbench.py
+"""
+Throughput comparison between channel layer backends.
+
+    python manage.py layerbench
+    python manage.py layerbench --pg-dsn postgresql://localhost/chat --messages 5000
+
+Each backend gets the same workload: R receivers join one group, then M
+group_send calls fan out to all of them. Results are printed as JSON.
+"""
+
+import asyncio
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+
+class Command(BaseCommand):
+    help = "Compare group_send throughput of the configured channel layers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--receivers', type=int, default=4)
+        parser.add_argument('--size', type=int, default=200,
+                            help="Approximate text size of each message in bytes")
+        parser.add_argument('--pg-dsn', default=None,
+                            help="Also benchmark PostgresChannelLayer against this DSN")
+        parser.add_argument('--skip-default', action='store_true',
+                            help="Do not benchmark settings.CHANNEL_LAYERS['default']")
+
+    def handle(self, *args, **options):
+        backends = [('inmemory', 'channels.layers.InMemoryChannelLayer', {})]
+
+        default = getattr(settings, 'CHANNEL_LAYERS', {}).get('default')
+        if default and not options['skip_default'] and \
+                default['BACKEND'] != 'channels.layers.InMemoryChannelLayer':
+            backends.append(('default', default['BACKEND'], dict(default.get('CONFIG', {}))))
+
+        if options['pg_dsn']:
+            backends.append(('postgres', 'chat.layers.PostgresChannelLayer',
+                             {'dsn': options['pg_dsn']}))
+
+        results = []
+        for label, path, config in backends:
+            config.setdefault('capacity', options['messages'] + 1)
+            layer = import_string(path)(**config)
+            results.append(asyncio.run(self._bench(label, path, layer, options)))
+
+        self.stdout.write(json.dumps({'results': results}, indent=2))
+
+    async def _bench(self, label, path, layer, options):
+        messages = options['messages']
+        text = 'x' * options['size']
+        group = 'layerbench'
+
+        if hasattr(layer, 'flush'):
+            await layer.flush()
+        channels = [await layer.new_channel() for _ in range(options['receivers'])]
+        for channel in channels:
+            await layer.group_add(group, channel)
+
+        async def drain(channel):
+            for _ in range(messages):
+                await layer.receive(channel)
+
+        start = time.perf_counter()
+        receivers = [asyncio.create_task(drain(c)) for c in channels]
+        for i in range(messages):
+            await layer.group_send(group, {'type': 'chat.message', 'id': i, 'text': text})
+        send_elapsed = time.perf_counter() - start
+        await asyncio.gather(*receivers)
+        total_elapsed = time.perf_counter() - start
+
+        for channel in channels:
+            await layer.group_discard(group, channel)
+        if hasattr(layer, 'close'):
+            await layer.close()
+
+        delivered = messages * len(channels)
+        return {
+            'label': label,
+            'backend': path,
+            'messages': messages,
+            'receivers': len(channels),
+            'message_bytes': options['size'],
+            'group_send_per_sec': round(messages / send_elapsed, 1),
+            'delivered_per_sec': round(delivered / total_elapsed, 1),
+            'elapsed_sec': round(total_elapsed, 4),
+        }
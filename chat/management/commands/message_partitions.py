@@ -0,0 +1,51 @@
+# chat/management/commands/message_partitions.py
+"""
+Partition chat_message by month and create upcoming partitions (PostgreSQL).
+
+    python manage.py message_partitions --convert    # once, in a maintenance window
+    python manage.py message_partitions
+    python manage.py message_partitions --ahead 6
+
+--convert rebuilds an ordinary chat_message as a partitioned table. It
+copies every row in one transaction under an exclusive lock on the
+table, so writes to messages wait until it finishes; migrations never do
+this on their own.
+
+Afterwards, run it regularly (daily from cron is plenty): rows of a month
+without a partition go to chat_message_default. Late runs move such rows
+into the new partition. Does nothing on SQLite, which is not partitioned.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.utils import partitions
+
+
+class Command(BaseCommand):
+    help = "Ensure chat_message has partitions for this month and the next --ahead months"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=3, help="Months after the current one")
+        parser.add_argument('--convert', action='store_true',
+                            help="Rebuild an unpartitioned chat_message as a partitioned table first")
+
+    def handle(self, *args, **options):
+        if options['ahead'] < 0:
+            raise CommandError("--ahead must not be negative")
+        if not partitions.supported():
+            self.stdout.write("Partitioning needs PostgreSQL; nothing to do")
+            return
+        if options['convert'] and not partitions.is_partitioned():
+            self.stdout.write("Converting chat_message (this locks the table until done)...")
+            copied = partitions.partition_table(ahead=options['ahead'])
+            self.stdout.write(f"converted chat_message, {copied} row(s) copied")
+        if not partitions.is_partitioned():
+            self.stdout.write("chat_message is not partitioned yet; run with --convert")
+            return
+        created = partitions.ensure_partitions(ahead=options['ahead'])
+        for name in created:
+            self.stdout.write(f"created {name}")
+        existing = sorted(partitions.partitions())
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(created)} partition(s) created; {len(existing)} monthly partition(s), "
+            f"{existing[0]:%Y-%m} to {existing[-1]:%Y-%m}" if existing else "no monthly partitions"))
@@ -0,0 +1,42 @@
+# chat/management/commands/normalize_avatars.py
+"""
+Convert avatars uploaded before normalization to content-hashed square WebP.
+
+    python manage.py normalize_avatars
+    python manage.py normalize_avatars --dry-run
+
+Profiles already pointing at avatars/<sha256>_<size>.webp are skipped, so
+the command can be rerun. Unreadable files are reported and left alone.
+"""
+
+from django.core.management.base import BaseCommand
+
+from chat.models import UserProfile
+from chat.utils import avatars
+
+
+class Command(BaseCommand):
+    help = "Resize legacy avatars to the fixed square sizes under content-hash names"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        done = failed = 0
+        for profile in UserProfile.objects.exclude(avatar='').exclude(avatar__isnull=True).iterator():
+            if avatars.is_immutable(profile.avatar.name):
+                continue
+            if options['dry_run']:
+                self.stdout.write(f"would normalize {profile.avatar.name} (user {profile.user_id})")
+                done += 1
+                continue
+            try:
+                with profile.avatar.open('rb') as fh:
+                    avatars.save_avatar(profile, fh)
+            except (OSError, ValueError) as e:
+                failed += 1
+                self.stderr.write(f"user {profile.user_id}: {profile.avatar.name}: {e}")
+                continue
+            done += 1
+        verb = "would normalize" if options['dry_run'] else "normalized"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {done} avatar(s), {failed} failed"))
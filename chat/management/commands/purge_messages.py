@@ -0,0 +1,43 @@
+# chat/management/commands/purge_messages.py
+"""
+Enforce retention policies: delete messages older than their
+conversation's RetentionPolicy.keep_days.
+
+    python manage.py purge_messages                  # e.g. nightly from cron
+    python manage.py purge_messages --dry-run
+    python manage.py purge_messages --batch-size 500 --pause 0.1
+
+Deletes in primary-key batches of --batch-size, one short transaction
+each, without loading instances; files are unlinked on a background
+thread after each batch commits (see chat/utils/retention.py). --pause
+sleeps between batches to leave room for other writers.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.utils import retention
+
+
+class Command(BaseCommand):
+    help = "Delete messages past their conversation's retention policy"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0.0,
+                            help="Seconds to sleep between batches")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Count expired messages without deleting them")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive")
+
+        counts, files = retention.purge_all(
+            batch_size=options['batch_size'], pause=options['pause'], dry_run=options['dry_run'])
+        verb = "would purge" if options['dry_run'] else "purged"
+        for key, count in counts.items():
+            if count:
+                self.stdout.write(f"{key}: {verb} {count} message(s)")
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {sum(counts.values())} message(s) in {len(counts)} conversation(s), "
+            f"{files} file(s) deleted"))
@@ -0,0 +1,181 @@
+# chat/management/commands/rotate_message_keys.py
+"""
+Re-encrypt stored messages with the primary message key.
+
+    python manage.py rotate_message_keys
+    python manage.py rotate_message_keys --rate 2000 --workers 4 --batch-size 1000
+    python manage.py rotate_message_keys --restart
+
+Walks Message in primary-key order, one short keyset query per batch (so
+neither the table nor a long-lived cursor is held), re-encrypts rows that use
+an old format or a non-primary key on a process pool, and writes them back
+with bulk_update in a small transaction per batch. Other writers are never
+blocked for longer than one batch.
+
+Progress is checkpointed to a JSON file after every batch; rerunning the
+command resumes where it stopped as long as the primary key is unchanged.
+"""
+
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+
+from chat.models import Message
+from chat.utils import encryption
+
+logger = logging.getLogger(__name__)
+
+
+def _reencrypt(rows):
+    """
+    Worker: [(pk, token)] -> ([(pk, new_token)], [failed pk])
+
+    Runs in a pool process; the keyring is rebuilt there from settings.
+    """
+    rewritten, failed = [], []
+    for pk, token in rows:
+        try:
+            if encryption.needs_upgrade(token):
+                rewritten.append((pk, encryption.upgrade_token(token)))
+        except Exception:
+            failed.append(pk)
+    return rewritten, failed
+
+
+def _split(rows, parts):
+    size = max(1, -(-len(rows) // parts))
+    return [rows[i:i + size] for i in range(0, len(rows), size)]
+
+
+class Command(BaseCommand):
+    help = "Re-encrypt messages with the primary key from settings.MESSAGE_KEYS"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Rows read, re-encrypted and written per batch")
+        parser.add_argument('--rate', type=float, default=0,
+                            help="Maximum rows scanned per second (0 = unlimited)")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Re-encryption processes (0 = in this process)")
+        parser.add_argument('--checkpoint',
+                            default=str(settings.BASE_DIR / 'logs' / 'rotate_message_keys.json'),
+                            help="Progress file used to resume an interrupted run")
+        parser.add_argument('--restart', action='store_true',
+                            help="Ignore an existing checkpoint and start from the first row")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Count rows that need rewriting without writing them")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError("--batch-size must be positive")
+
+        primary = encryption.keyring.primary_id.hex()
+        state = self._load_checkpoint(options['checkpoint'], primary, options['restart'])
+        max_pk = Message.objects.aggregate(m=Max('pk'))['m'] or 0
+
+        self.stdout.write(
+            f"Rotating to key {primary}: resuming after pk {state['last_pk']} "
+            f"of {max_pk} ({state['scanned']} scanned so far)")
+
+        workers = options['workers']
+        pool = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+        started = time.monotonic()
+        scanned_this_run = 0
+        last_report = 0.0
+
+        try:
+            while True:
+                rows = [
+                    (pk, bytes(token))
+                    for pk, token in Message.objects
+                    .filter(pk__gt=state['last_pk'], encrypted_text__isnull=False)
+                    .order_by('pk')
+                    .values_list('pk', 'encrypted_text')[:batch_size]
+                    .iterator(chunk_size=batch_size)
+                ]
+                if not rows:
+                    break
+
+                rewritten, failed = self._process(pool, workers, rows)
+                if rewritten and not options['dry_run']:
+                    with transaction.atomic():
+                        Message.objects.bulk_update(
+                            [Message(pk=pk, encrypted_text=token) for pk, token in rewritten],
+                            ['encrypted_text'],
+                        )
+                for pk in failed:
+                    logger.warning(f"rotate_message_keys: could not decrypt message {pk}")
+
+                state['last_pk'] = rows[-1][0]
+                state['scanned'] += len(rows)
+                state['rewritten'] += len(rewritten)
+                state['failed'] += len(failed)
+                scanned_this_run += len(rows)
+                if not options['dry_run']:
+                    self._save_checkpoint(options['checkpoint'], state)
+
+                elapsed = time.monotonic() - started
+                if elapsed - last_report >= 2:
+                    last_report = elapsed
+                    self._report(state, max_pk, scanned_this_run, elapsed)
+
+                if options['rate'] > 0:
+                    ahead = scanned_this_run / options['rate'] - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        self._report(state, max_pk, scanned_this_run, time.monotonic() - started)
+        verb = "would rewrite" if options['dry_run'] else "rewrote"
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: scanned {state['scanned']}, {verb} {state['rewritten']}, "
+            f"failed {state['failed']}"))
+
+    def _process(self, pool, workers, rows):
+        if pool is None:
+            return _reencrypt(rows)
+        rewritten, failed = [], []
+        for part_rewritten, part_failed in pool.map(_reencrypt, _split(rows, workers)):
+            rewritten.extend(part_rewritten)
+            failed.extend(part_failed)
+        return rewritten, failed
+
+    def _report(self, state, max_pk, scanned_this_run, elapsed):
+        pct = 100.0 * state['last_pk'] / max_pk if max_pk else 100.0
+        rate = scanned_this_run / elapsed if elapsed > 0 else 0.0
+        self.stdout.write(
+            f"  pk {state['last_pk']}/{max_pk} ({pct:.1f}%)  scanned {state['scanned']}  "
+            f"rewritten {state['rewritten']}  failed {state['failed']}  {rate:.0f} rows/s")
+
+    # ====================== CHECKPOINTS ======================
+
+    def _load_checkpoint(self, path, primary, restart):
+        fresh = {'key_id': primary, 'last_pk': 0, 'scanned': 0, 'rewritten': 0, 'failed': 0}
+        if restart or not os.path.exists(path):
+            return fresh
+        try:
+            with open(path) as fh:
+                state = json.load(fh)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Unreadable checkpoint {path}: {e} (use --restart)")
+        if state.get('key_id') != primary:
+            self.stdout.write(f"Checkpoint is for key {state.get('key_id')}; starting over")
+            return fresh
+        return {**fresh, **state}
+
+    def _save_checkpoint(self, path, state):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as fh:
+            json.dump(state, fh)
+        os.replace(tmp, path)
@@ -0,0 +1,126 @@
+# chat/management/commands/serializerbench.py
+"""
+DRF serializers vs the plain-Python read paths (chat/serializers.py).
+
+    python manage.py serializerbench
+    python manage.py serializerbench --messages 1000 --sidebar 500 --repeat 20
+
+Creates --messages messages (DM and project, some replies) and a sidebar
+of --sidebar items (half DMs, half projects with five members each) in a
+transaction that is rolled back afterwards, then times rendering them
+with MessageSerializer / SidebarItemSerializer and with message_data() /
+sidebar_data(), user cards already cached for both. Each output is
+checked to be identical first. Reports the median over --repeat runs and
+prints JSON.
+"""
+
+import json
+import statistics
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import RequestFactory
+from django.utils import timezone
+
+from chat.models import Message, Project
+from chat.serializers import (
+    MessageSerializer, SidebarItemSerializer, UserSerializer, message_data, sidebar_data,
+)
+from chat.utils.encryption import encrypt_message
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Compare DRF and plain-Python serialization of history pages and the sidebar"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000)
+        parser.add_argument('--sidebar', type=int, default=500)
+        parser.add_argument('--repeat', type=int, default=10)
+
+    def handle(self, *args, **options):
+        if options['messages'] < 1 or options['sidebar'] < 2 or options['repeat'] < 1:
+            raise CommandError("--messages, --sidebar and --repeat must be positive (--sidebar >= 2)")
+        results = {}
+        try:
+            with transaction.atomic():
+                messages, items = self.fixtures(options['messages'], options['sidebar'])
+                request = RequestFactory().get('/chat/api/messages/')
+                cards = UserSerializer.card_map(
+                    [item['user'] for item in items] +
+                    [u for item in items if item['project'] for u in item['project'].members.all()])
+
+                results['messages'] = self.compare(
+                    lambda: MessageSerializer(messages, many=True, context={'request': request}).data,
+                    lambda: message_data(messages, request),
+                    options['repeat'])
+                results['sidebar'] = self.compare(
+                    lambda: SidebarItemSerializer(items, many=True, context={'user_cards': cards}).data,
+                    lambda: sidebar_data(items, cards),
+                    options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+        self.stdout.write(json.dumps({
+            'config': {k: options[k] for k in ('messages', 'sidebar', 'repeat')},
+            'results': results,
+        }, indent=2))
+
+    def compare(self, drf, fast, repeat):
+        if json.dumps(drf()) != json.dumps(fast()):
+            raise CommandError("Fast path output differs from the DRF serializer")
+        timings = {}
+        for name, render in (('drf', drf), ('fast', fast)):
+            runs = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                render()
+                runs.append(time.perf_counter() - start)
+            timings[f'{name}_ms'] = round(statistics.median(runs) * 1000, 2)
+        timings['speedup'] = round(timings['drf_ms'] / timings['fast_ms'], 1) if timings['fast_ms'] else None
+        return timings
+
+    def fixtures(self, n_messages, n_sidebar):
+        run_id = uuid.uuid4().hex[:8]
+        users = [User.objects.create(username=f"serbench_{run_id}_{i}") for i in range(n_sidebar // 2 + 5)]
+        me, other = users[0], users[1]
+        project = Project.objects.create(name=f"serbench_{run_id}", created_by=me)
+        project.members.add(*users[:5])
+
+        token = encrypt_message("the deploy is done can you check staging again")
+        batch = []
+        for i in range(n_messages):
+            if i % 3:
+                batch.append(Message(sender=me if i % 2 else other, receiver=other if i % 2 else me,
+                                     encrypted_text=token, conversation_key=f"dm_{me.id}_{other.id}"))
+            else:
+                batch.append(Message(sender=users[i % 5], project=project, encrypted_text=token,
+                                     conversation_key=f"p_{project.id}"))
+        created = Message.objects.bulk_create(batch)
+        for reply, target in zip(created[10::10], created[::10]):
+            reply.reply_to_id = target.id
+        Message.objects.bulk_update(created[10::10], ['reply_to'])
+        messages = list(Message.objects.filter(id__in=[m.id for m in created])
+                        .select_related('meeting', 'attachment').order_by('timestamp', 'id'))
+
+        now = timezone.now()
+        items = [{'type': 'user', 'user': user, 'project': None, 'last_message': 'hello',
+                  'last_message_timestamp': now, 'unread_count': i % 3}
+                 for i, user in enumerate(users[5:5 + n_sidebar // 2])]
+        projects = []
+        for i in range(n_sidebar - len(items)):
+            p = Project.objects.create(name=f"serbench_{run_id}_{i}", created_by=me)
+            p.members.add(*users[:5])
+            projects.append(p.id)
+        items += [{'type': 'project', 'user': None, 'project': p, 'last_message': 'Project Created',
+                   'last_message_timestamp': p.created_at, 'unread_count': 0}
+                  for p in Project.objects.filter(id__in=projects)
+                  .select_related('created_by').prefetch_related('members')]
+        return messages, items
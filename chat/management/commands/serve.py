@@ -0,0 +1,310 @@
+# chat/management/commands/serve.py
+"""
+Multi-worker launcher for the ASGI application.
+
+    python manage.py serve --workers 4 --bind 0.0.0.0 --port 8000
+
+The master process binds the listening socket once and starts N Daphne
+workers that all accept() on the inherited descriptor (or, with
+--reuse-port, each worker binds its own SO_REUSEPORT socket and the kernel
+balances connections). Dead workers are restarted. POSIX only: on
+Windows the command refuses to start.
+
+Signals (sent to the master):
+    SIGHUP          graceful reload: start a fresh set of workers, then
+                    drain the old ones
+    SIGTERM/SIGINT  drain all workers and exit
+
+Draining a worker stops accepting new connections, closes open WebSockets
+with 1001 (going away) so clients reconnect to a live worker, and exits once
+every connection is gone or --graceful-timeout passes.
+"""
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from daphne.server import Server  # installs the asyncio reactor first
+from daphne.ws_protocol import WebSocketProtocol
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+from twisted.internet import reactor
+
+# Channel layers that only deliver within a single process
+PROCESS_LOCAL_LAYERS = {
+    'channels.layers.InMemoryChannelLayer',
+}
+
+# Caches each worker keeps to itself
+PROCESS_LOCAL_CACHES = {
+    'django.core.cache.backends.locmem.LocMemCache',
+}
+
+
+class Command(BaseCommand):
+    help = "Run the ASGI app on N Daphne workers sharing one listening socket"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--bind', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8000)
+        parser.add_argument('--backlog', type=int, default=2048)
+        parser.add_argument('--reuse-port', action='store_true',
+                            help="Each worker binds its own SO_REUSEPORT socket")
+        parser.add_argument('--graceful-timeout', type=float, default=30.0,
+                            help="Seconds a draining worker waits for connections to close")
+        parser.add_argument('--proxy-headers', action='store_true',
+                            help="Trust X-Forwarded-For / X-Forwarded-Port")
+        parser.add_argument('--application', default=None,
+                            help="Dotted path to the ASGI app (default: settings.ASGI_APPLICATION)")
+        # Internal: set by the master when it starts a worker
+        parser.add_argument('--worker', action='store_true', help="(internal)")
+        parser.add_argument('--worker-fd', type=int, default=None, help="(internal)")
+
+    def handle(self, *args, **options):
+        if options['worker']:
+            return self.run_worker(options)
+
+        if os.name == 'nt':
+            # Workers inherit the listening socket via Popen(pass_fds=...)
+            raise CommandError(
+                "serve needs a POSIX system to share the listening socket with its "
+                "workers; on Windows run a single server with `daphne` instead.")
+        workers = options['workers']
+        if workers < 1:
+            raise CommandError("--workers must be at least 1")
+        if ':' in options['bind']:
+            # Daphne's fd: endpoint adopts sockets as AF_INET only
+            raise CommandError("serve only supports IPv4 bind addresses")
+        if workers > 1:
+            self.check_channel_layer()
+            self.check_user_card_cache()
+
+        Master(self, options).run()
+
+    def check_channel_layer(self):
+        """Refuse to split rooms across workers that cannot see each other"""
+        layers = getattr(settings, 'CHANNEL_LAYERS', {})
+        backend = layers.get('default', {}).get('BACKEND')
+        if not backend:
+            raise CommandError("CHANNEL_LAYERS['default'] is not configured")
+        if backend in PROCESS_LOCAL_LAYERS:
+            raise CommandError(
+                f"{backend} only delivers within one process; with more than one "
+                "worker, users on different workers would not see each other. "
+                "Set REDIS_URL or use a Postgres DATABASE_URL, or run --workers 1."
+            )
+
+    def check_user_card_cache(self):
+        """Warn when user card invalidations cannot reach the other workers"""
+        alias = getattr(settings, 'USER_CARD_CACHE', 'default')
+        backend = getattr(settings, 'CACHES', {}).get(alias, {}).get('BACKEND', '')
+        if backend in PROCESS_LOCAL_CACHES:
+            self.stderr.write(self.style.WARNING(
+                f"The '{alias}' cache ({backend}) is per process: a profile change "
+                "reaches the other workers only when their cached user cards expire "
+                f"(USER_CARD_TTL={getattr(settings, 'USER_CARD_TTL', 300)}s). "
+                "Set REDIS_URL for a shared cache."
+            ))
+
+    # ---------------------------
+    # Worker side
+    # ---------------------------
+
+    def run_worker(self, options):
+        if options['worker_fd'] is not None:
+            fileno = options['worker_fd']
+        else:
+            sock = bind_socket(options['bind'], options['port'], options['backlog'], reuse_port=True)
+            fileno = sock.fileno()
+        endpoint = f"fd:fileno={fileno}"
+
+        application = import_string(options['application'] or settings.ASGI_APPLICATION)
+        server = DrainingServer(
+            application=application,
+            endpoints=[endpoint],
+            signal_handlers=False,
+            graceful_timeout=options['graceful_timeout'],
+            proxy_forwarded_address_header='X-Forwarded-For' if options['proxy_headers'] else None,
+            proxy_forwarded_port_header='X-Forwarded-Port' if options['proxy_headers'] else None,
+            proxy_forwarded_proto_header='X-Forwarded-Proto' if options['proxy_headers'] else None,
+        )
+
+        # The master owns Ctrl-C; workers only react to SIGTERM from it
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda *_: reactor.callFromThread(server.drain))
+        server.run()
+
+
+def bind_socket(host, port, backlog, reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise CommandError("SO_REUSEPORT is not supported on this platform")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    sock.set_inheritable(True)
+    return sock
+
+
+class DrainingServer(Server):
+    """Daphne server that can stop accepting and wait for sockets to close"""
+
+    def __init__(self, *args, graceful_timeout=30.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.graceful_timeout = graceful_timeout
+        self.ports = []
+        self.draining = False
+
+    def listen_success(self, port):
+        self.ports.append(port)
+        super().listen_success(port)
+
+    def drain(self):
+        if self.draining:
+            return
+        self.draining = True
+        for port in self.ports:
+            port.stopListening()
+
+        for protocol in list(self.connections):
+            if isinstance(protocol, WebSocketProtocol):
+                try:
+                    protocol.serverClose(code=1001)
+                except Exception:
+                    pass
+
+        self._wait_for_drain(time.monotonic() + self.graceful_timeout)
+
+    def _wait_for_drain(self, deadline):
+        open_connections = [
+            p for p, details in self.connections.items() if 'disconnected' not in details
+        ]
+        if not open_connections or time.monotonic() >= deadline:
+            self.stop()
+            return
+        reactor.callLater(0.25, self._wait_for_drain, deadline)
+
+
+# ---------------------------
+# Master side
+# ---------------------------
+
+class Master:
+    """Starts, supervises and reloads worker processes"""
+
+    RESTART_BACKOFF = 1.0
+
+    def __init__(self, command, options):
+        self.command = command
+        self.options = options
+        self.sock = None
+        self.workers = {}      # pid -> (Popen, started_at)
+        self.retiring = {}     # pid -> Popen
+        self.reload_requested = False
+        self.stopping = False
+
+    def log(self, msg):
+        self.command.stdout.write(f"[serve {os.getpid()}] {msg}")
+
+    def run(self):
+        opts = self.options
+        if not opts['reuse_port']:
+            self.sock = bind_socket(opts['bind'], opts['port'], opts['backlog'])
+        self.log(f"listening on {opts['bind']}:{opts['port']} with {opts['workers']} worker(s)")
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._on_reload)
+
+        for _ in range(opts['workers']):
+            self.spawn()
+
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.reap()
+            time.sleep(0.2)
+
+        self.shutdown()
+
+    def _on_stop(self, *_):
+        self.stopping = True
+
+    def _on_reload(self, *_):
+        self.reload_requested = True
+
+    def worker_argv(self):
+        argv = [sys.executable, sys.argv[0], 'serve', '--worker',
+                '--bind', self.options['bind'], '--port', str(self.options['port']),
+                '--backlog', str(self.options['backlog']),
+                '--graceful-timeout', str(self.options['graceful_timeout'])]
+        if self.options['proxy_headers']:
+            argv.append('--proxy-headers')
+        if self.options['application']:
+            argv += ['--application', self.options['application']]
+        if self.sock is not None:
+            argv += ['--worker-fd', str(self.sock.fileno())]
+        else:
+            argv.append('--reuse-port')
+        return argv
+
+    def spawn(self):
+        pass_fds = (self.sock.fileno(),) if self.sock is not None else ()
+        proc = subprocess.Popen(self.worker_argv(), pass_fds=pass_fds)
+        self.workers[proc.pid] = (proc, time.monotonic())
+        self.log(f"started worker {proc.pid}")
+
+    def reap(self):
+        for pid, (proc, started) in list(self.workers.items()):
+            code = proc.poll()
+            if code is None:
+                continue
+            del self.workers[pid]
+            self.log(f"worker {pid} exited with {code}; restarting")
+            if time.monotonic() - started < self.RESTART_BACKOFF:
+                # Crashing on boot; don't spin
+                time.sleep(self.RESTART_BACKOFF)
+            if not self.stopping:
+                self.spawn()
+
+        for pid, proc in list(self.retiring.items()):
+            if proc.poll() is not None:
+                del self.retiring[pid]
+                self.log(f"retired worker {pid} drained")
+
+    def reload(self):
+        old = self.workers
+        self.workers = {}
+        self.log("reloading: starting new workers")
+        for _ in range(self.options['workers']):
+            self.spawn()
+        for pid, (proc, _) in old.items():
+            self.retiring[pid] = proc
+            proc.send_signal(signal.SIGTERM)
+
+    def shutdown(self):
+        self.log("draining workers")
+        procs = [p for p, _ in self.workers.values()] + list(self.retiring.values())
+        for proc in procs:
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+
+        deadline = time.monotonic() + self.options['graceful_timeout'] + 5
+        for proc in procs:
+            try:
+                proc.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if self.sock is not None:
+            self.sock.close()
+        self.log("stopped")
@@ -0,0 +1,70 @@
+# chat/management/commands/train_message_dict.py
+"""
+Train a zlib preset dictionary for message compression from real traffic.
+
+    python manage.py train_message_dict --output /var/lib/chat/msg-dict-1.bin
+    python manage.py train_message_dict --samples 20000 --size 16384 --output dict.bin
+
+Samples the most recent messages long enough to be compressed, decrypts
+them, and writes a dictionary for settings.MESSAGE_COMPRESSION_DICTS. Put
+the new file first in that list and keep older ones after it for as long
+as stored messages use them.
+"""
+
+import zlib
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import Message
+from chat.utils.encryption import Compressor, decrypt_message
+
+
+class Command(BaseCommand):
+    help = "Train a zlib dictionary for message bodies from recent messages"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', required=True)
+        parser.add_argument('--samples', type=int, default=5000,
+                            help="Number of recent messages to sample")
+        parser.add_argument('--size', type=int, default=32 * 1024,
+                            help="Dictionary size in bytes (zlib uses at most 32 KiB)")
+        parser.add_argument('--min-length', type=int, default=None,
+                            help="Ignore shorter bodies (default: half the compression threshold)")
+
+    def handle(self, *args, **options):
+        min_length = options['min_length']
+        if min_length is None:
+            min_length = max(getattr(settings, 'MESSAGE_COMPRESSION_THRESHOLD', 0) // 2, 64)
+
+        samples = []
+        tokens = (
+            Message.objects.filter(encrypted_text__isnull=False)
+            .order_by('-pk')
+            .values_list('encrypted_text', flat=True)
+            .iterator(chunk_size=1000)
+        )
+        for token in tokens:
+            try:
+                body = decrypt_message(bytes(token)).encode()
+            except Exception:
+                continue
+            if len(body) >= min_length:
+                samples.append(body)
+                if len(samples) >= options['samples']:
+                    break
+
+        if not samples:
+            raise CommandError(f"No messages of at least {min_length} bytes to learn from")
+
+        zdict = Compressor.train(samples, size=min(options['size'], 32 * 1024))
+        with open(options['output'], 'wb') as fh:
+            fh.write(zdict)
+
+        plain = sum(len(s) for s in samples)
+        without = sum(len(zlib.compress(s)) for s in samples)
+        with_dict = sum(len(Compressor(1, dictionaries=[zdict]).compress(s) or s) for s in samples)
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {len(zdict)} byte dictionary (adler32 {zlib.adler32(zdict):08x}) "
+            f"from {len(samples)} messages: {plain} bytes -> {without} with zlib, "
+            f"{with_dict} with the dictionary"))
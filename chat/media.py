@@ -0,0 +1,255 @@
+# chat/media.py
+"""
+Authorized media serving for MEDIA_URL (attachments, thumbnails, avatars).
+
+    attachments/…/<sha256>.<ext>     members of a conversation with a message using it
+    thumbnails/…/<sha256>_<size>.webp  same as its attachment
+    messages/…                       members of the message's conversation (legacy files)
+    avatars/…                        any signed-in user
+
+Messages moved to the cold archive still count (MessageArchiveFile).
+
+Anything else is 404. Staff can read everything.
+
+The view is async: files are read in chunks on worker threads and streamed,
+so a slow download does not hold a request thread. It answers conditional
+requests (ETag / Last-Modified -> 304) and single byte ranges (206/416) for
+video seeking and PDF viewers. Attachments and normalized avatars are
+content-addressed, so they get a strong ETag and are cacheable forever
+(privately).
+
+Behind nginx or Apache, set MEDIA_X_ACCEL_REDIRECT_PREFIX (internal nginx
+location mapped to MEDIA_ROOT) or MEDIA_X_SENDFILE = True: the view then
+only authorizes and the proxy sends the bytes, ranges and all.
+"""
+
+import mimetypes
+import os
+import posixpath
+import re
+import stat
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import (
+    Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotModified,
+    StreamingHttpResponse,
+)
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+from .utils import avatars
+
+CHUNK_SIZE = 256 * 1024
+
+# Served inline; everything else is sent as a download so that uploaded
+# HTML/SVG/etc. never renders on our origin
+INLINE_TYPES = ('image/', 'video/', 'audio/', 'application/pdf', 'text/plain')
+INLINE_EXCLUDED = ('image/svg+xml',)
+
+_ATTACHMENT = re.compile(r'^attachments/[0-9a-f]{2}/[0-9a-f]{2}/(?P<sha>[0-9a-f]{64})(\.\w+)?$')
+_THUMBNAIL = re.compile(r'^thumbnails/[0-9a-f]{2}/[0-9a-f]{2}/(?P<sha>[0-9a-f]{64})_\d+\.webp$')
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+# ====================== AUTHORIZATION ======================
+
+def _canonical(path):
+    """
+    True for a plain relative path: no empty, '.' or '..' segment and no
+    backslash. Access rules match on prefixes, and storage.path() would
+    resolve 'avatars/../messages/…' to a file the rules never checked.
+    """
+    return (
+        bool(path) and '\\' not in path and posixpath.normpath(path) == path
+        and all(segment not in ('', '.', '..') for segment in path.split('/'))
+    )
+
+
+def _authorize(user, path):
+    """
+    (status, sha256): status is None if `user` may read `path`, else the
+    HTTP status to answer (403/404); sha256 is set for attachment files.
+    """
+    from .models import Message
+
+    if not _canonical(path):
+        return 404, None
+    if not user.is_authenticated:
+        return 403, None
+    match = _ATTACHMENT.match(path) or _THUMBNAIL.match(path)
+    if match:
+        sha = match.group('sha')
+        if user.is_staff:
+            return None, sha
+        visible = (
+            Message.objects.visible_to(user).filter(attachment__sha256=sha).exists()
+            or _archived(user, name__startswith=f"attachments/{sha[:2]}/{sha[2:4]}/{sha}")
+        )
+        return (None, sha) if visible else (404, None)
+    if path.startswith('messages/'):
+        if (user.is_staff or Message.objects.visible_to(user).filter(file=path).exists()
+                or _archived(user, name=path)):
+            return None, None
+        return 404, None
+    if path.startswith('avatars/'):
+        return None, None
+    return 404, None
+
+
+def _archived(user, **lookup):
+    """A file referenced by archived messages of the user's conversations"""
+    from .models import MessageArchive, MessageArchiveFile
+    return MessageArchiveFile.objects.filter(
+        archive__in=MessageArchive.objects.visible_to(user), **lookup).exists()
+
+
+# ====================== CONDITIONAL / RANGE ======================
+
+def _etag_matches(header, etag):
+    if header.strip() == '*':
+        return True
+    candidates = [c.strip() for c in header.split(',')]
+    # Weak comparison (RFC 9110 13.1.2)
+    bare = etag[2:] if etag.startswith('W/') else etag
+    return any((c[2:] if c.startswith('W/') else c) == bare for c in candidates)
+
+
+def _not_modified(request, etag, mtime):
+    inm = request.META.get('HTTP_IF_NONE_MATCH')
+    if inm is not None:
+        return _etag_matches(inm, etag)
+    ims = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return ims is not None and int(mtime) <= ims
+
+
+def _byte_range(request, etag, mtime, size):
+    """
+    (start, end) inclusive for a satisfiable single range, None to send the
+    whole file, or False when the range cannot be satisfied.
+    """
+    header = request.META.get('HTTP_RANGE')
+    if not header:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range:
+        date = parse_http_date_safe(if_range)
+        if date is not None:
+            fresh = int(mtime) <= date
+        else:
+            # If-Range needs a strong validator
+            fresh = not etag.startswith('W/') and if_range.strip() == etag
+        if not fresh:
+            return None
+    match = _RANGE.match(header.strip())
+    if not match:
+        return None  # multiple or malformed ranges: serve the full body
+    first, last = match.groups()
+    if first == '' and last == '':
+        return None
+    if first == '':
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        return False
+    return start, end
+
+
+async def _file_chunks(path, start, length):
+    fh = await sync_to_async(open, thread_sensitive=False)(path, 'rb')
+    try:
+        if start:
+            await sync_to_async(fh.seek, thread_sensitive=False)(start)
+        remaining = length
+        while remaining > 0:
+            chunk = await sync_to_async(fh.read, thread_sensitive=False)(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        fh.close()
+
+
+# ====================== VIEW ======================
+
+async def media_view(request, path):
+    """GET/HEAD MEDIA_URL<path> with access checks, conditional requests and ranges"""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponse(status=405, headers={'Allow': 'GET, HEAD'})
+
+    if not _canonical(path):
+        raise Http404("No such file")
+    denied, sha = await sync_to_async(_authorize)(request.user, path)
+    if denied == 403:
+        return HttpResponseForbidden("media: authentication required")
+    if denied:
+        raise Http404("No such file")
+
+    try:
+        full_path = default_storage.path(path)
+        st = await sync_to_async(os.stat, thread_sensitive=False)(full_path)
+    except (SuspiciousFileOperation, NotImplementedError, OSError):
+        raise Http404("No such file")
+    if not stat.S_ISREG(st.st_mode):
+        raise Http404("No such file")
+
+    size, mtime = st.st_size, st.st_mtime
+    if sha and path.startswith('attachments/'):
+        etag = quote_etag(sha)
+        cache_control = 'private, max-age=31536000, immutable'
+    elif avatars.is_immutable(path):
+        etag = quote_etag(os.path.basename(path))
+        cache_control = 'private, max-age=31536000, immutable'
+    else:
+        etag = f'W/"{st.st_mtime_ns:x}-{size:x}"'
+        cache_control = 'private, no-cache'
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(mtime),
+        'Cache-Control': cache_control,
+        'Accept-Ranges': 'bytes',
+        'X-Content-Type-Options': 'nosniff',
+    }
+    if not content_type.startswith(INLINE_TYPES) or content_type in INLINE_EXCLUDED:
+        headers['Content-Disposition'] = 'attachment'
+
+    if _not_modified(request, etag, mtime):
+        response = HttpResponseNotModified()
+        for name in ('ETag', 'Last-Modified', 'Cache-Control'):
+            response[name] = headers[name]
+        return response
+
+    accel_prefix = getattr(settings, 'MEDIA_X_ACCEL_REDIRECT_PREFIX', None)
+    if accel_prefix or getattr(settings, 'MEDIA_X_SENDFILE', False):
+        response = HttpResponse(content_type=content_type, headers=headers)
+        if accel_prefix:
+            response['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + path
+        else:
+            response['X-Sendfile'] = full_path
+        return response
+
+    byte_range = _byte_range(request, etag, mtime, size)
+    if byte_range is False:
+        headers['Content-Range'] = f'bytes */{size}'
+        return HttpResponse(status=416, headers=headers)
+    if byte_range:
+        start, end = byte_range
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        status = 206
+    else:
+        start, end, status = 0, size - 1, 200
+    length = end - start + 1
+    headers['Content-Length'] = str(length)
+
+    if request.method == 'HEAD':
+        return HttpResponse(status=status, content_type=content_type, headers=headers)
+    return StreamingHttpResponse(
+        _file_chunks(full_path, start, length),
+        status=status, content_type=content_type, headers=headers)
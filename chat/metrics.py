@@ -0,0 +1,365 @@
+# chat/metrics.py
+"""
+In-process latency histograms exposed in Prometheus text format.
+
+Deliberately dependency-free and cheap: observing a value is a bisect over
+a short bucket list plus two additions (well under a microsecond), with no
+locking. Concurrent observers can very occasionally lose an increment,
+which is an acceptable trade for staying off the hot path's critical section.
+
+Each worker process keeps its own numbers; when running several workers
+behind 'manage.py serve', the "pid" label tells scrapes apart.
+"""
+
+import contextvars
+import hmac
+import os
+import time
+from bisect import bisect_left
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+perf_counter = time.perf_counter
+
+# Seconds; tuned for sub-millisecond hot paths up to multi-second requests
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+REGISTRY = []
+PID = str(os.getpid())
+
+
+class _Series:
+    """One labelled histogram series"""
+
+    __slots__ = ('upper', 'counts', 'sum')
+
+    def __init__(self, upper):
+        self.upper = upper
+        self.counts = [0] * (len(upper) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.upper, value)] += 1
+        self.sum += value
+
+
+class Histogram:
+    """Prometheus-style histogram with optional labels"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        """Return the series for these label values; cache the result on hot paths"""
+        series = self._series.get(values)
+        if series is None:
+            series = self._series[values] = _Series(self.buckets)
+        return series
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for values, series in sorted(self._series.items()):
+            pairs = [f'{k}="{v}"' for k, v in zip(self.labelnames, values)]
+            pairs.append(f'pid="{PID}"')
+            base = ','.join(pairs)
+            cumulative = 0
+            for bound, count in zip(self.buckets, series.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{base},le="{bound}"}} {cumulative}')
+            cumulative += series.counts[-1]
+            lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{base}}} {series.sum}')
+            lines.append(f'{self.name}_count{{{base}}} {cumulative}')
+        return '\n'.join(lines)
+
+
+class Gauge:
+    """
+    Values read from a callback at scrape time, so keeping them costs
+    nothing in between. `callback` returns {label values tuple: number};
+    kind='counter' for monotonically increasing totals.
+    """
+
+    def __init__(self, name, documentation, labelnames, callback, kind='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self.kind = kind
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for values, value in sorted(self.callback().items()):
+            pairs = [f'{k}="{v}"' for k, v in zip(self.labelnames, values)]
+            pairs.append(f'pid="{PID}"')
+            lines.append(f'{self.name}{{{",".join(pairs)}}} {value}')
+        return '\n'.join(lines)
+
+
+def render_text():
+    return '\n'.join(h.render() for h in REGISTRY) + '\n'
+
+
+# ====================== WEBSOCKET HOT PATH ======================
+
+WS_DECODE = Histogram(
+    'chat_ws_decode_seconds', "Frame receive to parsed JSON", ['consumer'])
+WS_DB_SAVE = Histogram(
+    'chat_ws_db_save_seconds', "Persisting a message, including the DB thread hop", ['consumer'])
+WS_GROUP_SEND = Histogram(
+    'chat_ws_group_send_seconds', "channel_layer.group_send call", ['consumer'])
+WS_SEND = Histogram(
+    'chat_ws_send_seconds', "Writing one frame to the client", ['consumer'])
+WS_GROUP_SIZE = Histogram(
+    'chat_ws_group_size', "Local members of a group at group_send time",
+    ['consumer'], buckets=SIZE_BUCKETS)
+WS_DB_QUEUE_WAIT = Histogram(
+    'chat_ws_db_queue_seconds', "Wait for the shared database_sync_to_async thread", ['consumer'])
+WS_DB_QUEUE_DEPTH = Histogram(
+    'chat_ws_db_queue_depth', "Calls already queued or running on the DB thread when one is submitted",
+    ['consumer'], buckets=SIZE_BUCKETS)
+ENCRYPT = Histogram(
+    'chat_encrypt_seconds', "Message body encryption")
+
+# database_sync_to_async calls from consumers submitted and not finished
+db_thread_pending = 0
+
+# Channels connected to each group from this process
+local_group_members = {}
+
+
+def group_joined(group):
+    local_group_members[group] = local_group_members.get(group, 0) + 1
+
+
+def group_left(group):
+    remaining = local_group_members.get(group, 0) - 1
+    if remaining > 0:
+        local_group_members[group] = remaining
+    else:
+        local_group_members.pop(group, None)
+
+
+# ====================== FILE I/O EXECUTOR ======================
+
+FILE_IO_WAIT = Histogram(
+    'chat_file_io_wait_seconds', "Queueing before a file I/O job starts", ['op'])
+FILE_IO = Histogram(
+    'chat_file_io_seconds', "File decode/hash/storage write time", ['op'])
+
+
+# ====================== DB CONNECTION POOL ======================
+
+DB_POOL_WAIT = Histogram(
+    'chat_db_pool_wait_seconds', "Waiting to check a connection out of the pool", ['alias'])
+DB_POOL_IN_USE = Histogram(
+    'chat_db_pool_in_use', "Connections checked out (including this one) at checkout",
+    ['alias'], buckets=SIZE_BUCKETS)
+
+
+def _pool_stats(field):
+    def collect():
+        from chat.dbpool import pools
+        totals = {}
+        for pool in list(pools.values()):
+            for key, value in pool.stats(field).items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+    return collect
+
+
+DB_POOL_CONNECTIONS = Gauge(
+    'chat_db_pool_connections', "Pooled connections by state", ['alias', 'state'],
+    _pool_stats('connections'))
+DB_POOL_EVENTS = Gauge(
+    'chat_db_pool_events_total', "Pool events (opened, recycled, timeout)", ['alias', 'event'],
+    _pool_stats('events'), kind='counter')
+
+
+# ====================== SQLITE WRITER ======================
+
+SQLITE_WRITE_WAIT = Histogram(
+    'chat_sqlite_write_wait_seconds', "Write job queued until its batch starts")
+SQLITE_WRITE_BATCH = Histogram(
+    'chat_sqlite_write_batch_size', "Write jobs committed in one transaction", buckets=SIZE_BUCKETS)
+SQLITE_WRITE_COMMIT = Histogram(
+    'chat_sqlite_write_commit_seconds', "Running and committing one batch")
+
+
+# ====================== ATTACHMENTS ======================
+
+def _upload_counts():
+    from chat.utils.uploads import counts
+    return {(result,): n for result, n in counts.items()}
+
+
+ATTACHMENT_UPLOADS = Gauge(
+    'chat_attachment_uploads_total', "Attachment uploads by result (stored, deduplicated)", ['result'],
+    _upload_counts, kind='counter')
+
+
+# ====================== USER CARDS ======================
+
+def _user_card_counts():
+    from chat.utils.user_cards import counts
+    return {(result,): n for result, n in counts.items()}
+
+
+USER_CARD_LOOKUPS = Gauge(
+    'chat_user_card_lookups_total', "User card cache lookups by result (hit, miss)", ['result'],
+    _user_card_counts, kind='counter')
+
+
+# ====================== REST ======================
+
+HTTP_HANDLER = Histogram(
+    'chat_http_handler_seconds', "REST handler wall time", ['view'])
+HTTP_QUERY = Histogram(
+    'chat_http_query_seconds', "Time spent in SQL per REST request", ['view'])
+HTTP_SERIALIZE = Histogram(
+    'chat_http_serialize_seconds', "Serializer time per REST request, excluding SQL", ['view'])
+
+# {'query': seconds, 'serialize': seconds} for the request being handled
+_request_timings = contextvars.ContextVar('chat_request_timings', default=None)
+
+
+class _QueryTimer:
+    """connection.execute_wrapper hook that accumulates SQL time"""
+
+    def __init__(self, timings):
+        self.timings = timings
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.timings['query'] += perf_counter() - start
+
+
+def serialized(serializer):
+    """
+    Evaluate serializer.data, charging the time (minus any SQL it triggers)
+    to the current request's serialization histogram.
+    """
+    return serialized_with(lambda: serializer.data)
+
+
+def serialized_with(build, *args, **kwargs):
+    """serialized() for plain-Python serializers: build(*args, **kwargs), timed the same way"""
+    timings = _request_timings.get()
+    if timings is None:
+        return build(*args, **kwargs)
+    start, query_before = perf_counter(), timings['query']
+    data = build(*args, **kwargs)
+    timings['serialize'] += (perf_counter() - start) - (timings['query'] - query_before)
+    return data
+
+
+def _time_queries(stack, timings):
+    """Wrap this thread's connection to every database, replicas included"""
+    timer = _QueryTimer(timings)
+    for alias in connections:
+        stack.enter_context(connections[alias].execute_wrapper(timer))
+    return stack
+
+
+class MetricsMiddleware:
+    """Times REST API requests, split into SQL and serialization"""
+
+    prefix = '/chat/api/'
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not request.path.startswith(self.prefix):
+            return self.get_response(request)
+
+        timings = {'query': 0.0, 'serialize': 0.0}
+        token = _request_timings.set(timings)
+        start = perf_counter()
+        try:
+            with _time_queries(ExitStack(), timings):
+                response = self.get_response(request)
+        finally:
+            _request_timings.reset(token)
+        self._observe(request, start, timings)
+        return response
+
+    async def __acall__(self, request):
+        if not request.path.startswith(self.prefix):
+            return await self.get_response(request)
+
+        timings = {'query': 0.0, 'serialize': 0.0}
+        token = _request_timings.set(timings)
+        start = perf_counter()
+        try:
+            # Sync views and the async ORM run their queries on the request's
+            # thread-sensitive executor; wrap the connections of that thread
+            stack = await sync_to_async(_time_queries)(ExitStack(), timings)
+            try:
+                response = await self.get_response(request)
+            finally:
+                await sync_to_async(stack.close)()
+        finally:
+            _request_timings.reset(token)
+        self._observe(request, start, timings)
+        return response
+
+    def _observe(self, request, start, timings):
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match else 'unresolved'
+        HTTP_HANDLER.labels(view).observe(perf_counter() - start)
+        HTTP_QUERY.labels(view).observe(timings['query'])
+        HTTP_SERIALIZE.labels(view).observe(timings['serialize'])
+
+
+# ====================== ENDPOINT ======================
+
+def metrics_view(request):
+    """
+    GET /metrics in Prometheus text format.
+
+    Allowed for staff sessions, or with "Authorization: Bearer <METRICS_TOKEN>"
+    so a scraper does not need a login.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    bearer_ok = bool(token) and header.startswith('Bearer ') and \
+        hmac.compare_digest(header[len('Bearer '):], token)
+    user = getattr(request, 'user', None)
+    staff_ok = bool(user and user.is_authenticated and user.is_staff)
+    if not (bearer_ok or staff_ok):
+        return HttpResponseForbidden("metrics: authentication required")
+
+    return HttpResponse(render_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 06:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_meeting_ended'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='encrypted_text',
+            field=models.BinaryField(blank=True, help_text='Encrypted message content (versioned envelope, see utils/encryption.py)', null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-19 06:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_encrypted_text_envelope'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=32)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='chat.message')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='messagesearchtoken',
+            constraint=models.UniqueConstraint(fields=('digest', 'message'), name='chat_searchtoken_digest_message'),
+        ),
+    ]
@@ -0,0 +1,116 @@
+# Generated by Django 4.2.30 on 2026-10-19 06:42
+
+import hashlib
+import json
+import uuid
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+MARKERS = (
+    ('[MEETING_INVITE]', 'meeting_invite'),
+    ('[MEETING_ENDED]', 'meeting_ended'),
+    ('[PROJECT_MEETING_INVITE]', 'meeting_invite'),
+    ('[PROJECT_MEETING_ENDED]', 'meeting_ended'),
+)
+BATCH_SIZE = 1000
+
+
+def _decrypter():
+    """
+    Frozen copy of chat.utils.encryption's decoding as of this migration
+    (v2 keyed AES-GCM, v1 AES-GCM, legacy Fernet), so later changes to that
+    module do not change what this migration does.
+    """
+    from cryptography.fernet import Fernet, MultiFernet
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    secrets = [s.encode() if isinstance(s, str) else s for s in settings.MESSAGE_KEYS]
+    fernet = MultiFernet([Fernet(s) for s in secrets])
+    aeads = {}
+    for secret in secrets:
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                   info=b'teams-chat message v1 aes-256-gcm').derive(secret)
+        aeads.setdefault(hashlib.sha256(b'teams-chat key id' + key).digest()[:4], AESGCM(key))
+
+    def decrypt(token):
+        if token[:1] == b'\x02':
+            return aeads[token[1:5]].decrypt(token[5:17], token[17:], None).decode()
+        if token[:1] == b'\x01':
+            for aead in aeads.values():
+                try:
+                    return aead.decrypt(token[1:13], token[13:], None).decode()
+                except Exception:
+                    continue
+            raise ValueError("no key decrypts this message")
+        return fernet.decrypt(token).decode()
+    return decrypt
+
+
+def classify_existing(apps, schema_editor):
+    """Derive kind/meeting from the encrypted text markers of existing rows"""
+    decrypt_message = _decrypter()
+
+    Message = apps.get_model('chat', 'Message')
+    Meeting = apps.get_model('chat', 'Meeting')
+
+    Message.objects.exclude(file='').exclude(file__isnull=True).update(kind='file')
+
+    last_pk = 0
+    while True:
+        rows = list(
+            Message.objects.filter(pk__gt=last_pk, encrypted_text__isnull=False)
+            .order_by('pk').values_list('pk', 'encrypted_text')[:BATCH_SIZE]
+        )
+        if not rows:
+            break
+        last_pk = rows[-1][0]
+
+        updates = {}
+        for pk, token in rows:
+            try:
+                text = decrypt_message(bytes(token))
+            except Exception:
+                continue
+            for marker, kind in MARKERS:
+                if text.startswith(marker):
+                    try:
+                        meeting_id = uuid.UUID(str(json.loads(text[len(marker):])['id']))
+                    except (ValueError, TypeError, KeyError):
+                        meeting_id = None
+                    updates[pk] = (kind, meeting_id)
+                    break
+        if not updates:
+            continue
+
+        known = set(Meeting.objects.filter(
+            id__in={m for _, m in updates.values() if m}).values_list('id', flat=True))
+        Message.objects.bulk_update(
+            [Message(pk=pk, kind=kind, meeting_id=m if m in known else None)
+             for pk, (kind, m) in updates.items()],
+            ['kind', 'meeting'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_message_search_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='kind',
+            field=models.CharField(choices=[('text', 'Text'), ('file', 'File'), ('meeting_invite', 'Meeting invite'), ('meeting_ended', 'Meeting ended'), ('system', 'System')], db_index=True, default='text', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='meeting',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='messages', to='chat.meeting'),
+        ),
+        migrations.RunPython(classify_existing, migrations.RunPython.noop),
+    ]
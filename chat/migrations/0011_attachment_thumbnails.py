@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-19 06:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_attachment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='thumbnails',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-19 06:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_attachment_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='file_name',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='attachment',
+            name='content_type',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['project', 'kind', 'id'], name='chat_messag_project_2538f0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'receiver', 'kind', 'id'], name='chat_messag_sender__325cf8_idx'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.30 on 2026-10-19 07:04
+
+from django.db import migrations, models, transaction
+from django.db.models.functions import Cast, Concat, Greatest, Least
+
+BATCH_SIZE = 5000
+
+
+def backfill_conversation_keys(apps, schema_editor):
+    """dm_<low>_<high> / p_<project id> for existing rows, one pk range per transaction"""
+    Message = apps.get_model('chat', 'Message')
+    db = schema_editor.connection.alias
+    text = models.CharField()
+    project_key = Concat(models.Value('p_'), Cast('project_id', text), output_field=text)
+    dm_key = Concat(
+        models.Value('dm_'), Cast(Least('sender_id', 'receiver_id'), text),
+        models.Value('_'), Cast(Greatest('sender_id', 'receiver_id'), text),
+        output_field=text)
+
+    messages = Message.objects.using(db).filter(conversation_key='')
+    top = messages.aggregate(top=models.Max('pk'))['top'] or 0
+    for start in range(0, top, BATCH_SIZE):
+        batch = messages.filter(pk__gt=start, pk__lte=start + BATCH_SIZE)
+        with transaction.atomic(using=db):
+            batch.filter(project__isnull=False).update(conversation_key=project_key)
+            batch.filter(project__isnull=True, receiver__isnull=False).update(conversation_key=dm_key)
+
+
+class Migration(migrations.Migration):
+    # Each backfill batch commits on its own instead of one long transaction
+    atomic = False
+
+    dependencies = [
+        ('chat', '0012_attachment_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='conversation_key',
+            field=models.CharField(blank=True, default='', editable=False, max_length=48),
+        ),
+        migrations.RunPython(backfill_conversation_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation_key', 'timestamp', 'id'], name='chat_messag_convers_0bcadc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation_key', 'kind', 'id'], name='chat_messag_convers_42818a_idx'),
+        ),
+        # Superseded by the conversation_key file index
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chat_messag_project_2538f0_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chat_messag_sender__325cf8_idx',
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.30 on 2026-10-19 07:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_message_conversation_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('conversation_key', models.CharField(max_length=48)),
+                ('month', models.DateField()),
+                ('path', models.CharField(max_length=255)),
+                ('message_count', models.PositiveIntegerField()),
+                ('first_id', models.BigIntegerField()),
+                ('last_id', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='reply_to',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='replies', to='chat.message'),
+        ),
+        migrations.AlterField(
+            model_name='messagesearchtoken',
+            name='message',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='chat.message'),
+        ),
+        migrations.CreateModel(
+            name='MessageArchiveFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(db_index=True, max_length=255)),
+                ('archive', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='files', to='chat.messagearchive')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='messagearchive',
+            index=models.Index(fields=['conversation_key', 'last_id'], name='chat_messag_convers_6b4835_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='messagearchive',
+            constraint=models.UniqueConstraint(fields=('conversation_key', 'month'), name='chat_archive_conversation_month'),
+        ),
+        migrations.AddConstraint(
+            model_name='messagearchivefile',
+            constraint=models.UniqueConstraint(fields=('archive', 'name'), name='chat_archivefile_archive_name'),
+        ),
+    ]
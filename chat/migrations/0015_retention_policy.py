@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-19 07:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0014_message_partitions_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetentionPolicy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('conversation_key', models.CharField(help_text='dm_<low id>_<high id> or p_<project id>', max_length=48, unique=True)),
+                ('keep_days', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_purged_at', models.DateTimeField(blank=True, null=True)),
+                ('purged_count', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Retention policies',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 07:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_retention_policy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='thumbnails_failed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
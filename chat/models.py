@@ -1,14 +1,31 @@
 # chat/models.py
+import json
 import os
 from datetime import datetime
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
-from django.db.models.signals import pre_delete, post_save
+from django.db.models.signals import m2m_changed, pre_delete, post_save
 from django.dispatch import receiver
 from django.conf import settings
 from django.utils import timezone
 import uuid
 
+from .routers import pin_to_primary
+from .utils import user_cards
+
+
+def blob_path(sha, filename):
+    """Content-addressed path: attachments/ab/cd/<sha256>[.ext]"""
+    ext = os.path.splitext(filename)[1].lower()
+    if not ext[1:].isalnum() or len(ext) > 10:
+        ext = ''
+    return os.path.join('attachments', sha[:2], sha[2:4], f"{sha}{ext}")
+
+
+def attachment_blob_path(instance, filename):
+    return blob_path(instance.sha256, filename)
+
 
 def message_file_path(instance, filename):
     """Generate file path for uploaded files"""
@@ -37,14 +54,63 @@ class Project(models.Model):
         return self.name
 
 
+def dm_key(a, b):
+    """Conversation key of a DM (same as the consumers' DM group name)"""
+    low, high = sorted((int(a), int(b)))
+    return f"dm_{low}_{high}"
+
+
+def project_key(project_id):
+    return f"p_{int(project_id)}"
+
+
+class MessageQuerySet(models.QuerySet):
+
+    def in_conversation(self, key):
+        """One conversation (dm_key / project_key), a single index range"""
+        return self.filter(conversation_key=key)
+
+    def visible_to(self, user):
+        """Messages in DMs the user takes part in or projects they belong to"""
+        return self.filter(
+            models.Q(sender=user) | models.Q(receiver=user) |
+            models.Q(project__in=Project.objects.filter(members=user).values('id'))
+        )
+
+
 class Message(models.Model):
     """Message model for both DM and project chats
 
     Messages are stored encrypted (encrypted_text BinaryField).
     Access `message.text` to get decrypted text; setting `message.text = '...'`
     will encrypt automatically before save.
+
+    `kind` and `meeting` describe the message without decrypting it. Meeting
+    invites/endings still carry their "[MEETING_INVITE] {...}" text for the
+    web client, but the server reads the structured columns.
     """
 
+    KIND_TEXT = 'text'
+    KIND_FILE = 'file'
+    KIND_MEETING_INVITE = 'meeting_invite'
+    KIND_MEETING_ENDED = 'meeting_ended'
+    KIND_SYSTEM = 'system'
+    KIND_CHOICES = [
+        (KIND_TEXT, 'Text'),
+        (KIND_FILE, 'File'),
+        (KIND_MEETING_INVITE, 'Meeting invite'),
+        (KIND_MEETING_ENDED, 'Meeting ended'),
+        (KIND_SYSTEM, 'System'),
+    ]
+
+    # Text prefixes written by older code paths and the web client
+    KIND_MARKERS = (
+        ('[MEETING_INVITE]', KIND_MEETING_INVITE),
+        ('[MEETING_ENDED]', KIND_MEETING_ENDED),
+        ('[PROJECT_MEETING_INVITE]', KIND_MEETING_INVITE),
+        ('[PROJECT_MEETING_ENDED]', KIND_MEETING_ENDED),
+    )
+
     # Sender (required)
     sender = models.ForeignKey(
         User,
@@ -74,7 +140,7 @@ class Message(models.Model):
     encrypted_text = models.BinaryField(
         null=True,
         blank=True,
-        help_text="Encrypted message content (Fernet)"
+        help_text="Encrypted message content (versioned envelope, see utils/encryption.py)"
     )
 
     # File attachment
@@ -85,19 +151,53 @@ class Message(models.Model):
         help_text="Supported: images, PDFs, documents"
     )
 
-    # Message this one replies to (thread reference)
+    # Deduplicated blob behind `file` (file.name then points at the blob)
+    attachment = models.ForeignKey(
+        'Attachment',
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='messages'
+    )
+
+    # Name the file was uploaded under (blobs are stored by hash)
+    file_name = models.CharField(max_length=255, blank=True, default='')
+
+    # Message this one replies to (thread reference). ORM-only: the target
+    # may be partitioned away or archived (utils/partitions.py)
     reply_to = models.ForeignKey(
         'self',
         on_delete=models.SET_NULL,
         null=True,
         blank=True,
-        related_name='replies'
+        related_name='replies',
+        db_constraint=False
     )
 
+    kind = models.CharField(
+        max_length=20, choices=KIND_CHOICES, default=KIND_TEXT, db_index=True)
+
+    # Meeting an invite/ended message refers to
+    meeting = models.ForeignKey(
+        'Meeting',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='messages'
+    )
+
+    # dm_<low>_<high> or p_<project id>, derived on save; lets history,
+    # unread and last-message queries scan one (conversation_key, ...) range
+    # instead of OR-ing sender/receiver pairs
+    conversation_key = models.CharField(max_length=48, blank=True, default='', editable=False)
+
     # Metadata
-    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Not auto_now_add: imports (utils/transfer.py) keep the original times
+    timestamp = models.DateTimeField(default=timezone.now, editable=False, db_index=True)
     is_read = models.BooleanField(default=False, db_index=True)
 
+    objects = MessageQuerySet.as_manager()
+
     class Meta:
         ordering = ['timestamp']
         indexes = [
@@ -105,6 +205,10 @@ class Message(models.Model):
             models.Index(fields=['receiver', 'is_read']),
             models.Index(fields=['project', 'timestamp']),
             models.Index(fields=['reply_to']),
+            # History pages, unread counts and last message per conversation
+            models.Index(fields=['conversation_key', 'timestamp', 'id']),
+            # Per-conversation file listings (kind='file', newest first)
+            models.Index(fields=['conversation_key', 'kind', 'id']),
         ]
 
     def __str__(self):
@@ -138,6 +242,7 @@ class Message(models.Model):
         try:
             from .utils.encryption import encrypt_message
             self.encrypted_text = encrypt_message(value)
+            self._index_text = value
         except Exception as e:
             import logging
             logger = logging.getLogger(__name__)
@@ -152,8 +257,294 @@ class Message(models.Model):
                 "Message must have either receiver OR project, not both")
 
     def save(self, *args, **kwargs):
+        index_text = self.__dict__.pop('_index_text', None)
+        if self.kind == self.KIND_TEXT:
+            self._classify(index_text)
         self.full_clean()
-        super().save(*args, **kwargs)
+        self._set_conversation_key(kwargs)
+        self._upgrade_ciphertext(kwargs.get('update_fields'))
+        if index_text is None:
+            super().save(*args, **kwargs)
+            return
+        # Text changed: keep the blind search index in the same transaction
+        from .utils.search_index import index_message
+        created = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            index_message(self, index_text, created=created)
+
+    def attach(self, attachment, name=''):
+        """Point this (saved) message at a stored Attachment and take a reference"""
+        with transaction.atomic():
+            Attachment.objects.filter(pk=attachment.pk).update(ref_count=F('ref_count') + 1)
+            self.attachment = attachment
+            self.file.name = attachment.blob.name
+            self.file_name = os.path.basename(name or '')[:255]
+            if self.kind == self.KIND_TEXT:
+                self.kind = self.KIND_FILE
+            self.save(update_fields=['attachment', 'file', 'file_name', 'kind'])
+
+    @property
+    def display_file_name(self):
+        """Original upload name, else the stored file's basename"""
+        return self.file_name or (os.path.basename(self.file.name) if self.file else '')
+
+    @classmethod
+    def kind_for_text(cls, text):
+        """(kind, meeting id or None) implied by a text marker, else (None, None)"""
+        if not text or not text.startswith('['):
+            return None, None
+        for marker, kind in cls.KIND_MARKERS:
+            if text.startswith(marker):
+                try:
+                    meeting_id = uuid.UUID(str(json.loads(text[len(marker):])['id']))
+                except (ValueError, TypeError, KeyError):
+                    meeting_id = None
+                return kind, meeting_id
+        return None, None
+
+    def _classify(self, text):
+        """Fill kind/meeting for messages created without them"""
+        kind, meeting_id = self.kind_for_text(text)
+        if kind:
+            self.kind = kind
+            if meeting_id and self.meeting_id is None:
+                self.meeting = Meeting.objects.filter(id=meeting_id).first()
+        elif self.file:
+            self.kind = self.KIND_FILE
+
+    def _set_conversation_key(self, save_kwargs):
+        if self.project_id:
+            key = project_key(self.project_id)
+        else:
+            key = dm_key(self.sender_id, self.receiver_id)
+        if key == self.conversation_key:
+            return
+        self.conversation_key = key
+        update_fields = save_kwargs.get('update_fields')
+        if update_fields is not None:
+            save_kwargs['update_fields'] = {*update_fields, 'conversation_key'}
+
+    def _upgrade_ciphertext(self, update_fields=None):
+        """Lazily move legacy (Fernet) ciphertext to the current format on rewrite"""
+        if not self.encrypted_text:
+            return
+        if update_fields is not None and 'encrypted_text' not in update_fields:
+            return
+        from .utils.encryption import needs_upgrade, upgrade_token
+        token = bytes(self.encrypted_text)
+        if needs_upgrade(token):
+            try:
+                self.encrypted_text = upgrade_token(token)
+            except Exception as e:
+                import logging
+                logging.getLogger(__name__).warning(
+                    f"Could not upgrade ciphertext of message {self.pk}: {e}")
+
+
+class MessageSearchToken(models.Model):
+    """Blind index entry: keyed HMAC of one normalized word of a message
+
+    See utils/search_index.py. Rows are written on Message.save and by
+    'manage.py backfill_search_index'.
+    """
+    # No database constraint: chat_message is partitioned on Postgres
+    # (utils/partitions.py) and cannot be a foreign key target
+    message = models.ForeignKey(
+        Message, on_delete=models.CASCADE, related_name='search_tokens', db_constraint=False)
+    digest = models.CharField(max_length=32)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['digest', 'message'], name='chat_searchtoken_digest_message'),
+        ]
+
+    def __str__(self):
+        return f"{self.digest[:8]}… → {self.message_id}"
+
+
+class MessageArchiveQuerySet(models.QuerySet):
+
+    def visible_to(self, user):
+        """Archives of the user's DMs and of projects they belong to"""
+        return self.filter(
+            models.Q(conversation_key__startswith=f"dm_{user.id}_") |
+            models.Q(conversation_key__startswith='dm_', conversation_key__endswith=f"_{user.id}") |
+            models.Q(conversation_key__in=[
+                project_key(pk) for pk in Project.objects.filter(members=user).values_list('id', flat=True)])
+        )
+
+
+class MessageArchive(models.Model):
+    """One conversation's messages of one month, moved to a cold file
+
+    Written by 'manage.py archive_messages' (utils/archive.py). The file
+    holds the rows as they were, bodies still encrypted; history pages
+    read it once a cursor passes the oldest message left in chat_message.
+    """
+    conversation_key = models.CharField(max_length=48)
+    month = models.DateField()
+    path = models.CharField(max_length=255)
+    message_count = models.PositiveIntegerField()
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = MessageArchiveQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['conversation_key', 'month'], name='chat_archive_conversation_month'),
+        ]
+        indexes = [
+            models.Index(fields=['conversation_key', 'last_id']),
+        ]
+
+    def __str__(self):
+        return f"{self.conversation_key} {self.month:%Y-%m} ({self.message_count})"
+
+
+class MessageArchiveFile(models.Model):
+    """A file (blob or legacy upload) referenced by an archived message, for media auth"""
+    archive = models.ForeignKey(MessageArchive, on_delete=models.CASCADE, related_name='files')
+    name = models.CharField(max_length=255, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['archive', 'name'], name='chat_archivefile_archive_name'),
+        ]
+
+
+class RetentionPolicy(models.Model):
+    """Keep a conversation's messages for keep_days, then purge them
+
+    Enforced by 'manage.py purge_messages' (utils/retention.py), which
+    also keeps the counters below.
+    """
+    conversation_key = models.CharField(
+        max_length=48, unique=True, help_text="dm_<low id>_<high id> or p_<project id>")
+    keep_days = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_purged_at = models.DateTimeField(null=True, blank=True)
+    purged_count = models.BigIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'Retention policies'
+
+    def __str__(self):
+        return f"{self.conversation_key}: {self.keep_days} days"
+
+    @classmethod
+    def for_project(cls, project, keep_days):
+        return cls.objects.update_or_create(
+            conversation_key=project_key(project.pk), defaults={'keep_days': keep_days})[0]
+
+    @classmethod
+    def for_dm(cls, user, other, keep_days):
+        return cls.objects.update_or_create(
+            conversation_key=dm_key(user.pk, other.pk), defaults={'keep_days': keep_days})[0]
+
+
+class Attachment(models.Model):
+    """Uploaded file stored once per distinct content (SHA-256)
+
+    Messages reference it through Message.attachment; ref_count tracks how
+    many, and the blob is deleted with the last one.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    blob = models.FileField(upload_to=attachment_blob_path, max_length=255)
+    size = models.BigIntegerField()
+    content_type = models.CharField(max_length=100, blank=True, db_index=True)
+    ref_count = models.PositiveIntegerField(default=0)
+    # Images only: original dimensions and the thumbnail sizes generated so far
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    thumbnails = models.JSONField(default=list, blank=True)
+    # Last failed thumbnail render; retried after THUMBNAIL_RETRY_AFTER
+    thumbnails_failed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]}… ({self.size} bytes, {self.ref_count} refs)"
+
+    @classmethod
+    def store(cls, content, sha256, name, content_type=''):
+        """
+        (attachment, created) for this content, writing the blob only if it
+        is new. `content` is a Django File whose SHA-256 is already known
+        (see utils/uploads.py); a temporary upload is moved, not copied.
+        """
+        existing = cls.objects.filter(sha256=sha256).first()
+        if existing is not None:
+            return existing, False
+        attachment = cls(sha256=sha256, size=content.size, content_type=content_type or '')
+        path = attachment_blob_path(attachment, name)
+        if attachment.blob.storage.exists(path):
+            # Left behind by a concurrent upload of the same content
+            attachment.blob.name = path
+        else:
+            attachment.blob.save(name, content, save=False)
+        return cls._insert(attachment)
+
+    @classmethod
+    def link(cls, sha256, blob_name, size, content_type=''):
+        """
+        (attachment, created) for a blob already written under its
+        content-addressed name (utils/uploads.write_blob); no file I/O.
+        """
+        existing = cls.objects.filter(sha256=sha256).first()
+        if existing is not None:
+            existing.discard_duplicate(blob_name)
+            return existing, False
+        attachment = cls(sha256=sha256, size=size, content_type=content_type or '')
+        attachment.blob.name = blob_name
+        return cls._insert(attachment)
+
+    @classmethod
+    def _insert(cls, attachment):
+        try:
+            with transaction.atomic():
+                attachment.save()
+        except IntegrityError:
+            existing = cls.objects.get(sha256=attachment.sha256)
+            existing.discard_duplicate(attachment.blob.name)
+            return existing, False
+        from .utils import thumbnails
+        if thumbnails.supported(attachment.content_type):
+            transaction.on_commit(lambda: thumbnails.schedule(attachment))
+        return attachment, True
+
+    def discard_duplicate(self, blob_name):
+        """
+        Delete a blob just written for this content under another name
+        (another extension): nothing references it, this row wins.
+        """
+        if blob_name and blob_name != self.blob.name:
+            self.blob.storage.delete(blob_name)
+
+    @classmethod
+    def release(cls, pk):
+        """Drop one reference; delete the row and blob when none remain"""
+        with transaction.atomic():
+            attachment = cls.objects.select_for_update().filter(pk=pk).first()
+            if attachment is None:
+                return
+            if attachment.ref_count > 1:
+                cls.objects.filter(pk=pk).update(ref_count=F('ref_count') - 1)
+                return
+            remaining = attachment.messages.count()
+            if remaining:
+                # Count drifted: trust the references that actually exist
+                cls.objects.filter(pk=pk).update(ref_count=remaining)
+                return
+            from .utils.thumbnails import thumbnail_name
+            names = [attachment.blob.name] + [
+                thumbnail_name(attachment.sha256, size) for size in attachment.thumbnails or []]
+            storage = attachment.blob.storage
+            attachment.delete()
+            transaction.on_commit(lambda: [storage.delete(name) for name in names])
 
 
 class UserProfile(models.Model):
@@ -204,10 +595,45 @@ def save_user_profile(sender, instance, **kwargs):
         UserProfile.objects.create(user=instance)
 
 
+# SIGNALS: Read-your-writes — the writer's replica reads stay on the primary
+@receiver(post_save, sender=Message)
+def pin_message_sender(sender, instance, created, **kwargs):
+    if created:
+        pin_to_primary(instance.sender_id)
+
+
+@receiver(post_save, sender=Project)
+def pin_project_creator(sender, instance, created, **kwargs):
+    if created:
+        pin_to_primary(instance.created_by_id)
+
+
+@receiver(m2m_changed, sender=Project.members.through)
+def pin_new_project_members(sender, instance, action, pk_set, **kwargs):
+    if action == 'post_add' and isinstance(instance, Project):
+        for user_id in pk_set or ():
+            pin_to_primary(user_id)
+
+
+# SIGNALS: Cached user cards (utils/user_cards.py) follow user and profile saves
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=UserProfile)
+def bump_user_card(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= {'is_online', 'last_seen'}:
+        return  # presence is not part of the cached card (UserSerializer.cards)
+    user_id = instance.user_id if isinstance(instance, UserProfile) else instance.pk
+    user_cards.bump(user_id)
+    # Again after commit: a card rebuilt in between may have read the old row
+    transaction.on_commit(lambda: user_cards.bump(user_id))
+
+
 # SIGNALS: Cleanup uploaded files on message deletion
 @receiver(pre_delete, sender=Message)
 def delete_message_file(sender, instance, **kwargs):
-    if instance.file:
+    if instance.attachment_id:
+        # Shared blob: only removed with its last reference
+        transaction.on_commit(lambda: Attachment.release(instance.attachment_id))
+    elif instance.file:
         instance.file.delete(save=False)
 
 
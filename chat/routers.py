@@ -0,0 +1,96 @@
+# chat/routers.py
+"""
+Read-replica routing with read-your-writes stickiness.
+
+Only reads that opt in leave the primary: views wrapped in
+@reads_from_replica (history, sidebar, search, user search, admin change
+lists) or code inside `with replica_reads(user_id)`. Everything else, and
+every write, stays on 'default'.
+
+Replicas lag. After a user writes (a message saved, a project created or
+joined, an admin save) pin_to_primary() keeps that user's replica reads
+on the primary for REPLICA_STICKY_SECONDS, so a sender always sees their
+own message. Pins live in the REPLICA_STICKY_CACHE cache; it must be
+shared (Redis) when more than one process serves the same users, or a
+write handled by one process does not pin reads served by another.
+
+    READ_REPLICAS = ['replica1', ...]   # DATABASES aliases, [] = off
+    REPLICA_STICKY_SECONDS = 10
+"""
+
+import contextlib
+import contextvars
+import functools
+import math
+import random
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+
+# Replica alias chosen for the current block, None = primary
+_current = contextvars.ContextVar('chat_read_replica', default=None)
+
+
+def replicas():
+    return list(getattr(settings, 'READ_REPLICAS', None) or ())
+
+
+def _cache():
+    return caches[getattr(settings, 'REPLICA_STICKY_CACHE', 'default')]
+
+
+def _pin_key(user_id):
+    return f"chat:replica-pin:{user_id}"
+
+
+def pin_to_primary(user_id):
+    """Serve this user's replica reads from the primary for the sticky window"""
+    seconds = getattr(settings, 'REPLICA_STICKY_SECONDS', 0)
+    if user_id and seconds > 0 and replicas():
+        _cache().set(_pin_key(user_id), 1, timeout=math.ceil(seconds))
+
+
+def is_pinned(user_id):
+    return bool(user_id) and _cache().get(_pin_key(user_id)) is not None
+
+
+@contextlib.contextmanager
+def replica_reads(user_id=None):
+    """Route ORM reads in this block to one replica, unless the user is pinned"""
+    options = replicas()
+    alias = random.choice(options) if options and not is_pinned(user_id) else None
+    token = _current.set(alias)
+    try:
+        yield alias
+    finally:
+        _current.reset(token)
+
+
+def reads_from_replica(view):
+    """Wrap a view method (self, request, ...) in replica_reads(request.user)"""
+    @functools.wraps(view)
+    def wrapper(self, request, *args, **kwargs):
+        with replica_reads(getattr(request.user, 'pk', None)):
+            return view(self, request, *args, **kwargs)
+    return wrapper
+
+
+class ReplicaRouter:
+    """DATABASE_ROUTERS entry; reads go to the replica chosen by replica_reads()"""
+
+    def db_for_read(self, model, **hints):
+        return _current.get()
+
+    def db_for_write(self, model, **hints):
+        # Objects read from a replica are saved to the primary
+        instance = hints.get('instance')
+        if _current.get() or (instance is not None and instance._state.db in replicas()):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        pool = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in pool and obj2._state.db in pool:
+            return True
+        return None
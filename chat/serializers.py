@@ -13,11 +13,16 @@ Fixes implemented:
 """
 
 import logging
+import mimetypes
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import prefetch_related_objects
+from django.db.models.manager import BaseManager
 from django.utils import timezone
 from .models import Message, Project, UserProfile
+from .utils import user_cards
+from .utils.avatars import AVATAR_SIZES, urls as avatar_urls
 
 logger = logging.getLogger(__name__)
 
@@ -47,6 +52,16 @@ class SerializerConfig:
 
 # ====================== USER SERIALIZER ======================
 
+class UserListSerializer(serializers.ListSerializer):
+    """Many users at once: one cache round-trip, cards built only for the misses"""
+
+    def to_representation(self, data):
+        users = list(data.all() if isinstance(data, BaseManager) else data)
+        primed = self.context.get('user_cards') or {}
+        cards = {**UserSerializer.card_map(user for user in users if user.pk not in primed), **primed}
+        return [cards[user.pk] for user in users]
+
+
 class UserSerializer(serializers.ModelSerializer):
     """
     Serializer for User model with extended profile information.
@@ -64,6 +79,48 @@ class UserSerializer(serializers.ModelSerializer):
         model = User
         fields = ['id', 'username', 'email', 'first_name', 'last_name', 'profile']
         read_only_fields = ['id', 'profile']
+        list_serializer_class = UserListSerializer
+
+    @classmethod
+    def cards(cls, users):
+        """
+        Serialized users, from the user card cache (utils/user_cards.py).
+        Views that render users nested in other serializers pass
+        {user.pk: card} as context['user_cards'] to fetch them all at once.
+
+        is_online / last_seen change on every socket connect and are read
+        fresh (one query) instead: with a per-process cache, other workers
+        would keep serving a stale copy.
+        """
+        def build(missing):
+            prefetch_related_objects(missing, 'profile')
+            serializer = cls()
+            return [dict(super(UserSerializer, serializer).to_representation(user)) for user in missing]
+        cards = user_cards.get_many(users, build)
+        if not cards:
+            return cards
+        presence = {
+            user_id: {'is_online': is_online, 'last_seen': last_seen.isoformat() if last_seen else None}
+            for user_id, is_online, last_seen in UserProfile.objects.filter(
+                user_id__in={user.pk for user in users}).values_list('user_id', 'is_online', 'last_seen')
+        }
+        return [
+            {**card, 'profile': {**card['profile'], **presence[user.pk]}}
+            if card.get('profile') and user.pk in presence else card
+            for user, card in zip(users, cards)
+        ]
+
+    @classmethod
+    def card_map(cls, users):
+        """{user.pk: card} for distinct users (None entries skipped)"""
+        users = list({user.pk: user for user in users if user is not None}.values())
+        return dict(zip((user.pk for user in users), cls.cards(users))) if users else {}
+
+    def to_representation(self, instance):
+        primed = self.context.get('user_cards') or {}
+        if instance.pk in primed:
+            return primed[instance.pk]
+        return self.cards([instance])[0]
     
     def get_profile(self, obj):
         """
@@ -75,6 +132,7 @@ class UserSerializer(serializers.ModelSerializer):
         """
         try:
             profile = obj.profile
+            avatars = avatar_urls(profile)
             
             return {
                 'is_online': profile.is_online,
@@ -82,7 +140,9 @@ class UserSerializer(serializers.ModelSerializer):
                     profile.last_seen.isoformat() 
                     if profile.last_seen else None
                 ),
-                'avatar': profile.avatar.url if profile.avatar else None,
+                # Smallest square size; 'avatars' has every size, all immutable URLs
+                'avatar': avatars[str(AVATAR_SIZES[0])] if avatars else None,
+                'avatars': avatars,
             }
             
         except UserProfile.DoesNotExist:
@@ -113,6 +173,7 @@ class UserSerializer(serializers.ModelSerializer):
                     'is_online': False,
                     'last_seen': None,
                     'avatar': None,
+                    'avatars': None,
                 }
         
         except Exception as e:
@@ -215,11 +276,12 @@ class MessageSerializer(serializers.ModelSerializer):
         allow_null=True
     )
     reply_to_id = serializers.IntegerField(
-        source='reply_to.id',
         read_only=True,
         allow_null=True
     )
     file_url = serializers.SerializerMethodField()
+    file_name = serializers.CharField(source='display_file_name', read_only=True)
+    thumbnail_urls = serializers.SerializerMethodField()
     timestamp_iso = serializers.SerializerMethodField()
     meeting_status = serializers.SerializerMethodField()
     
@@ -229,42 +291,23 @@ class MessageSerializer(serializers.ModelSerializer):
             'id', 'sender', 'sender_id', 'sender_username',
             'receiver', 'receiver_id', 'receiver_username',
             'project', 'project_id', 'project_name',
-            'text', 'file', 'file_url', 'reply_to_id',
+            'text', 'file', 'file_url', 'file_name', 'thumbnail_urls', 'reply_to_id',
             'timestamp', 'timestamp_iso', 'is_read',
-            'meeting_status'
+            'kind', 'meeting_status'
         ]
         read_only_fields = [
-            'id', 'timestamp', 'sender', 'sender_id', 'sender_username'
+            'id', 'timestamp', 'sender', 'sender_id', 'sender_username', 'kind'
         ]
     
     def get_meeting_status(self, obj):
         """
-        Check if message is a meeting invite and return meeting status.
+        'active' / 'ended' for meeting invites, resolved through the meeting FK
+        (querysets select_related('meeting')), else None.
         """
-        if not obj.text or '[MEETING_INVITE]' not in obj.text:
-            return None
-            
-        try:
-            import json
-            from .models import Meeting
-            
-            marker = '[MEETING_INVITE]'
-            # Extract JSON part
-            json_str = obj.text[obj.text.find(marker) + len(marker):]
-            data = json.loads(json_str)
-            meeting_id = data.get('id')
-            
-            if not meeting_id:
-                return None
-                
-            meeting = Meeting.objects.filter(id=meeting_id).first()
-            if meeting:
-                return 'ended' if (meeting.ended or meeting.status == 'ended') else 'active'
-                
-        except Exception as e:
-            logger.warning(f"Error checking meeting status for message {obj.id}: {e}")
+        if obj.kind != Message.KIND_MEETING_INVITE or obj.meeting_id is None:
             return None
-        return None
+        meeting = obj.meeting
+        return 'ended' if (meeting.ended or meeting.status == 'ended') else 'active'
     
     def get_file_url(self, obj):
         """
@@ -291,6 +334,22 @@ class MessageSerializer(serializers.ModelSerializer):
             )
             return None
     
+    def get_thumbnail_urls(self, obj):
+        """
+        {"160": url, "480": url, ...} for image attachments, None otherwise.
+        Missing sizes are (re)generated in the background.
+        """
+        if obj.attachment_id is None:
+            return None
+        from .utils.thumbnails import urls
+        thumbs = urls(obj.attachment)
+        if thumbs is None:
+            return None
+        request = self.context.get('request')
+        if request:
+            thumbs = {size: request.build_absolute_uri(url) for size, url in thumbs.items()}
+        return thumbs
+    
     def get_timestamp_iso(self, obj):
         """
         Get ISO formatted timestamp.
@@ -303,6 +362,45 @@ class MessageSerializer(serializers.ModelSerializer):
         return None
 
 
+# ====================== CONVERSATION FILE SERIALIZER ======================
+
+class ConversationFileSerializer(serializers.ModelSerializer):
+    """
+    One file of a conversation for the files panel, read from the message's
+    indexed columns and its Attachment (size, type, dimensions, hash).
+    Messages with pre-Attachment files have no size/hash/dimensions.
+    """
+
+    message_id = serializers.IntegerField(source='id', read_only=True)
+    sender_id = serializers.IntegerField(read_only=True)
+    name = serializers.CharField(source='display_file_name', read_only=True)
+    url = serializers.SerializerMethodField()
+    size = serializers.IntegerField(source='attachment.size', read_only=True, default=None)
+    content_type = serializers.SerializerMethodField()
+    width = serializers.IntegerField(source='attachment.width', read_only=True, default=None)
+    height = serializers.IntegerField(source='attachment.height', read_only=True, default=None)
+    sha256 = serializers.CharField(source='attachment.sha256', read_only=True, default=None)
+    thumbnail_urls = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Message
+        fields = [
+            'message_id', 'sender_id', 'name', 'url', 'size', 'content_type',
+            'width', 'height', 'sha256', 'thumbnail_urls', 'timestamp',
+        ]
+
+    def get_url(self, obj):
+        request = self.context.get('request')
+        return request.build_absolute_uri(obj.file.url) if request else obj.file.url
+
+    def get_content_type(self, obj):
+        if obj.attachment_id is not None:
+            return obj.attachment.content_type
+        return mimetypes.guess_type(obj.file.name)[0] or ''
+
+    get_thumbnail_urls = MessageSerializer.get_thumbnail_urls
+
+
 # ====================== MESSAGE CREATE SERIALIZER ======================
 
 class MessageCreateSerializer(serializers.ModelSerializer):
@@ -336,10 +434,16 @@ class MessageCreateSerializer(serializers.ModelSerializer):
         required=False,
         allow_null=True
     )
+    # Token from POST /api/attachments/ (streamed, deduplicated upload)
+    attachment_token = serializers.CharField(
+        write_only=True,
+        required=False,
+        allow_blank=True
+    )
     
     class Meta:
         model = Message
-        fields = ['receiver_id', 'project_id', 'text', 'file']
+        fields = ['receiver_id', 'project_id', 'reply_to_id', 'text', 'file', 'attachment_token']
     
     def validate_text(self, value):
         """Validate message text content"""
@@ -385,6 +489,16 @@ class MessageCreateSerializer(serializers.ModelSerializer):
         
         return value
     
+    def validate_attachment_token(self, value):
+        """Resolve an upload token to the Attachment it grants this user"""
+        if not value:
+            return None
+        from .utils.uploads import attachment_from_token
+        attachment = attachment_from_token(value, self.context['request'].user)
+        if attachment is None:
+            raise serializers.ValidationError("Invalid or expired attachment token")
+        return attachment
+    
     def validate(self, data):
         """
         Validate destination and sender permissions.
@@ -553,9 +667,7 @@ class MessageCreateSerializer(serializers.ModelSerializer):
                         message.save()
                     except Exception:
                         pass
-                if 'file' in validated_data and validated_data['file']:
-                    message.file = validated_data['file']
-                    message.save()
+                self._attach(message, validated_data)
                 logger.info(
                     "DM created: %s (ID: %s) -> %s",
                     sender.username, message.id, receiver.username
@@ -573,9 +685,7 @@ class MessageCreateSerializer(serializers.ModelSerializer):
                         message.save()
                     except Exception:
                         pass
-                if 'file' in validated_data and validated_data['file']:
-                    message.file = validated_data['file']
-                    message.save()
+                self._attach(message, validated_data)
                 logger.info(
                     "Project message created: %s (ID: %s) in %s",
                     sender.username, message.id, project.name
@@ -605,6 +715,17 @@ class MessageCreateSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError({
                 'non_field_errors': ["Invalid message data"]
             })
+    
+    def _attach(self, message, validated_data):
+        """Attach an uploaded file or upload token through deduplicated storage"""
+        attachment = validated_data.get('attachment_token')
+        name = getattr(attachment, 'upload_name', '')
+        if attachment is None and validated_data.get('file'):
+            from .utils.uploads import store_upload
+            attachment, _ = store_upload(validated_data['file'])
+            name = validated_data['file'].name
+        if attachment is not None:
+            message.attach(attachment, name)
 
 
 # ====================== RECENT CHAT SERIALIZER ======================
@@ -741,3 +862,138 @@ class SidebarItemSerializer(serializers.Serializer):
     last_message_timestamp = serializers.DateTimeField(allow_null=True, required=False)
     unread_count = serializers.IntegerField(default=0)
 
+
+# ====================== FAST READ PATHS ======================
+#
+# Plain-Python equivalents of MessageSerializer(many=True).data and
+# SidebarItemSerializer(many=True).data for the hot read endpoints. DRF
+# resolves every declared field per object (get_attribute, to_representation,
+# method fields); these build the same dicts directly, key for key, and are
+# checked against the serializers above by golden tests. Any field added to
+# those serializers must be added here too.
+
+_DATETIME = serializers.DateTimeField()
+
+
+def _datetime(value):
+    """DateTimeField output (ISO 8601, UTC as 'Z') without a bound field per call"""
+    return _DATETIME.to_representation(value) if value else None
+
+
+def _absolute(request, url):
+    return request.build_absolute_uri(url) if request is not None else url
+
+
+def _related_values(messages, fields, attr):
+    """
+    {pk: attr} for the objects behind FK `fields` of the messages: taken
+    from relations already loaded (select_related, archive pages) and one
+    query for the rest
+    """
+    values, missing = {}, set()
+    for field in fields:
+        descriptor = Message._meta.get_field(field)
+        for message in messages:
+            pk = getattr(message, descriptor.attname)
+            if pk is None or pk in values:
+                continue
+            if descriptor.is_cached(message):
+                values[pk] = getattr(getattr(message, field), attr)
+            else:
+                missing.add(pk)
+    missing -= values.keys()
+    if missing:
+        model = Message._meta.get_field(fields[0]).related_model
+        values.update(model.objects.filter(pk__in=missing).order_by().values_list('pk', attr))
+    return values
+
+
+def message_data(messages, request=None):
+    """
+    MessageSerializer(messages, many=True, context={'request': request}).data
+    as plain dicts. Messages should come with select_related('meeting',
+    'attachment'); sender/receiver/project names are fetched in one query
+    each unless already loaded.
+    """
+    from .utils.thumbnails import urls as thumbnail_urls
+
+    messages = list(messages)
+    usernames = _related_values(messages, ('sender', 'receiver'), 'username')
+    project_names = _related_values(messages, ('project',), 'name')
+    rows = []
+    for m in messages:
+        file_url = _absolute(request, m.file.url) if m.file else None
+        thumbs = thumbnail_urls(m.attachment) if m.attachment_id is not None else None
+        if thumbs is not None and request is not None:
+            thumbs = {size: request.build_absolute_uri(url) for size, url in thumbs.items()}
+        meeting_status = None
+        if m.kind == Message.KIND_MEETING_INVITE and m.meeting_id is not None:
+            meeting_status = 'ended' if (m.meeting.ended or m.meeting.status == 'ended') else 'active'
+        rows.append({
+            'id': m.id,
+            'sender': m.sender_id,
+            'sender_id': m.sender_id,
+            'sender_username': usernames.get(m.sender_id),
+            'receiver': m.receiver_id,
+            'receiver_id': m.receiver_id,
+            'receiver_username': usernames.get(m.receiver_id),
+            'project': m.project_id,
+            'project_id': m.project_id,
+            'project_name': project_names.get(m.project_id),
+            'text': m.text,
+            'file': file_url,
+            'file_url': file_url,
+            'file_name': m.display_file_name,
+            'thumbnail_urls': thumbs,
+            'reply_to_id': m.reply_to_id,
+            'timestamp': _datetime(m.timestamp),
+            'timestamp_iso': m.timestamp.isoformat() if m.timestamp else None,
+            'is_read': m.is_read,
+            'kind': m.kind,
+            'meeting_status': meeting_status,
+        })
+    return rows
+
+
+def _project_data(project, cards):
+    members = list(project.members.all())
+    row = {
+        'id': project.id,
+        'name': project.name,
+        'description': project.description,
+        'members': [cards[user.pk] for user in members],
+        'member_count': len(members),
+        'created_at': _datetime(project.created_at),
+        'updated_at': _datetime(project.updated_at),
+        'created_by': project.created_by_id,
+    }
+    # ProjectSerializer skips created_by_username when there is no creator
+    if project.created_by_id is not None:
+        row['created_by_username'] = project.created_by.username
+    return row
+
+
+def sidebar_data(items, cards=None):
+    """
+    SidebarItemSerializer(items, many=True).data as plain dicts. `items`
+    are the recent_chats dicts; projects should have their members
+    prefetched. `cards` is {user.pk: card} (UserSerializer.card_map) for
+    every user on the page; missing ones are fetched in one round-trip.
+    """
+    cards = dict(cards or {})
+    needed = [item['user'] for item in items if item.get('user') is not None]
+    needed += [user for item in items if item.get('project') is not None
+               for user in item['project'].members.all()]
+    cards.update(UserSerializer.card_map(user for user in needed if user.pk not in cards))
+    rows = []
+    for item in items:
+        last_message = item.get('last_message')
+        rows.append({
+            'type': item['type'],
+            'user': cards[item['user'].pk] if item.get('user') is not None else None,
+            'project': _project_data(item['project'], cards) if item.get('project') is not None else None,
+            'last_message': str(last_message) if last_message is not None else None,
+            'last_message_timestamp': _datetime(item.get('last_message_timestamp')),
+            'unread_count': int(item.get('unread_count', 0)),
+        })
+    return rows
@@ -1,3 +1,1805 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gzip
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
 
-# Create your tests here.
+from channels.exceptions import ChannelFull
+from asgiref.sync import async_to_sync, sync_to_async
+from cryptography.fernet import Fernet
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from . import consumers, metrics
+from .layers import PostgresChannelLayer
+from .models import Attachment, Message, MessageSearchToken, Project
+from .utils import db_executor, encryption
+from .utils.uploads import store_upload
+
+
+# ====================== POSTGRES CHANNEL LAYER ======================
+
+PG_TEST_DSN = os.environ.get('CHANNELS_PG_TEST_DSN')
+
+
+class PostgresChannelLayerNamingTests(SimpleTestCase):
+    """Routing decisions that do not need a database"""
+
+    def test_specific_channels_route_to_owning_process(self):
+        layer = PostgresChannelLayer(dsn='unused')
+        channel = f"specific.{layer.client_prefix}!abc"
+        self.assertEqual(layer._pg_channel_for(channel), layer.pg_channel)
+
+    def test_general_channel_names_fit_postgres_identifiers(self):
+        layer = PostgresChannelLayer(dsn='unused')
+        pg_channel = layer._pg_channel_for('x' * 99)
+        self.assertLessEqual(len(pg_channel), 63)
+
+
+class FakeListenConnection:
+    """Just enough of a psycopg2 connection for the layer's listener"""
+
+    def __init__(self):
+        self.notifies, self.listens, self.closed, self.lost = [], [], False, False
+
+    def cursor(self):
+        conn = self
+
+        class Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def execute(self, sql):
+                if conn.lost:
+                    raise OSError("server closed the connection")
+                conn.listens.append(sql)
+        return Cursor()
+
+    def poll(self):
+        if self.lost:
+            raise OSError("server closed the connection")
+
+    def fileno(self):
+        return -1
+
+    def close(self):
+        self.closed = True
+
+
+class PostgresChannelLayerReconnectTests(SimpleTestCase):
+    """The listener reconnects without stranding receivers already waiting"""
+
+    async def test_waiting_receiver_survives_a_lost_listener(self):
+        from types import SimpleNamespace
+        from chat import layers
+        layer = PostgresChannelLayer(dsn='unused')
+        connections = []
+
+        def connect():
+            connections.append(FakeListenConnection())
+            return connections[-1]
+
+        loop = asyncio.get_running_loop()
+        with mock.patch.object(layer, '_connect', connect), \
+                mock.patch.object(layers, 'RECONNECT_DELAY', 0.01), \
+                mock.patch.object(loop, 'add_reader', side_effect=NotImplementedError):
+            channel = await layer.new_channel()
+            layer._listen(layer._pg_channel_for('general'))
+            receiving = asyncio.ensure_future(layer.receive(channel))
+            await asyncio.sleep(0.1)
+
+            connections[0].lost = True
+            for _ in range(100):
+                if layer._listen_conn is not None and layer._listen_conn is not connections[0]:
+                    break
+                await asyncio.sleep(0.02)
+            fresh = connections[-1]
+            self.assertEqual(len(connections), 2)
+            self.assertTrue(connections[0].closed)
+            self.assertEqual(sorted(fresh.listens), sorted(
+                f'LISTEN "{c}"' for c in (layer.pg_channel, layer._pg_channel_for('general'))))
+
+            body = base64.b64encode(layer._envelope(channel, {'type': 'after.failover'})).decode()
+            fresh.notifies.append(SimpleNamespace(channel=layer.pg_channel, payload=body))
+            message = await asyncio.wait_for(receiving, 2)
+            self.assertEqual(message['type'], 'after.failover')
+            await layer.close()
+
+
+@unittest.skipUnless(PG_TEST_DSN, "set CHANNELS_PG_TEST_DSN to run against Postgres")
+class PostgresChannelLayerConformanceTests(SimpleTestCase):
+    """Mirrors the channels layer conformance checks used for InMemory/Redis"""
+
+    def make_layer(self, **kwargs):
+        kwargs.setdefault('prefix', 'test')
+        return PostgresChannelLayer(dsn=PG_TEST_DSN, **kwargs)
+
+    async def test_send_receive(self):
+        layer = self.make_layer()
+        await layer.flush()
+        await layer.send('test-channel-1', {'type': 'test.message', 'text': 'Ahoy-hoy!'})
+        message = await asyncio.wait_for(layer.receive('test-channel-1'), 5)
+        self.assertEqual(message['type'], 'test.message')
+        self.assertEqual(message['text'], 'Ahoy-hoy!')
+        await layer.close()
+
+    async def test_specific_channel_round_trip(self):
+        layer = self.make_layer()
+        channel = await layer.new_channel()
+        await layer.send(channel, {'type': 'test.message', 'blob': b'\x00\x01'})
+        message = await asyncio.wait_for(layer.receive(channel), 5)
+        self.assertEqual(message['blob'], b'\x00\x01')
+        await layer.close()
+
+    async def test_large_payload_goes_through_table(self):
+        layer = self.make_layer()
+        channel = await layer.new_channel()
+        text = 'y' * 50000
+        await layer.send(channel, {'type': 'test.message', 'text': text})
+        message = await asyncio.wait_for(layer.receive(channel), 5)
+        self.assertEqual(message['text'], text)
+        await layer.close()
+
+    async def test_cross_instance_delivery(self):
+        sender, receiver = self.make_layer(), self.make_layer()
+        channel = await receiver.new_channel()
+        await sender.group_add('cross', channel)
+        await sender.group_send('cross', {'type': 'test.message', 'n': 1})
+        message = await asyncio.wait_for(receiver.receive(channel), 5)
+        self.assertEqual(message['n'], 1)
+        await sender.group_discard('cross', channel)
+        await sender.close()
+        await receiver.close()
+
+    async def test_send_capacity(self):
+        layer = self.make_layer(capacity=3)
+        await layer.flush()
+        for _ in range(3):
+            await layer.send('test-channel-1', {'type': 'test.message'})
+        with self.assertRaises(ChannelFull):
+            await layer.send('test-channel-1', {'type': 'test.message'})
+        await layer.flush()
+        await layer.close()
+
+    async def test_groups_basic(self):
+        layer = self.make_layer()
+        await layer.flush()
+        c1, c2, c3 = [await layer.new_channel() for _ in range(3)]
+        await layer.group_add('test-group', c1)
+        await layer.group_add('test-group', c2)
+        await layer.group_add('test-group', c3)
+        await layer.group_discard('test-group', c2)
+        await layer.group_send('test-group', {'type': 'message.1'})
+
+        self.assertEqual((await asyncio.wait_for(layer.receive(c1), 5))['type'], 'message.1')
+        self.assertEqual((await asyncio.wait_for(layer.receive(c3), 5))['type'], 'message.1')
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(c2), 1)
+        await layer.close()
+
+    async def test_message_expiry(self):
+        layer = self.make_layer(expiry=1)
+        await layer.flush()
+        await layer.send('test-channel-1', {'type': 'test.message'})
+        await asyncio.sleep(1.5)
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive('test-channel-1'), 1)
+        await layer.close()
+
+    async def test_receiver_survives_listener_termination(self):
+        import psycopg2
+        from chat import layers
+        layer = self.make_layer()
+        channel = await layer.new_channel()
+        receiving = asyncio.ensure_future(layer.receive(channel))
+        await asyncio.sleep(0.2)
+        pid = layer._listen_conn.get_backend_pid()
+        with mock.patch.object(layers, 'RECONNECT_DELAY', 0.05):
+            killer = psycopg2.connect(PG_TEST_DSN)
+            with killer, killer.cursor() as cursor:
+                cursor.execute("SELECT pg_terminate_backend(%s)", [pid])
+            killer.close()
+            for _ in range(100):
+                conn = layer._listen_conn
+                if conn is not None and not conn.closed and conn.get_backend_pid() != pid:
+                    break
+                await asyncio.sleep(0.05)
+        await layer.send(channel, {'type': 'after.restart'})
+        self.assertEqual((await asyncio.wait_for(receiving, 5))['type'], 'after.restart')
+        await layer.close()
+
+    async def test_group_expiry(self):
+        layer = self.make_layer(group_expiry=1)
+        channel = await layer.new_channel()
+        await layer.group_add('test-group', channel)
+        await asyncio.sleep(1.5)
+        await layer.group_send('test-group', {'type': 'message.1'})
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channel), 1)
+        await layer.close()
+
+
+# ====================== METRICS ======================
+
+class HistogramTests(SimpleTestCase):
+
+    def test_render_is_cumulative(self):
+        hist = metrics.Histogram('test_render_seconds', "test", ['op'], buckets=(0.1, 1.0))
+        metrics.REGISTRY.remove(hist)
+        series = hist.labels('x')
+        for value in (0.05, 0.5, 5.0):
+            series.observe(value)
+        text = hist.render()
+        self.assertIn('test_render_seconds_bucket{op="x",pid="%s",le="0.1"} 1' % metrics.PID, text)
+        self.assertIn('le="1.0"} 2', text)
+        self.assertIn('le="+Inf"} 3', text)
+        self.assertIn('test_render_seconds_count{op="x",pid="%s"} 3' % metrics.PID, text)
+
+
+@override_settings(METRICS_TOKEN='s3cret')
+class MetricsEndpointTests(TestCase):
+
+    def test_requires_auth(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+    def test_bearer_token(self):
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE chat_ws_decode_seconds histogram', response.content)
+
+    def test_rest_requests_are_timed(self):
+        user = User.objects.create_user('alice', password='pw')
+        self.client.force_login(user)
+        self.client.get('/chat/api/users/me/')
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertIn(b'chat_http_serialize_seconds_count{view="users-me"', response.content)
+
+    async def test_async_requests_are_timed(self):
+        from asgiref.sync import iscoroutinefunction
+        from django.http import HttpResponse
+        from django.test import AsyncRequestFactory
+
+        async def view(request):
+            await User.objects.acount()
+            request.resolver_match = mock.Mock(url_name='async-view')
+            return HttpResponse()
+
+        middleware = metrics.MetricsMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        await middleware(AsyncRequestFactory().get('/chat/api/async/'))
+        self.assertEqual(sum(metrics.HTTP_HANDLER.labels('async-view').counts), 1)
+        self.assertGreater(metrics.HTTP_QUERY.labels('async-view').sum, 0)
+
+
+# ====================== ENCRYPTION ======================
+
+class EnvelopeTests(TestCase):
+
+    def test_round_trip_uses_versioned_envelope(self):
+        token = encryption.encrypt_message('hello')
+        self.assertEqual(token[0], encryption.VERSION_KEYED)
+        self.assertEqual(len(token), 1 + encryption.KEY_ID_SIZE + encryption.NONCE_SIZE + len('hello') + 16)
+        self.assertEqual(encryption.decrypt_message(token), 'hello')
+
+    def test_legacy_fernet_tokens_still_decrypt(self):
+        legacy = encryption.f.encrypt('old message'.encode())
+        self.assertTrue(encryption.needs_upgrade(legacy))
+        self.assertEqual(encryption.decrypt_message(legacy), 'old message')
+
+    def test_legacy_rows_are_upgraded_on_save(self):
+        alice = User.objects.create_user('alice')
+        bob = User.objects.create_user('bob')
+        msg = Message(sender=alice, receiver=bob)
+        msg.encrypted_text = encryption.f.encrypt('legacy body'.encode())
+        msg.save()
+
+        stored = bytes(Message.objects.get(pk=msg.pk).encrypted_text)
+        self.assertFalse(encryption.needs_upgrade(stored))
+        self.assertEqual(Message.objects.get(pk=msg.pk).text, 'legacy body')
+
+
+class KeyRotationTests(TestCase):
+
+    def setUp(self):
+        self.old_secret = Fernet.generate_key().decode()
+        self.new_secret = Fernet.generate_key().decode()
+        self.old_ring = encryption.Keyring([self.old_secret])
+        self.rotated_ring = encryption.Keyring([self.new_secret, self.old_secret])
+
+    def test_every_configured_key_decrypts(self):
+        token = self.old_ring.encrypt('before rotation')
+        self.assertEqual(self.rotated_ring.decrypt(token), 'before rotation')
+        self.assertTrue(self.rotated_ring.needs_upgrade(token))
+        self.assertFalse(self.rotated_ring.needs_upgrade(self.rotated_ring.encrypt('x')))
+
+    def test_unknown_key_id_is_rejected(self):
+        token = encryption.Keyring([self.new_secret]).encrypt('secret')
+        with self.assertRaises(KeyError):
+            self.old_ring.decrypt(token)
+
+    def test_command_rewrites_old_rows_and_checkpoints(self):
+        alice = User.objects.create_user('alice')
+        bob = User.objects.create_user('bob')
+        ids = []
+        for i in range(5):
+            msg = Message(sender=alice, receiver=bob)
+            msg.encrypted_text = self.old_ring.encrypt(f'body {i}')
+            # bulk_create skips the lazy upgrade in Message.save
+            ids.append(Message.objects.bulk_create([msg])[0].pk)
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(encryption, 'keyring', self.rotated_ring):
+            checkpoint = os.path.join(tmp, 'rotate.json')
+            call_command('rotate_message_keys', workers=0, batch_size=2,
+                         checkpoint=checkpoint, stdout=open(os.devnull, 'w'))
+            with open(checkpoint) as fh:
+                self.assertIn(f'"last_pk": {ids[-1]}', fh.read())
+
+            for i, pk in enumerate(ids):
+                token = bytes(Message.objects.get(pk=pk).encrypted_text)
+                self.assertFalse(self.rotated_ring.needs_upgrade(token))
+                self.assertEqual(Message.objects.get(pk=pk).text, f'body {i}')
+
+
+class CompressionTests(SimpleTestCase):
+
+    def setUp(self):
+        self.secret = Fernet.generate_key().decode()
+        self.body = "ERROR worker timed out while handling request\n" * 40
+
+    def test_long_bodies_are_compressed_short_ones_are_not(self):
+        ring = encryption.Keyring([self.secret], encryption.Compressor(512))
+        token = ring.encrypt(self.body)
+        self.assertEqual(token[0], encryption.VERSION_COMPRESSED)
+        self.assertLess(len(token), len(self.body) // 4)
+        self.assertEqual(ring.decrypt(token), self.body)
+        self.assertFalse(ring.needs_upgrade(token))
+        self.assertEqual(ring.encrypt("short")[0], encryption.VERSION_KEYED)
+
+    def test_dictionary_streams_need_their_dictionary(self):
+        zdict = encryption.Compressor.train([self.body.encode()] * 3)
+        writer = encryption.Keyring([self.secret], encryption.Compressor(512, dictionaries=[zdict]))
+        token = writer.encrypt(self.body)
+        self.assertEqual(writer.decrypt(token), self.body)
+        with self.assertRaises(KeyError):
+            encryption.Keyring([self.secret]).decrypt(token)
+
+    def test_flags_byte_is_authenticated(self):
+        ring = encryption.Keyring([self.secret], encryption.Compressor(512))
+        token = bytearray(ring.encrypt(self.body))
+        token[1 + encryption.KEY_ID_SIZE] = 0
+        with self.assertRaises(Exception):
+            ring.decrypt(bytes(token))
+
+
+# ====================== SEARCH INDEX ======================
+
+class MessageSearchTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.carol = User.objects.create_user('carol')
+
+    def _dm(self, sender, receiver, text):
+        msg = Message(sender=sender, receiver=receiver)
+        msg.text = text
+        msg.save()
+        return msg
+
+    def test_normalization_folds_case_and_accents(self):
+        from .utils.search_index import normalize
+        self.assertEqual(normalize("Café CAFE, déjà-vu a"), ['cafe', 'deja', 'vu'])
+
+    def test_tokens_are_written_on_save_and_replaced_on_edit(self):
+        msg = self._dm(self.alice, self.bob, "quarterly budget review")
+        self.assertEqual(msg.search_tokens.count(), 3)
+        msg.text = "budget"
+        msg.save()
+        self.assertEqual(msg.search_tokens.count(), 1)
+
+    def test_search_intersects_words_and_respects_visibility(self):
+        hit = self._dm(self.alice, self.bob, "The budget review is Friday")
+        self._dm(self.alice, self.bob, "budget only")
+        self._dm(self.carol, self.bob, "budget review for carol and bob")
+
+        self.client.force_login(self.alice)
+        response = self.client.get('/chat/api/messages/search/', {'q': 'REVIEW budget'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['id'] for m in response.json()['results']], [hit.id])
+        self.assertEqual(response.json()['results'][0]['text'], "The budget review is Friday")
+
+    def test_search_pages_with_before_cursor(self):
+        ids = [self._dm(self.alice, self.bob, f"standup notes {i}").id for i in range(3)]
+        self.client.force_login(self.bob)
+        first = self.client.get('/chat/api/messages/search/', {'q': 'standup', 'limit': 2}).json()
+        self.assertEqual([m['id'] for m in first['results']], ids[:0:-1])
+        rest = self.client.get('/chat/api/messages/search/',
+                               {'q': 'standup', 'before': first['next_before']}).json()
+        self.assertEqual([m['id'] for m in rest['results']], [ids[0]])
+        self.assertIsNone(rest['next_before'])
+
+    def test_backfill_indexes_unindexed_messages(self):
+        msg = Message(sender=self.alice, receiver=self.bob,
+                      encrypted_text=encryption.encrypt_message("legacy roadmap"))
+        Message.objects.bulk_create([msg])
+        call_command('backfill_search_index', stdout=open(os.devnull, 'w'))
+        self.client.force_login(self.bob)
+        response = self.client.get('/chat/api/messages/search/', {'q': 'roadmap'})
+        self.assertEqual(len(response.json()['results']), 1)
+
+
+# ====================== MESSAGE KINDS ======================
+
+class MessageKindTests(TestCase):
+
+    def setUp(self):
+        self.host = User.objects.create_user('host')
+        self.guest = User.objects.create_user('guest')
+        self.client.force_login(self.host)
+
+    def test_marker_text_is_classified_on_save(self):
+        from .models import Meeting
+        meeting = Meeting.objects.create(host=self.host, title='sync')
+        msg = Message(sender=self.host, receiver=self.guest)
+        msg.text = '[MEETING_INVITE] ' + json.dumps({'id': str(meeting.id)})
+        msg.save()
+        self.assertEqual((msg.kind, msg.meeting_id), (Message.KIND_MEETING_INVITE, meeting.id))
+
+        plain = Message(sender=self.host, receiver=self.guest)
+        plain.text = '[MEETING_INVITE] not json'
+        plain.save()
+        self.assertEqual((plain.kind, plain.meeting_id), (Message.KIND_MEETING_INVITE, None))
+
+    def test_meeting_lifecycle_uses_structured_columns(self):
+        created = self.client.post('/chat/api/meetings/create/', {
+            'title': 'Planning',
+            'invites': json.dumps([{'type': 'user', 'id': self.guest.id}]),
+        }).json()
+        invite = Message.objects.get(kind=Message.KIND_MEETING_INVITE)
+        self.assertEqual(str(invite.meeting_id), created['meeting_id'])
+
+        messages = self.client.get(f'/chat/api/messages/user/{self.guest.id}/').json()
+        self.assertEqual(messages[0]['meeting_status'], 'active')
+
+        self.client.post(f"/chat/api/meetings/{created['meeting_id']}/end/")
+        ended = Message.objects.get(kind=Message.KIND_MEETING_ENDED)
+        self.assertEqual((ended.receiver_id, ended.meeting_id), (self.guest.id, invite.meeting_id))
+
+        messages = self.client.get(f'/chat/api/messages/user/{self.guest.id}/').json()
+        self.assertEqual([m['kind'] for m in messages],
+                         [Message.KIND_MEETING_INVITE, Message.KIND_MEETING_ENDED])
+        self.assertEqual(messages[0]['meeting_status'], 'ended')
+
+
+class ConversationKeyTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.project = Project.objects.create(name='p')
+
+    def test_key_matches_dm_group_and_follows_edits(self):
+        msg = Message.objects.create(sender=self.bob, receiver=self.alice)
+        self.assertEqual(msg.conversation_key, consumers._dm_group_name(self.alice.id, self.bob.id))
+        msg.receiver, msg.project = None, self.project
+        msg.save(update_fields=['receiver', 'project'])
+        msg.refresh_from_db()
+        self.assertEqual(msg.conversation_key, f'p_{self.project.id}')
+
+    def test_backfill_migration_fills_existing_rows_in_batches(self):
+        import importlib
+        from django.apps import apps
+        migration = importlib.import_module('chat.migrations.0013_message_conversation_key')
+        dm = Message.objects.create(sender=self.bob, receiver=self.alice)
+        for _ in range(3):
+            Message.objects.create(sender=self.alice, project=self.project)
+        Message.objects.update(conversation_key='')
+
+        with mock.patch.object(migration, 'BATCH_SIZE', 2):
+            migration.backfill_conversation_keys(apps, mock.Mock(connection=connection))
+        self.assertEqual(Message.objects.get(id=dm.id).conversation_key,
+                         f'dm_{self.alice.id}_{self.bob.id}')
+        self.assertEqual(Message.objects.filter(conversation_key=f'p_{self.project.id}').count(), 3)
+
+
+# ====================== ATTACHMENTS ======================
+
+class MediaTestCase(TestCase):
+    """Runs with MEDIA_ROOT in a temporary directory, logged in as alice"""
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        override = override_settings(MEDIA_ROOT=self.media.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.client.force_login(self.alice)
+
+    def _blobs(self):
+        return [os.path.join(d, f) for d, _, files in os.walk(self.media.name) for f in files]
+
+
+class AttachmentTests(MediaTestCase):
+
+    def _upload(self, data=b'%PDF-1.4 same bytes'):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        upload = SimpleUploadedFile('report.pdf', data, content_type='application/pdf')
+        return self.client.post('/chat/api/attachments/', {'file': upload})
+
+    def test_identical_uploads_are_stored_once(self):
+        from .utils import uploads
+        before = dict(uploads.counts)
+        first, second = self._upload().json(), self._upload().json()
+        self.assertEqual(first['sha256'], second['sha256'])
+        # Whether the content already existed stays server-side
+        self.assertNotIn('deduplicated', second)
+        self.assertEqual(uploads.counts['deduplicated'] - before['deduplicated'], 1)
+        self.assertEqual(len(self._blobs()), 1)
+        self.assertTrue(self._blobs()[0].endswith(first['sha256'] + '.pdf'))
+
+    def test_blob_lives_until_last_reference_is_deleted(self):
+        token = self._upload().json()['attachment_token']
+        sent = [
+            self.client.post('/chat/api/messages/send/', {
+                'receiver_id': self.bob.id, 'text': f'copy {i}', 'attachment_token': token})
+            for i in range(2)
+        ]
+        self.assertEqual([r.status_code for r in sent], [201, 201])
+        first, second = Message.objects.order_by('id')
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(first.attachment.ref_count, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(len(self._blobs()), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertEqual(self._blobs(), [])
+
+    def test_tokens_are_bound_to_the_uploader(self):
+        token = self._upload().json()['attachment_token']
+        self.client.force_login(self.bob)
+        response = self.client.post('/chat/api/messages/send/', {
+            'receiver_id': self.alice.id, 'text': 'hi', 'attachment_token': token})
+        self.assertEqual(response.status_code, 400)
+
+    def test_conversation_files_index(self):
+        token = self._upload().json()['attachment_token']
+        for i in range(3):
+            self.client.post('/chat/api/messages/send/', {
+                'receiver_id': self.bob.id, 'text': f'copy {i}', 'attachment_token': token})
+        self.client.post('/chat/api/messages/send/', {'receiver_id': self.bob.id, 'text': 'no file'})
+
+        url = f'/chat/api/conversations/user/{self.bob.id}/files/'
+        page = self.client.get(url, {'limit': 2}).json()
+        self.assertEqual((page['count'], page['message_count']), (3, 4))
+        self.assertEqual(len(page['results']), 2)
+        first = page['results'][0]
+        self.assertEqual(first['name'], 'report.pdf')
+        self.assertEqual(first['content_type'], 'application/pdf')
+        self.assertEqual(first['size'], len(b'%PDF-1.4 same bytes'))
+
+        rest = self.client.get(url, {'limit': 2, 'before': page['next_before']}).json()
+        self.assertEqual(len(rest['results']), 1)
+        self.assertIsNone(rest['next_before'])
+
+        carol = User.objects.create_user('carol')
+        project = Project.objects.create(name='p', created_by=self.alice)
+        project.members.add(self.alice)
+        self.client.force_login(carol)
+        response = self.client.get(f'/chat/api/conversations/project/{project.id}/files/')
+        self.assertEqual(response.status_code, 403)
+
+    def test_inline_files_are_written_on_the_io_pool(self):
+        import base64
+        from asgiref.sync import async_to_sync
+        from .consumers import _attach_file, _write_inline_file
+
+        series = metrics.FILE_IO.labels('inline_upload')
+        before = sum(series.counts)
+        data_uri = 'data:text/plain;base64,' + base64.b64encode(b'hello').decode()
+        blob = async_to_sync(_write_inline_file)(data_uri, 'hi.txt', 'text/plain')
+        self.assertEqual(sum(series.counts), before + 1)
+        self.assertEqual(self._blobs(), [os.path.join(self.media.name, blob.name)])
+
+        message = Message(sender=self.alice, receiver=self.bob)
+        message.text = 'inline'
+        message.save()
+        # The DB step only links the blob
+        with mock.patch('django.core.files.storage.FileSystemStorage._save',
+                        side_effect=AssertionError("file written on the DB thread")):
+            _attach_file(message, self.alice, blob, 'hi.txt', None)
+        self.assertEqual(message.attachment.sha256, blob.sha256)
+        self.assertEqual((message.file_name, message.attachment.size), ('hi.txt', 5))
+
+    def test_same_content_under_another_extension_leaves_no_orphan(self):
+        from .utils.uploads import write_blob
+        first, created = Attachment.link(*write_blob(b'same bytes', 'photo.png', 'image/png'))
+        self.assertTrue(created)
+        again, created = Attachment.link(*write_blob(b'same bytes', 'photo.jpeg', 'image/jpeg'))
+        self.assertEqual((again.pk, created), (first.pk, False))
+        self.assertEqual(self._blobs(), [os.path.join(self.media.name, first.blob.name)])
+
+    def test_oversized_uploads_are_refused(self):
+        from .serializers import SerializerConfig
+        with mock.patch.object(SerializerConfig, 'MAX_FILE_SIZE', 10):
+            response = self._upload(b'x' * 100)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self._blobs(), [])
+
+
+@override_settings(THUMBNAIL_WORKERS=0, THUMBNAIL_SIZES=(32, 64))
+class ThumbnailTests(MediaTestCase):
+
+    def _jpeg(self):
+        import io
+        from PIL import Image
+        img = Image.new('RGB', (300, 200), 'red')
+        exif = Image.Exif()
+        exif[0x0112] = 6  # orientation: rotate 90 degrees
+        exif[0x010F] = 'SecretCam'
+        buf = io.BytesIO()
+        img.save(buf, 'JPEG', exif=exif)
+        return buf.getvalue()
+
+    def _send_image(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        upload = SimpleUploadedFile('photo.jpg', self._jpeg(), content_type='image/jpeg')
+        with self.captureOnCommitCallbacks(execute=True):
+            token = self.client.post('/chat/api/attachments/', {'file': upload}).json()['attachment_token']
+        self.client.post('/chat/api/messages/send/',
+                         {'receiver_id': self.bob.id, 'text': 'look', 'attachment_token': token})
+        return Message.objects.get().attachment
+
+    def test_thumbnails_are_webp_oriented_and_stripped(self):
+        from PIL import Image
+        from .utils.thumbnails import thumbnail_name
+        attachment = self._send_image()
+        attachment.refresh_from_db()
+        self.assertEqual((attachment.width, attachment.height), (200, 300))
+        self.assertEqual(attachment.thumbnails, [32, 64])
+        with Image.open(os.path.join(self.media.name, thumbnail_name(attachment.sha256, 64))) as thumb:
+            self.assertEqual(thumb.format, 'WEBP')
+            self.assertEqual(thumb.size, (43, 64))
+            self.assertNotIn('exif', thumb.info)
+
+    def test_serializer_exposes_and_regenerates_thumbnails(self):
+        attachment = self._send_image()
+        attachment.refresh_from_db()
+        attachment.thumbnails = []
+        attachment.save()
+
+        messages = self.client.get(f'/chat/api/messages/user/{self.bob.id}/').json()
+        urls = messages[0]['thumbnail_urls']
+        self.assertEqual(sorted(urls), ['32', '64'])
+        self.assertTrue(urls['32'].endswith(f'{attachment.sha256}_32.webp'))
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.thumbnails, [32, 64])
+
+    def test_undecodable_and_failed_images_are_not_retried_per_request(self):
+        import datetime
+        from django.utils import timezone
+        from .utils import thumbnails
+        svg, _ = store_upload(ContentFile(b'<svg/>', name='logo.svg'), content_type='image/svg+xml')
+        self.assertIsNone(thumbnails.urls(svg))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            broken, _ = store_upload(ContentFile(b'not a jpeg', name='broken.jpg'), content_type='image/jpeg')
+        broken.refresh_from_db()
+        self.assertIsNotNone(broken.thumbnails_failed_at)
+
+        with mock.patch.object(thumbnails, 'render_thumbnails', side_effect=OSError('broken')) as render:
+            self.assertEqual(thumbnails.urls(broken), {})
+            self.assertEqual(thumbnails.urls(svg), None)
+            render.assert_not_called()
+            broken.thumbnails_failed_at = timezone.now() - datetime.timedelta(days=2)
+            thumbnails.urls(broken)
+            render.assert_called_once()
+
+
+class AvatarTests(MediaTestCase):
+
+    def _upload(self, color):
+        import io
+        from PIL import Image
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        buf = io.BytesIO()
+        Image.new('RGB', (300, 200), color).save(buf, 'PNG')
+        upload = SimpleUploadedFile('me.png', buf.getvalue(), content_type='image/png')
+        return self.client.post('/chat/api/users/upload_avatar/', {'avatar': upload})
+
+    def test_avatars_are_square_webp_under_hashed_names(self):
+        from PIL import Image
+        from .serializers import UserSerializer
+        from .utils.avatars import AVATAR_SIZES
+
+        urls = self._upload('red').json()['avatar_urls']
+        self.assertEqual(sorted(urls, key=int), [str(s) for s in AVATAR_SIZES])
+        self.assertEqual(len(self._blobs()), len(AVATAR_SIZES))
+        for path in self._blobs():
+            with Image.open(path) as img:
+                self.assertEqual(img.format, 'WEBP')
+                self.assertEqual(img.size[0], img.size[1])
+                self.assertIn(f'_{img.size[0]}.webp', path)
+
+        profile = UserSerializer(User.objects.get(pk=self.alice.pk)).data['profile']
+        self.assertEqual(profile['avatar'], profile['avatars'][str(AVATAR_SIZES[0])])
+        self.assertTrue(urls[str(AVATAR_SIZES[0])].endswith(profile['avatar']))
+
+        response = self.client.get(profile['avatar'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+
+    def test_new_avatar_gets_new_urls_and_old_files_go(self):
+        first = self._upload('red').json()['avatar_url']
+        second = self._upload('blue').json()['avatar_url']
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(self._blobs()), 2)
+
+    def test_non_images_are_refused(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        upload = SimpleUploadedFile('me.png', b'not an image', content_type='image/png')
+        response = self.client.post('/chat/api/users/upload_avatar/', {'avatar': upload})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self._blobs(), [])
+
+
+class MediaViewTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.carol = User.objects.create_user('carol')
+        self.body = bytes(range(256)) * 40  # 10240 bytes
+        content = ContentFile(self.body, name='clip.pdf')
+        attachment, _ = store_upload(content, content_type='application/pdf')
+        message = Message(sender=self.alice, receiver=self.bob)
+        message.text = 'clip'
+        message.save()
+        message.attach(attachment)
+        self.url = '/media/' + attachment.blob.name
+        self.sha = attachment.sha256
+
+    async def _get(self, user, **headers):
+        await sync_to_async(self.async_client.force_login)(user)
+        return await self.async_client.get(
+            self.url, headers={k.replace('_', '-'): v for k, v in headers.items()})
+
+    async def _body(self, response):
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    async def test_members_get_the_file_others_do_not(self):
+        response = await self._get(self.bob)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await self._body(response), self.body)
+        self.assertEqual(response['ETag'], f'"{self.sha}"')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+
+        self.assertEqual((await self._get(self.carol)).status_code, 404)
+        await sync_to_async(self.async_client.logout)()
+        self.assertEqual((await self.async_client.get(self.url)).status_code, 403)
+
+    async def test_conditional_requests(self):
+        self.assertEqual((await self._get(self.alice, If_None_Match=f'"{self.sha}"')).status_code, 304)
+        self.assertEqual((await self._get(self.alice, If_None_Match='"other"')).status_code, 200)
+
+    async def test_byte_ranges(self):
+        response = await self._get(self.alice, Range='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 100-199/10240')
+        self.assertEqual(await self._body(response), self.body[100:200])
+
+        response = await self._get(self.alice, Range='bytes=-10')
+        self.assertEqual(await self._body(response), self.body[-10:])
+
+        response = await self._get(self.alice, Range='bytes=99999-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10240')
+
+        response = await self._get(self.alice, Range='bytes=0-9', If_Range='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(MEDIA_X_ACCEL_REDIRECT_PREFIX='/protected-media/')
+    async def test_proxy_handoff(self):
+        response = await self._get(self.bob)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media' + self.url[len('/media'):])
+        self.assertEqual(response.content, b'')
+
+    async def test_path_traversal_is_rejected(self):
+        await sync_to_async(self.async_client.force_login)(self.alice)
+        response = await self.async_client.get('/media/avatars/../../manage.py')
+        self.assertEqual(response.status_code, 404)
+
+    async def test_dot_segments_cannot_reach_other_conversations(self):
+        legacy = await sync_to_async(Message.objects.create)(
+            sender=self.alice, receiver=self.bob, file=ContentFile(b'private', name='notes.txt'))
+        await sync_to_async(self.async_client.force_login)(self.carol)
+        for target in (legacy.file.name, self.url[len('/media/'):]):
+            for path in (f'avatars/../{target}', f'avatars/./../{target}', f'avatars//../{target}'):
+                response = await self.async_client.get('/media/' + path)
+                self.assertEqual(response.status_code, 404, path)
+
+
+# ====================== COLD ARCHIVE ======================
+
+class ArchiveTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        import datetime
+        from django.utils import timezone
+        self.carol = User.objects.create_user('carol')
+        self.old_timestamp = old = timezone.now() - datetime.timedelta(days=500)
+        self.old = []
+        for i in range(4):
+            msg = Message(sender=self.bob if i % 2 else self.alice, receiver=self.alice if i % 2 else self.bob)
+            msg.text = f'old word{i}'
+            msg.save()
+            self.old.append(msg)
+        attachment, _ = store_upload(ContentFile(b'%PDF old', name='old.pdf'), content_type='application/pdf')
+        self.old[0].attach(attachment, 'old.pdf')
+        self.blob = attachment.blob.name
+        Message.objects.filter(id__in=[m.id for m in self.old]).update(timestamp=old)
+        self.hot = []
+        for i in range(3):
+            msg = Message(sender=self.bob, receiver=self.alice)
+            msg.text = f'hot {i}'
+            msg.save()
+            self.hot.append(msg)
+
+    def history(self, **params):
+        response = self.client.get(f'/chat/api/messages/user/{self.bob.id}/', params)
+        self.assertEqual(response.status_code, 200)
+        return [m['text'] for m in response.json()]
+
+    def test_old_months_move_to_cold_files_and_stay_readable(self):
+        from .media import _authorize
+        from .models import MessageArchive
+        out = io.StringIO()
+        call_command('archive_messages', '--older-than', '3', stdout=out)
+        self.assertIn('archived 4 message(s)', out.getvalue())
+        self.assertEqual(Message.objects.count(), 3)
+        self.assertFalse(MessageSearchToken.objects.filter(message_id__in=[m.id for m in self.old]).exists())
+        archived = MessageArchive.objects.get()
+        self.assertEqual((archived.message_count, archived.first_id), (4, self.old[0].id))
+        with open(os.path.join(self.media.name, archived.path), 'rb') as f:
+            self.assertNotIn(b'old word', gzip.decompress(f.read()))  # bodies still encrypted
+
+        # No cursor: the live table only. Paging continues into the archive.
+        self.assertEqual(self.history(), ['hot 0', 'hot 1', 'hot 2'])
+        self.assertEqual(self.history(limit=2), ['hot 1', 'hot 2'])
+        page = self.client.get(f'/chat/api/messages/user/{self.bob.id}/',
+                               {'limit': 3, 'before': self.hot[1].id}).json()
+        self.assertEqual([m['text'] for m in page], ['old word2', 'old word3', 'hot 0'])
+        self.assertEqual(page[0]['sender_username'], 'alice')
+        first = self.client.get(f'/chat/api/messages/user/{self.bob.id}/',
+                                {'limit': 10, 'before': self.old[2].id}).json()
+        self.assertEqual([m['file_name'] for m in first], ['old.pdf', ''])
+
+        # The archived attachment stays viewable by the conversation only
+        self.assertEqual(Attachment.objects.get().ref_count, 1)
+        self.assertIsNone(_authorize(self.bob, self.blob)[0])
+        self.assertEqual(_authorize(self.carol, self.blob)[0], 404)
+
+        call_command('archive_messages', '--older-than', '3', stdout=io.StringIO())
+        self.assertEqual(MessageArchive.objects.get().message_count, 4)
+
+    def test_paging_follows_ids_when_timestamps_disagree(self):
+        import datetime
+        # Imported: newest id, oldest timestamp
+        imported = Message(sender=self.alice, receiver=self.bob)
+        imported.text = 'imported'
+        imported.save()
+        Message.objects.filter(id=imported.id).update(
+            timestamp=Message.objects.get(id=self.old[0].id).timestamp - datetime.timedelta(days=1))
+
+        seen, before = [], None
+        while True:
+            params = {'limit': 2, **({'before': before} if before else {})}
+            page = self.client.get(f'/chat/api/messages/user/{self.bob.id}/', params).json()
+            if not page:
+                break
+            seen = [m['id'] for m in page] + seen
+            before = page[0]['id']
+        self.assertEqual(seen, [m.id for m in self.old + self.hot] + [imported.id])
+
+    def add_old(self, text):
+        msg = Message(sender=self.alice, receiver=self.bob)
+        msg.text = text
+        msg.save()
+        Message.objects.filter(id=msg.id).update(timestamp=self.old_timestamp)
+        return msg
+
+    def test_rerun_writes_a_new_file_and_deletes_the_old_one_after_commit(self):
+        from .models import MessageArchive
+        from .utils import archive
+        call_command('archive_messages', '--older-than', '3', stdout=io.StringIO())
+        first = MessageArchive.objects.get().path
+        late = self.add_old('late')
+
+        with mock.patch.object(archive, '_remove_rows', side_effect=RuntimeError('crash')):
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertRaises(RuntimeError):
+                    call_command('archive_messages', '--older-than', '3', stdout=io.StringIO())
+        # Merged file recorded under a new name, the old one gone only now
+        second = MessageArchive.objects.get()
+        self.assertNotEqual(second.path, first)
+        self.assertFalse(default_storage.exists(first))
+        self.assertEqual([row['id'] for row in archive._read_file(second.path)],
+                         [m.id for m in self.old] + [late.id])
+
+        with mock.patch.object(archive, '_write_file', side_effect=OSError('disk full')):
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertRaises(OSError):
+                    call_command('archive_messages', '--older-than', '3', stdout=io.StringIO())
+        self.assertEqual(MessageArchive.objects.get().path, second.path)
+        self.assertTrue(default_storage.exists(second.path))
+
+    def test_rows_added_during_the_scan_are_kept(self):
+        from .models import MessageArchive
+        from .utils import archive
+        store, added = archive._store, []
+
+        def store_and_import(*args):
+            if not added:
+                added.append(self.add_old('imported'))
+            return store(*args)
+
+        with mock.patch.object(archive, '_store', side_effect=store_and_import):
+            call_command('archive_messages', '--older-than', '3', stdout=io.StringIO())
+        self.assertEqual(MessageArchive.objects.get().message_count, 4)
+        self.assertTrue(Message.objects.filter(id=added[0].id).exists())
+        self.assertEqual(Message.objects.count(), 4)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "partitioning needs PostgreSQL")
+class MessagePartitionTests(TestCase):
+    """utils/partitions.py against the test database's own chat_message"""
+
+    def message(self, text, timestamp=None):
+        msg = Message(sender=self.alice, receiver=self.bob)
+        msg.text = text
+        msg.save()
+        if timestamp is not None:
+            Message.objects.filter(id=msg.id).update(timestamp=timestamp)
+        return msg
+
+    def count(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM "{table}"')
+            return cursor.fetchone()[0]
+
+    def test_convert_insert_create_and_drop(self):
+        import datetime
+        from .utils import partitions
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        now = datetime.datetime.now(datetime.timezone.utc)
+        old_month = partitions.month_start(now - datetime.timedelta(days=62))
+        old = self.message('old', old_month + datetime.timedelta(days=1))
+        recent = self.message('recent')
+
+        self.assertEqual(partitions.partition_table(connection), 2)
+        self.assertTrue(partitions.is_partitioned())
+        self.assertIsNone(partitions.partition_table(connection))
+        months = partitions.partitions()
+        self.assertEqual(self.count(months[old_month]), 1)
+        self.assertEqual(Message.objects.get(id=old.id).text, 'old')
+
+        # New rows continue the id sequence and reference the same users
+        fresh = self.message('fresh')
+        self.assertGreater(fresh.id, recent.id)
+        self.assertEqual(Message.objects.filter(sender=self.alice).count(), 3)
+
+        # A month without a partition lands in the default one...
+        future = partitions.month_start(now + datetime.timedelta(days=400))
+        later = self.message('later', future + datetime.timedelta(days=3))
+        self.assertEqual(self.count(partitions.DEFAULT_PARTITION), 1)
+        # ...and moves when its partition is created
+        self.assertTrue(partitions.create_partition(future))
+        self.assertFalse(partitions.create_partition(future))
+        self.assertEqual(self.count(partitions.DEFAULT_PARTITION), 0)
+        self.assertEqual(self.count(partitions.partition_name(future)), 1)
+        self.assertEqual(Message.objects.get(id=later.id).text, 'later')
+
+        self.assertTrue(partitions.drop_partition(future))
+        self.assertFalse(partitions.drop_partition(future))
+        self.assertNotIn(future, partitions.partitions())
+        self.assertFalse(Message.objects.filter(id=later.id).exists())
+        self.assertEqual(Message.objects.count(), 3)
+
+
+# ====================== EXPORT / IMPORT ======================
+
+class ExportImportTests(MediaTestCase):
+
+    def test_round_trip_into_an_emptied_database(self):
+        from .utils.search_index import digest
+        hello = Message(sender=self.alice, receiver=self.bob)
+        hello.text = 'hello world'
+        hello.save()
+        reply = Message(sender=self.bob, receiver=self.alice, reply_to=hello)
+        reply.text = 'hi alice'
+        reply.save()
+        project = Project.objects.create(name='apollo', created_by=self.alice)
+        project.members.add(self.alice, self.bob)
+        report = Message.objects.create(sender=self.alice, project=project)
+        attachment, _ = store_upload(ContentFile(b'%PDF export', name='plan.pdf'), content_type='application/pdf')
+        report.attach(attachment, 'plan.pdf')
+        stamps = list(Message.objects.order_by('id').values_list('timestamp', flat=True))
+
+        export = tempfile.TemporaryDirectory()
+        self.addCleanup(export.cleanup)
+        out = io.StringIO()
+        call_command('export_chats', export.name, '--workers', '0', '--batch-size', '2', stdout=out)
+        self.assertIn('Exported 3 message(s), 1 attachment(s)', out.getvalue())
+        with open(os.path.join(export.name, 'messages.jsonl')) as f:
+            self.assertIn('hello world', f.read())
+
+        Message.objects.all().delete()
+        Attachment.objects.all().delete()
+        project.delete()
+        self.bob.delete()
+
+        out = io.StringIO()
+        call_command('import_chats', export.name, '--workers', '0', '--batch-size', '2', stdout=out)
+        self.assertIn('Imported 3 message(s)', out.getvalue())
+        bob = User.objects.get(username='bob')
+        self.assertFalse(bob.has_usable_password())
+        project = Project.objects.get(name='apollo')
+        self.assertEqual(set(project.members.values_list('username', flat=True)), {'alice', 'bob'})
+
+        hello, reply, report = Message.objects.order_by('id')
+        self.assertEqual([hello.text, reply.text], ['hello world', 'hi alice'])
+        self.assertEqual((reply.reply_to_id, reply.sender, reply.conversation_key),
+                         (hello.id, bob, hello.conversation_key))
+        self.assertEqual([hello.timestamp, reply.timestamp, report.timestamp], stamps)
+        self.assertTrue(MessageSearchToken.objects.filter(message=hello, digest=digest('hello')).exists())
+        self.assertEqual((report.project, report.file_name, report.attachment.ref_count),
+                         (project, 'plan.pdf', 1))
+        with report.file.open('rb') as f:
+            self.assertEqual(f.read(), b'%PDF export')
+
+    def test_legacy_file_never_reuses_an_unrelated_local_file(self):
+        from django.core.files.storage import default_storage
+        legacy = Message.objects.create(sender=self.alice, receiver=self.bob,
+                                        file=ContentFile(b'exported notes', name='notes.txt'))
+        name = legacy.file.name
+        export = tempfile.TemporaryDirectory()
+        self.addCleanup(export.cleanup)
+        call_command('export_chats', export.name, '--workers', '0', stdout=io.StringIO())
+
+        # The target already has a different file under the same name
+        Message.objects.all().delete()
+        default_storage.save(name, ContentFile(b'someone else'))
+        call_command('import_chats', export.name, '--workers', '0', stdout=io.StringIO())
+
+        imported = Message.objects.get()
+        self.assertNotEqual(imported.file.name, name)
+        with imported.file.open('rb') as f:
+            self.assertEqual(f.read(), b'exported notes')
+        with default_storage.open(name) as f:
+            self.assertEqual(f.read(), b'someone else')
+
+
+# ====================== RETENTION ======================
+
+class RetentionTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        import datetime
+        from django.utils import timezone
+        self.old = []
+        for i in range(3):
+            msg = Message(sender=self.alice, receiver=self.bob)
+            msg.text = f'old {i}'
+            msg.save()
+            self.old.append(msg)
+        self.only_old, _ = store_upload(ContentFile(b'%PDF only old', name='a.pdf'), content_type='application/pdf')
+        self.shared, _ = store_upload(ContentFile(b'%PDF shared', name='b.pdf'), content_type='application/pdf')
+        self.old[0].attach(self.only_old, 'a.pdf')
+        self.old[1].attach(self.shared, 'b.pdf')
+        self.old[2].file.save('notes.txt', ContentFile(b'legacy'))
+        Message.objects.filter(id__in=[m.id for m in self.old]).update(
+            timestamp=timezone.now() - datetime.timedelta(days=40))
+
+        self.hot = Message(sender=self.bob, receiver=self.alice, reply_to=self.old[0])
+        self.hot.text = 'recent'
+        self.hot.save()
+        self.hot.attach(self.shared, 'b.pdf')
+        project = Project.objects.create(name='keep', created_by=self.alice)
+        self.other = Message.objects.create(sender=self.alice, project=project)
+        Message.objects.filter(id=self.other.id).update(timestamp=timezone.now() - datetime.timedelta(days=400))
+
+    def test_purge_deletes_expired_rows_in_batches_and_their_files(self):
+        from .models import RetentionPolicy
+        from .utils import retention
+        policy = RetentionPolicy.for_dm(self.bob, self.alice, keep_days=30)
+        out = io.StringIO()
+        call_command('purge_messages', '--dry-run', stdout=out)
+        self.assertIn('would purge 3 message(s)', out.getvalue())
+        self.assertEqual(Message.objects.count(), 5)
+
+        blobs = len(self._blobs())
+        reaper = retention.FileReaper()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(retention.purge(policy, batch_size=2, reaper=reaper), 3)
+        reaper.close()
+
+        self.assertEqual(set(Message.objects.values_list('id', flat=True)), {self.hot.id, self.other.id})
+        self.assertFalse(MessageSearchToken.objects.filter(message_id__in=[m.id for m in self.old]).exists())
+        self.hot.refresh_from_db()
+        self.assertIsNone(self.hot.reply_to_id)
+        self.assertFalse(Attachment.objects.filter(id=self.only_old.id).exists())
+        self.assertEqual(Attachment.objects.get(id=self.shared.id).ref_count, 1)
+        self.assertEqual((reaper.deleted, len(self._blobs())), (2, blobs - 2))
+        policy.refresh_from_db()
+        self.assertEqual(policy.purged_count, 3)
+        self.assertIsNotNone(policy.last_purged_at)
+
+
+# ====================== CONSUMER DB EXECUTOR ======================
+
+class _ProbeConsumer(consumers.InstrumentedConsumer):
+    metrics_label = 'test'
+
+    @consumers.db_thread
+    def probe(self, delay=0.0):
+        import threading
+        import time
+        time.sleep(delay)
+        User.objects.exists()
+        return threading.current_thread().name
+
+
+# SQLite (and its shared-cache test database) fails concurrent writers at once
+needs_concurrent_writes = unittest.skipIf(
+    connection.vendor == 'sqlite', "needs a database with concurrent writers (DATABASE_URL=postgres://...)")
+
+
+class ConsumerDBPoolTests(TransactionTestCase):
+    """consumers.db_thread on the shared thread vs. a CONSUMER_DB_THREADS pool"""
+
+    def setUp(self):
+        self.addCleanup(db_executor.shutdown)
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+
+    def _consumer(self, cls=consumers.ChatConsumer):
+        consumer = cls()
+        consumer.user = self.alice
+        return consumer
+
+    async def _gather(self, calls):
+        return await asyncio.gather(*calls)
+
+    @override_settings(CONSUMER_DB_THREADS=0)
+    def test_zero_runs_everything_on_one_thread(self):
+        probe = self._consumer(_ProbeConsumer)
+        results = async_to_sync(self._gather)([probe.probe() for _ in range(4)])
+        self.assertEqual(len(set(results)), 1)
+
+    @override_settings(CONSUMER_DB_THREADS=4)
+    def test_pool_runs_calls_concurrently(self):
+        import time
+        probe = self._consumer(_ProbeConsumer)
+        start = time.perf_counter()
+        results = async_to_sync(self._gather)([probe.probe(0.2) for _ in range(8)])
+        self.assertLess(time.perf_counter() - start, 0.2 * 8 / 2)
+        names = set(results)
+        self.assertEqual(len(names), 4)
+        self.assertTrue(all(name.startswith('chat-db') for name in names))
+
+    @override_settings(CONSUMER_DB_THREADS=2)
+    def test_pooled_connections_are_aged_on_the_worker(self):
+        import threading
+        from django.db import close_old_connections
+        threads = []
+
+        def record():
+            threads.append(threading.current_thread().name)
+            close_old_connections()
+
+        with mock.patch('channels.db.close_old_connections', record):
+            name = async_to_sync(self._consumer(_ProbeConsumer).probe)()
+        # Checked before and after the call, on the worker that owns the connection
+        self.assertEqual(threads, [name, name])
+
+    @needs_concurrent_writes
+    @override_settings(CONSUMER_DB_THREADS=4)
+    def test_concurrent_saves_are_all_persisted(self):
+        consumer = self._consumer()
+        saved = async_to_sync(self._gather)([
+            consumer._save_message(self.bob.id, f'parallel word{i}') for i in range(20)])
+        self.assertTrue(all(saved))
+        self.assertEqual(Message.objects.count(), 20)
+        self.assertEqual(len({m.id for m in saved}), 20)
+        self.assertEqual(MessageSearchToken.objects.values('message').distinct().count(), 20)
+
+    @needs_concurrent_writes
+    @override_settings(CONSUMER_DB_THREADS=4)
+    def test_concurrent_links_of_one_blob_share_an_attachment(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        with override_settings(MEDIA_ROOT=media.name):
+            from .utils.uploads import write_blob
+            blob = write_blob(b'same bytes', 'a.txt', 'text/plain')
+            consumer = self._consumer()
+            saved = async_to_sync(self._gather)([
+                consumer._save_message(self.bob.id, f'copy {i}', blob=blob, file_name='a.txt')
+                for i in range(10)])
+        self.assertTrue(all(saved))
+        attachment = Attachment.objects.get()
+        self.assertEqual(attachment.ref_count, 10)
+        self.assertEqual(attachment.messages.count(), 10)
+
+    @needs_concurrent_writes
+    @override_settings(CONSUMER_DB_THREADS=4)
+    def test_concurrent_presence_updates_do_not_clobber_the_profile(self):
+        from .models import UserProfile
+        consumer = self._consumer()
+        UserProfile.objects.filter(user=self.alice).update(avatar='avatars/new.webp')
+        async_to_sync(self._gather)([consumer.set_user_online(i % 2 == 0) for i in range(6)])
+        self.assertEqual(UserProfile.objects.get(user=self.alice).avatar.name, 'avatars/new.webp')
+
+
+# ====================== DB CONNECTION POOL ======================
+
+class _FakeConn:
+    """Just enough of a psycopg2 connection for ConnectionPool"""
+
+    def __init__(self):
+        self.closed = 0
+        self.status = 0
+        self.fail_ping = False
+        self.rollbacks = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = 0
+
+    def cursor(self):
+        conn = self
+
+        class _Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def execute(self, sql):
+                if conn.fail_ping:
+                    raise RuntimeError("server closed the connection unexpectedly")
+
+        return _Cursor()
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTests(SimpleTestCase):
+
+    def make_pool(self, **kwargs):
+        from .dbpool import ConnectionPool
+        self.opened = []
+
+        def connect():
+            conn = _FakeConn()
+            self.opened.append(conn)
+            return conn
+
+        kwargs.setdefault('ping_after', 0)
+        return ConnectionPool(connect, alias='test', **kwargs)
+
+    def test_reuses_returned_connections_up_to_size(self):
+        pool = self.make_pool(size=2, timeout=0.05)
+        first = pool.getconn()
+        pool.putconn(first)
+        self.assertIs(pool.getconn(), first)
+        pool.getconn()
+        self.assertEqual(len(self.opened), 2)
+
+        from .dbpool import PoolTimeout
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        self.assertEqual(pool.stats('events')[('test', 'timeout')], 1)
+        self.assertEqual(pool.stats('connections')[('test', 'in_use')], 2)
+
+    def test_waiter_gets_the_next_returned_connection(self):
+        import threading
+        pool = self.make_pool(size=1, timeout=2)
+        held = pool.getconn()
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(pool.getconn()))
+        waiter.start()
+        pool.putconn(held)
+        waiter.join(2)
+        self.assertEqual(got, [held])
+
+    def test_failed_health_check_recycles_every_idle_connection(self):
+        pool = self.make_pool(size=3)
+        conns = [pool.getconn() for _ in range(3)]
+        for conn in conns:
+            pool.putconn(conn)
+        for conn in conns:
+            conn.fail_ping = True  # the server went away
+
+        fresh = pool.getconn()
+        self.assertNotIn(fresh, conns)
+        self.assertTrue(all(conn.closed for conn in conns))
+        self.assertEqual(pool.stats('connections')[('test', 'idle')], 0)
+        self.assertEqual(pool.stats('events')[('test', 'recycled')], 3)
+
+    def test_open_transactions_are_rolled_back_and_broken_connections_closed(self):
+        pool = self.make_pool(size=2)
+        dirty, broken = pool.getconn(), pool.getconn()
+        dirty.status = 3  # TRANSACTION_STATUS_INERROR
+        broken.status = 4  # TRANSACTION_STATUS_UNKNOWN
+        pool.putconn(dirty)
+        pool.putconn(broken)
+        self.assertEqual(dirty.rollbacks, 1)
+        self.assertFalse(dirty.closed)
+        self.assertTrue(broken.closed)
+        self.assertIs(pool.getconn(), dirty)
+
+    def test_connections_past_max_lifetime_are_replaced(self):
+        pool = self.make_pool(size=1, max_lifetime=0)
+        old = pool.getconn()
+        pool.putconn(old)
+        self.assertTrue(old.closed)
+        self.assertIsNot(pool.getconn(), old)
+
+    def test_wait_and_utilization_are_exported(self):
+        from . import dbpool
+        pool = self.make_pool(size=1)
+        key = ('test', ('fake', 'params'))
+        dbpool.pools[key] = pool
+        self.addCleanup(dbpool.pools.pop, key)
+        pool.getconn()
+        text = metrics.render_text()
+        self.assertIn('chat_db_pool_wait_seconds_count{alias="test"', text)
+        self.assertIn('chat_db_pool_connections{alias="test",state="in_use"', text)
+
+
+@unittest.skipUnless(PG_TEST_DSN, "set CHANNELS_PG_TEST_DSN to run against Postgres")
+class ConnectionPoolPostgresTests(SimpleTestCase):
+    """Failover: a backend killed server-side is detected and replaced"""
+
+    def test_terminated_backend_is_replaced(self):
+        import psycopg2
+        from .dbpool import ConnectionPool
+        pool = ConnectionPool(lambda: psycopg2.connect(PG_TEST_DSN), size=2,
+                              ping_after=0, alias='pgtest')
+        conn = pool.getconn()
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_backend_pid()")
+            pid = cursor.fetchone()[0]
+        conn.rollback()
+        pool.putconn(conn)
+
+        killer = psycopg2.connect(PG_TEST_DSN)
+        with killer, killer.cursor() as cursor:
+            cursor.execute("SELECT pg_terminate_backend(%s)", [pid])
+        killer.close()
+
+        fresh = pool.getconn()
+        with fresh.cursor() as cursor:
+            cursor.execute("SELECT pg_backend_pid()")
+            self.assertNotEqual(cursor.fetchone()[0], pid)
+        fresh.rollback()
+        pool.putconn(fresh)
+        pool.close_all()
+        self.assertEqual(pool.stats('events')[('pgtest', 'recycled')], 2)
+
+
+# ====================== READ REPLICAS ======================
+
+@override_settings(READ_REPLICAS=['replica'], REPLICA_STICKY_SECONDS=30)
+class ReplicaRoutingTests(TestCase):
+    """
+    'replica' is a second in-memory database that only sees what
+    replicate() copies. It is added for this class only, so the runner
+    does not know it.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        from django.db import connections
+        cls.databases = {'default', 'replica'}
+        connections.settings.update(connections.configure_settings({
+            'default': connections.settings['default'],
+            'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'},
+        }))
+        call_command('migrate', database='replica', verbosity=0, interactive=False)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        from django.db import connections
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+
+    def setUp(self):
+        from django.core.cache import cache
+        from .models import UserProfile
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.replicate(self.alice, self.bob, *UserProfile.objects.all())
+        self.client.force_login(self.alice)
+
+    def replicate(self, *objs):
+        import copy
+        for obj in objs:
+            type(obj).objects.using('replica').bulk_create([copy.copy(obj)])
+
+    def message(self, sender, receiver, text):
+        msg = Message(sender=sender, receiver=receiver)
+        msg.text = text
+        msg.save()
+        return msg
+
+    def history(self):
+        response = self.client.get(f'/chat/api/messages/user/{self.bob.id}/')
+        return [m['text'] for m in response.json()]
+
+    def test_history_reads_lag_behind_on_the_replica(self):
+        self.replicate(self.message(self.bob, self.alice, 'replicated'))
+        self.message(self.bob, self.alice, 'not yet replicated')
+        self.assertEqual(self.history(), ['replicated'])
+        # Mark-as-read went to the primary, not the replica it was read from
+        self.assertEqual(Message.objects.using('default').filter(is_read=True).count(), 2)
+        self.assertFalse(Message.objects.using('replica').filter(is_read=True).exists())
+
+    def test_sender_reads_own_message_from_the_primary(self):
+        from django.core.cache import cache
+        self.replicate(self.message(self.bob, self.alice, 'hi'))
+        self.message(self.alice, self.bob, 'my reply')
+        self.assertEqual(self.history(), ['hi', 'my reply'])
+
+        cache.clear()  # the sticky window is over
+        self.assertEqual(self.history(), ['hi'])
+
+    def test_sidebar_and_user_search_use_the_replica(self):
+        carol = User.objects.create_user('carol')  # only on the primary
+        self.replicate(self.message(self.bob, self.alice, 'hello'))
+        self.message(carol, self.alice, 'unreplicated')
+
+        chats = self.client.get('/chat/api/messages/recent_chats/').json()
+        self.assertEqual([c['user']['id'] for c in chats if c['type'] == 'user'], [self.bob.id])
+        found = self.client.get('/chat/api/users/search/', {'q': 'carol'}).json()
+        self.assertEqual(found, [])
+
+    def test_replica_queries_are_timed(self):
+        seen, timer_call = [], metrics._QueryTimer.__call__
+
+        def record(timer, execute, sql, params, many, context):
+            seen.append(context['connection'].alias)
+            return timer_call(timer, execute, sql, params, many, context)
+
+        self.replicate(self.message(self.bob, self.alice, 'hello'))
+        with mock.patch.object(metrics._QueryTimer, '__call__', record):
+            self.assertEqual(self.history(), ['hello'])
+        self.assertEqual(set(seen), {'default', 'replica'})
+
+
+# ====================== SQLITE EMBEDDED MODE ======================
+
+class SQLiteWriterTests(TransactionTestCase):
+
+    def setUp(self):
+        from .utils.sqlite_mode import WriterQueue
+        self.writer = WriterQueue(max_batch=10)
+        self.addCleanup(self.writer.stop)
+
+    def test_queued_writes_commit_together(self):
+        import threading
+        release = threading.Event()
+        first = self.writer.submit(release.wait, 5)
+        futures = [self.writer.submit(User.objects.create, username=f'u{i}') for i in range(5)]
+        batches = metrics.SQLITE_WRITE_BATCH.labels()
+        count, total = sum(batches.counts), batches.sum
+        release.set()
+        self.assertTrue(first.result(5))
+        self.assertEqual([f.result(5).username for f in futures], [f'u{i}' for i in range(5)])
+        self.assertEqual((sum(batches.counts) - count, batches.sum - total), (2, 6))
+
+    def test_a_failing_job_rolls_back_alone(self):
+        def create_then_fail():
+            User.objects.create(username='b')
+            raise ValueError("boom")
+
+        futures = [self.writer.submit(User.objects.create, username='a'),
+                   self.writer.submit(create_then_fail),
+                   self.writer.submit(User.objects.create, username='c')]
+        with self.assertRaises(ValueError):
+            futures[1].result(5)
+        futures[2].result(5)
+        self.assertEqual(sorted(User.objects.values_list('username', flat=True)), ['a', 'c'])
+
+    @override_settings(SQLITE_EMBEDDED=True)
+    def test_file_databases_get_wal_and_pragmas(self):
+        from django.db.backends.sqlite3.base import DatabaseWrapper
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        wrapper = DatabaseWrapper({**connection.settings_dict,
+                                   'NAME': os.path.join(directory.name, 'db.sqlite3')}, 'embedded')
+        self.addCleanup(wrapper.close)
+        with wrapper.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], 5000)
+
+
+# ====================== USER CARDS ======================
+
+class UserCardCacheTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.carol = User.objects.create_user('carol')
+        self.client.force_login(self.alice)
+
+    def _profile_queries(self, url):
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            data = self.client.get(url).json()
+        return data, sum('chat_userprofile' in q['sql'] for q in queries)
+
+    def test_lists_build_cards_only_for_misses(self):
+        # One query for presence, plus one building the missing cards
+        users, first = self._profile_queries('/chat/api/users/')
+        self.assertEqual((len(users), first), (3, 2))
+        users, second = self._profile_queries('/chat/api/users/')
+        self.assertEqual((len(users), second), (3, 1))
+
+        self.bob.first_name = 'Bob'
+        self.bob.save()
+        users, third = self._profile_queries('/chat/api/users/')
+        self.assertEqual(third, 2)
+        self.assertEqual(next(u for u in users if u['username'] == 'bob')['first_name'], 'Bob')
+        self.assertGreater(metrics.USER_CARD_LOOKUPS.callback()[('hit',)], 0)
+
+    def test_presence_is_read_fresh_not_cached(self):
+        from .utils import user_cards
+        self.client.get('/chat/api/users/')
+        profile = self.bob.profile
+        profile.is_online = True
+        with mock.patch.object(user_cards, 'bump') as bump:
+            profile.save(update_fields=['is_online', 'last_seen'])
+        bump.assert_not_called()
+        users, queries = self._profile_queries('/chat/api/users/')
+        self.assertEqual(queries, 1)
+        self.assertTrue(next(u for u in users if u['username'] == 'bob')['profile']['is_online'])
+
+    def test_sidebar_fetches_every_card_in_one_round_trip(self):
+        from .utils import user_cards
+        Message.objects.create(sender=self.bob, receiver=self.alice)
+        project = Project.objects.create(name='apollo', created_by=self.alice)
+        project.members.add(self.alice, self.bob, self.carol)
+        with mock.patch.object(user_cards, 'get_many', wraps=user_cards.get_many) as get_many:
+            items = self.client.get('/chat/api/messages/recent_chats/').json()
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual({u['username'] for u in items[0]['project']['members']}, {'alice', 'bob', 'carol'})
+        self.assertEqual(items[1]['user']['username'], 'bob')
+
+
+# ====================== FAST READ PATHS ======================
+
+class FastSerializerGoldenTests(MediaTestCase):
+    """The plain-Python read paths must render exactly what the DRF serializers do"""
+
+    def setUp(self):
+        super().setUp()
+        from django.test import RequestFactory
+        from .models import Meeting
+        from .utils.thumbnails import sizes
+        self.request = RequestFactory().get('/chat/api/messages/')
+        self.project = Project.objects.create(name='apollo', description=None, created_by=self.alice)
+        self.project.members.add(self.alice, self.bob)
+        orphan = Project.objects.create(name='orphan', description='no creator')
+        orphan.members.add(self.alice)
+
+        hello = Message(sender=self.alice, receiver=self.bob)
+        hello.text = 'hello'
+        hello.save()
+        reply = Message(sender=self.bob, receiver=self.alice, reply_to=hello, is_read=True)
+        reply.text = 'hi'
+        reply.save()
+        picture = Message.objects.create(sender=self.alice, project=self.project)
+        image = Attachment.objects.create(sha256='ab' * 32, blob='attachments/ab/ab/pic.png', size=3,
+                                          content_type='image/png', thumbnails=list(sizes()))
+        picture.attach(image, 'pic.png')
+        legacy = Message.objects.create(sender=self.bob, project=self.project)
+        legacy.file.save('notes.txt', ContentFile(b'legacy'))
+        for ended in (False, True):
+            meeting = Meeting.objects.create(host=self.alice, title='standup', ended=ended)
+            invite = Message(sender=self.alice, receiver=self.bob, meeting=meeting,
+                             kind=Message.KIND_MEETING_INVITE)
+            invite.text = f'[MEETING_INVITE] {{"id": "{meeting.id}"}}'
+            invite.save()
+
+    def _messages(self):
+        return list(Message.objects.select_related('meeting', 'attachment').order_by('id'))
+
+    def test_message_rows_match_message_serializer(self):
+        from .serializers import MessageSerializer, message_data
+        for request in (self.request, None):
+            expected = MessageSerializer(self._messages(), many=True, context={'request': request}).data
+            messages = self._messages()
+            with self.assertNumQueries(2):  # usernames, project names
+                actual = message_data(messages, request)
+            self.assertEqual(json.dumps(actual), json.dumps(expected))
+        # The fixture covers every optional branch
+        self.assertEqual([m['meeting_status'] for m in expected][-2:], ['active', 'ended'])
+        self.assertIsNotNone(expected[2]['thumbnail_urls'])
+        self.assertEqual((expected[1]['reply_to_id'], expected[3]['file_name']), (expected[0]['id'], '4_2.txt'))
+
+    def test_sidebar_rows_match_sidebar_serializer(self):
+        from .serializers import SidebarItemSerializer, sidebar_data
+        from django.utils import timezone
+        projects = list(Project.objects.select_related('created_by').prefetch_related('members').order_by('id'))
+        items = [
+            {'type': 'user', 'user': self.bob, 'project': None, 'last_message': 'hello',
+             'last_message_timestamp': timezone.now(), 'unread_count': 2},
+            {'type': 'project', 'user': None, 'project': projects[0], 'last_message': None,
+             'last_message_timestamp': None, 'unread_count': 0},
+            {'type': 'project', 'user': None, 'project': projects[1], 'last_message': 'Project Created',
+             'last_message_timestamp': projects[1].created_at, 'unread_count': 0},
+        ]
+        expected = SidebarItemSerializer(items, many=True).data
+        self.assertNotIn('created_by_username', expected[2]['project'])
+        self.assertEqual(json.dumps(sidebar_data(items)), json.dumps(expected))
+
+
+class ServeTests(SimpleTestCase):
+    """serve: draining a worker and restarting dead ones, with the reactor and Popen stubbed"""
+
+    def setUp(self):
+        from .management.commands import serve
+        self.serve = serve
+        self.now = 100.0
+        patcher = mock.patch.object(serve.time, 'monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def draining_server(self):
+        server = self.serve.DrainingServer(application=None, endpoints=['fd:fileno=3'], graceful_timeout=5)
+        server.connections = {}
+        server.stop = mock.Mock()
+        return server
+
+    def test_drain_waits_for_connections_to_close(self):
+        from daphne.http_protocol import WebRequest
+        from daphne.ws_protocol import WebSocketProtocol
+        server = self.draining_server()
+        port = mock.Mock(**{'getHost.return_value': mock.Mock(host='127.0.0.1', port=8000)})
+        server.listen_success(port)
+        ws, http = mock.Mock(spec=WebSocketProtocol), mock.Mock(spec=WebRequest)
+        server.connections = {ws: {}, http: {}}
+
+        with mock.patch.object(self.serve.reactor, 'callLater') as call_later:
+            server.drain()
+            server.drain()  # once only
+            port.stopListening.assert_called_once_with()
+            ws.serverClose.assert_called_once_with(code=1001)
+            server.stop.assert_not_called()
+            call_later.assert_called_once_with(0.25, server._wait_for_drain, 105.0)
+
+            server.connections[ws]['disconnected'] = 101.0
+            self.now = 102.0
+            server._wait_for_drain(105.0)
+            self.assertEqual(call_later.call_count, 2)  # the HTTP request is still open
+            server.connections[http]['disconnected'] = 102.5
+            server._wait_for_drain(105.0)
+        server.stop.assert_called_once_with()
+        self.assertEqual(call_later.call_count, 2)
+
+    def test_drain_gives_up_at_the_graceful_timeout(self):
+        from daphne.ws_protocol import WebSocketProtocol
+        server = self.draining_server()
+        ws = mock.Mock(spec=WebSocketProtocol)
+        ws.serverClose.side_effect = RuntimeError("already closing")
+        server.connections = {ws: {}}
+        with mock.patch.object(self.serve.reactor, 'callLater') as call_later:
+            server.drain()
+            self.now = 104.9
+            server._wait_for_drain(105.0)
+            server.stop.assert_not_called()
+            self.now = 105.0
+            server._wait_for_drain(105.0)
+        server.stop.assert_called_once_with()
+        self.assertEqual(call_later.call_count, 2)
+
+    def master(self, **options):
+        options = {'workers': 2, 'bind': '127.0.0.1', 'port': 8000, 'backlog': 16, 'reuse_port': False,
+                   'graceful_timeout': 5.0, 'proxy_headers': False, 'application': None, **options}
+        master = self.serve.Master(self.serve.Command(stdout=io.StringIO()), options)
+        master.sock = mock.Mock(**{'fileno.return_value': 7})
+        return master
+
+    def test_reap_restarts_dead_workers(self):
+        procs = iter(mock.Mock(pid=pid, **{'poll.return_value': None}) for pid in (11, 12, 13))
+        master = self.master()
+        with mock.patch.object(self.serve.subprocess, 'Popen', side_effect=lambda *a, **kw: next(procs)) as popen, \
+                mock.patch.object(self.serve.time, 'sleep') as sleep:
+            master.spawn()
+            master.spawn()
+            self.assertEqual(set(master.workers), {11, 12})
+            argv = popen.call_args.args[0]
+            self.assertEqual(argv[argv.index('--worker-fd') + 1], '7')
+            self.assertEqual(popen.call_args.kwargs, {'pass_fds': (7,)})
+
+            master.reap()
+            self.assertEqual(popen.call_count, 2)  # all alive
+
+            self.now = 200.0
+            master.workers[11][0].poll.return_value = -9
+            master.reap()
+            sleep.assert_not_called()
+            self.assertEqual(set(master.workers), {12, 13})
+            self.assertEqual(master.workers[13][1], 200.0)
+
+            # Dying right after start: back off before the next attempt
+            master.workers[13][0].poll.return_value = 1
+            master.stopping = True
+            master.reap()
+        sleep.assert_called_once_with(master.RESTART_BACKOFF)
+        self.assertEqual(set(master.workers), {12})  # not restarted while stopping
+        self.assertEqual(popen.call_count, 3)
+
+    def test_refuses_to_run_on_windows(self):
+        from django.core.management.base import CommandError
+        with mock.patch.object(self.serve.os, 'name', 'nt'), \
+                mock.patch.object(self.serve, 'Master') as master:
+            with self.assertRaisesRegex(CommandError, 'POSIX'):
+                call_command('serve', stdout=io.StringIO())
+        master.assert_not_called()
+
+
+class ChatbenchSmokeTests(TransactionTestCase):
+    """chatbench in-process: two DM clients exchanging a few messages"""
+
+    def test_report_has_throughput_latency_and_cpu(self):
+        out = io.StringIO()
+        call_command('chatbench', '--clients', '2', '--consumers', 'dm', '--mix', 'message=1',
+                     '--rate', '10', '--duration', '0.5', '--seed', '1', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual((report['config']['mode'], report['config']['connected']), ('inprocess', 2))
+        self.assertEqual(report['errors'], 0)
+        self.assertGreater(report['sent']['message'], 0)
+        self.assertGreater(report['throughput']['sent_per_sec'], 0)
+        self.assertGreater(report['throughput']['received_per_sec'], 0)
+        latency = report['delivery_latency']
+        self.assertGreater(latency['count'], 0)
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            self.assertIsInstance(latency[key], float)
+        self.assertLessEqual(latency['p50_ms'], latency['p99_ms'])
+        self.assertEqual(report['server_cpu']['source'], 'self')
+        self.assertGreaterEqual(report['server_cpu']['seconds'], 0)
+        self.assertIn('utilization', report['server_cpu'])
+        # Synthetic users are cleaned up afterwards
+        self.assertFalse(User.objects.filter(username__startswith='bench_').exists())
@@ -3,7 +3,7 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .views import (
     chat_index, chat_window,
-    UserViewSet, ProjectViewSet, MessageViewSet,
+    UserViewSet, ProjectViewSet, MessageViewSet, AttachmentViewSet, ConversationViewSet,
     send_message_test, meeting_room, create_meeting, end_meeting
 )
 
@@ -14,6 +14,8 @@ router = DefaultRouter()
 router.register(r'users', UserViewSet, basename='users')
 router.register(r'projects', ProjectViewSet, basename='projects')
 router.register(r'messages', MessageViewSet, basename='messages')
+router.register(r'attachments', AttachmentViewSet, basename='attachments')
+router.register(r'conversations', ConversationViewSet, basename='conversations')
 
 # ---------------------------
 # URLPATTERNS
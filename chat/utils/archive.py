@@ -0,0 +1,262 @@
+"""
+Cold archive of old messages.
+
+archive_month() moves one calendar month (UTC) of chat_message into
+storage, one file per conversation:
+
+    message-archive/2025-03/dm_4_17.jsonl.gz
+    message-archive/2025-03/p_9.jsonl.gz
+
+Each file is gzip'd JSON lines, one row per message with every column as
+stored: bodies stay in their encrypted envelope (keep the keys they were
+written with in MESSAGE_KEYS while archives use them). A MessageArchive
+row per file (conversation, month, id range) is what history pages look
+up, and MessageArchiveFile rows keep the files those messages reference
+viewable through the media view.
+
+The files are written and recorded first; only then are the month's
+rows removed: exactly the ids written, or, on Postgres, the whole
+partition detached and dropped (utils/partitions.py) when under lock it
+holds nothing else. Rows that arrive for the month during a run (an
+import with old timestamps) stay for the next one. Rerunning after a
+failure merges into the existing files: the merged file is written under
+a new name, the MessageArchive row repointed in the same transaction and
+the old file deleted only after commit, so a failure at any point leaves
+one complete copy. Removing rows this way skips
+Message's delete signal on purpose: archived messages keep their
+Attachment references, so the blobs stay. Their search tokens are
+deleted, so archived messages no longer match /api/messages/search/.
+"""
+
+import base64
+import datetime
+import gzip
+import json
+import logging
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.utils.dateparse import parse_datetime
+
+from . import partitions
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = 'message-archive'
+
+
+def archive_path(month, key):
+    return f"{ARCHIVE_DIR}/{month:%Y-%m}/{key}.jsonl.gz"
+
+
+# ====================== ROW ENCODING ======================
+
+def _fields():
+    from chat.models import Message
+    return [(f.attname, f.get_internal_type()) for f in Message._meta.concrete_fields]
+
+
+def _encode(row, fields):
+    out = {}
+    for name, kind in fields:
+        value = row[name]
+        if value is None:
+            out[name] = None
+        elif kind == 'BinaryField':
+            out[name] = base64.b64encode(bytes(value)).decode('ascii')
+        elif kind == 'DateTimeField':
+            out[name] = value.isoformat()
+        elif kind in ('ForeignKey', 'UUIDField') and not isinstance(value, (int, str)):
+            out[name] = str(value)
+        else:
+            out[name] = value
+    return out
+
+
+def _decode(data, fields):
+    """Unsaved Message carrying the archived row (columns added since get defaults)"""
+    from chat.models import Message
+    values = {}
+    for name, kind in fields:
+        if name not in data:
+            continue
+        value = data[name]
+        if value is not None and kind == 'BinaryField':
+            value = base64.b64decode(value)
+        elif value is not None and kind == 'DateTimeField':
+            value = parse_datetime(value)
+        values[name] = value
+    message = Message(**values)
+    message._state.adding = False
+    return message
+
+
+def _read_file(path):
+    with default_storage.open(path, 'rb') as f:
+        return [json.loads(line) for line in gzip.decompress(f.read()).splitlines() if line]
+
+
+def _write_file(path, rows):
+    """Write rows to `path`, or a free name next to it; returns the name used"""
+    body = gzip.compress(
+        b''.join(json.dumps(row, separators=(',', ':')).encode() + b'\n' for row in rows))
+    return default_storage.save(path, ContentFile(body))
+
+
+# ====================== ARCHIVING ======================
+
+def archivable_months(older_than, now=None):
+    """Month starts with messages, all of whose days are `older_than` months back"""
+    from chat.models import Message
+    oldest = Message.objects.order_by('timestamp').values_list('timestamp', flat=True).first()
+    if oldest is None:
+        return []
+    cutoff = partitions.month_start(now or datetime.datetime.now(datetime.timezone.utc))
+    for _ in range(older_than):
+        cutoff = (cutoff - datetime.timedelta(days=1)).replace(day=1)
+    months, start = [], partitions.month_start(oldest)
+    while start < cutoff:
+        months.append(start)
+        start = partitions.next_month(start)
+    return months
+
+
+def archive_month(start, batch_size=2000):
+    """Archive every message of the month starting at `start`; counts by conversation"""
+    from chat.models import Message
+
+    end = partitions.next_month(start)
+    rows = (
+        Message.objects.filter(timestamp__gte=start, timestamp__lt=end)
+        .order_by('conversation_key', 'id')
+    )
+    fields = _fields()
+    counts, archived = {}, []
+    key, group = None, []
+    for row in rows.values(*[name for name, _ in fields]).iterator(chunk_size=batch_size):
+        if row['conversation_key'] != key and group:
+            counts[key] = _store(start, key, group)
+            group = []
+        key = row['conversation_key']
+        group.append(_encode(row, fields))
+        archived.append(row['id'])
+    if group:
+        counts[key] = _store(start, key, group)
+
+    _remove_rows(start, archived, batch_size)
+    if counts:
+        logger.info("archive: %s: %s messages in %s conversations",
+                    f"{start:%Y-%m}", sum(counts.values()), len(counts))
+    return counts
+
+
+def _store(month, key, rows):
+    from chat.models import MessageArchive, MessageArchiveFile
+
+    existing = MessageArchive.objects.filter(conversation_key=key, month=month.date()).first()
+    if existing is not None:
+        # Rerun after a partial failure: merge with what was written before
+        merged = {row['id']: row for row in _read_file(existing.path)}
+        merged.update((row['id'], row) for row in rows)
+        rows = [merged[pk] for pk in sorted(merged)]
+    # Never over the existing file: it stays until the new one is recorded
+    path = _write_file(archive_path(month, key), rows)
+
+    try:
+        with transaction.atomic():
+            archive, _ = MessageArchive.objects.update_or_create(
+                conversation_key=key, month=month.date(),
+                defaults={
+                    'path': path,
+                    'message_count': len(rows),
+                    'first_id': rows[0]['id'],
+                    'last_id': rows[-1]['id'],
+                })
+            names = {row['file'] for row in rows if row.get('file')}
+            MessageArchiveFile.objects.bulk_create(
+                [MessageArchiveFile(archive=archive, name=name) for name in names],
+                ignore_conflicts=True)
+            if existing is not None and existing.path != path:
+                transaction.on_commit(lambda old=existing.path: default_storage.delete(old))
+    except Exception:
+        default_storage.delete(path)  # not recorded: the old file is still current
+        raise
+    return len(rows)
+
+
+def _remove_rows(start, ids, batch_size=2000):
+    """Delete the archived messages `ids` of the month starting at `start`"""
+    from chat.models import Message, MessageSearchToken
+
+    with transaction.atomic():
+        partition = partitions.partitions().get(start)
+        if partition is not None:
+            with connection.cursor() as cursor:
+                # Nothing can be added while counting; drop only if all was archived
+                cursor.execute(f'LOCK TABLE "{partition}" IN ACCESS EXCLUSIVE MODE')
+                cursor.execute(f'SELECT count(*) FROM "{partition}"')
+                complete = cursor.fetchone()[0] == len(ids)
+            if complete:
+                for i in range(0, len(ids), batch_size):
+                    MessageSearchToken.objects.filter(message_id__in=ids[i:i + batch_size]).delete()
+                partitions.drop_partition(start)
+                return
+        # Unpartitioned, rows in the default partition, or rows added since
+        # the scan: delete by id, bypassing Message's delete signal (see the
+        # module docstring)
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            MessageSearchToken.objects.filter(message_id__in=batch).delete()
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {Message._meta.db_table} WHERE id IN ({', '.join(['%s'] * len(batch))})",
+                    batch)
+
+
+# ====================== READING ======================
+
+def read(key, before=None, limit=50):
+    """
+    Up to `limit` archived messages of a conversation with id < `before`,
+    newest first, as unsaved Message instances with their relations loaded.
+    """
+    from chat.models import MessageArchive
+
+    archives = MessageArchive.objects.filter(conversation_key=key)
+    if before is not None:
+        archives = archives.filter(first_id__lt=before)
+    fields = _fields()
+    found = []
+    for archive in archives.order_by('-last_id').iterator():
+        rows = [row for row in _read_file(archive.path) if before is None or row['id'] < before]
+        found.extend(sorted(rows, key=lambda row: row['id'], reverse=True))
+        if len(found) >= limit:
+            break
+    return _load_related([_decode(row, fields) for row in found[:limit]])
+
+
+def _load_related(messages):
+    """Attach senders, receivers, projects, meetings and attachments in a few queries"""
+    from chat.models import Attachment, Meeting, Project
+
+    def fetch(model, attname):
+        # Keyed by str(pk): archived meeting ids come back as strings
+        ids = {getattr(m, attname) for m in messages} - {None}
+        return {str(pk): obj for pk, obj in model.objects.in_bulk(ids).items()} if ids else {}
+
+    users = {**fetch(User, 'sender_id'), **fetch(User, 'receiver_id')}
+    related = (
+        ('sender', 'sender_id', users),
+        ('receiver', 'receiver_id', users),
+        ('project', 'project_id', fetch(Project, 'project_id')),
+        ('meeting', 'meeting_id', fetch(Meeting, 'meeting_id')),
+        ('attachment', 'attachment_id', fetch(Attachment, 'attachment_id')),
+    )
+    for message in messages:
+        for field, attname, objects in related:
+            obj = objects.get(str(getattr(message, attname)))
+            if obj is not None:
+                setattr(message, field, obj)
+    return messages
@@ -0,0 +1,106 @@
+"""
+Normalized avatars.
+
+An uploaded avatar is decoded once, oriented from EXIF, center-cropped to a
+square and written as WebP at each of AVATAR_SIZES under a name derived from
+the upload's SHA-256:
+
+    avatars/<sha256>_<size>.webp
+
+UserProfile.avatar points at the largest size. Files never change once
+written, so their URLs can be cached forever and a new avatar simply gets a
+new URL. Profiles still holding a pre-normalization upload keep serving it.
+"""
+
+import hashlib
+import io
+import os
+import re
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+AVATAR_SIZES = (64, 256)
+WEBP_QUALITY = 85
+
+# Refuse images that would take a lot of memory to decode
+MAX_PIXELS = 40_000_000
+
+_NAME = re.compile(r'^avatars/(?P<sha>[0-9a-f]{64})_(?P<size>\d+)\.webp$')
+
+
+def avatar_name(sha256, size):
+    return os.path.join('avatars', f"{sha256}_{size}.webp")
+
+
+def render(data):
+    """Image bytes -> {size: square WebP bytes}; raises ValueError for non-images"""
+    from PIL import Image, ImageOps
+
+    try:
+        img = Image.open(io.BytesIO(data))
+        if img.width * img.height > MAX_PIXELS:
+            raise ValueError("image too large")
+        img.draft('RGB', (max(AVATAR_SIZES), max(AVATAR_SIZES)))
+        img = ImageOps.exif_transpose(img)
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"not a usable image: {e}")
+
+    has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+    img = img.convert('RGBA' if has_alpha else 'RGB')
+    out = {}
+    for size in AVATAR_SIZES:
+        square = ImageOps.fit(img, (size, size), Image.LANCZOS)
+        buf = io.BytesIO()
+        square.save(buf, 'WEBP', quality=WEBP_QUALITY, method=4)
+        out[size] = buf.getvalue()
+    return out
+
+
+def save_avatar(profile, upload):
+    """
+    Normalize `upload` (a Django File), store every size and point the
+    profile at it. Returns the new avatar name; the previous files are
+    removed unless another profile uses them.
+    """
+    data = upload.read()
+    sha = hashlib.sha256(data).hexdigest()
+    for size, webp in render(data).items():
+        name = avatar_name(sha, size)
+        if not default_storage.exists(name):
+            default_storage.save(name, ContentFile(webp))
+
+    old = profile.avatar.name if profile.avatar else None
+    profile.avatar.name = avatar_name(sha, max(AVATAR_SIZES))
+    profile.save(update_fields=['avatar'])
+
+    if old and old != profile.avatar.name:
+        from chat.models import UserProfile
+        if not UserProfile.objects.filter(avatar=old).exists():
+            for name in _files_of(old):
+                default_storage.delete(name)
+    return profile.avatar.name
+
+
+def _files_of(name):
+    match = _NAME.match(name)
+    if not match:
+        return [name]
+    return [avatar_name(match.group('sha'), size) for size in AVATAR_SIZES]
+
+
+def urls(profile):
+    """{size: url} for a profile's avatar (legacy uploads: the same url for all sizes)"""
+    if not profile.avatar:
+        return None
+    match = _NAME.match(profile.avatar.name)
+    if not match:
+        url = profile.avatar.url
+        return {str(size): url for size in AVATAR_SIZES}
+    sha = match.group('sha')
+    return {str(size): default_storage.url(avatar_name(sha, size)) for size in AVATAR_SIZES}
+
+
+def is_immutable(name):
+    """True for content-hashed avatar files (safe to cache forever)"""
+    return bool(_NAME.match(name))
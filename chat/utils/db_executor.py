@@ -0,0 +1,97 @@
+"""
+Where consumer ORM calls run.
+
+database_sync_to_async is thread-sensitive by default, so every consumer
+in a process queues its queries on one shared thread and a single slow
+query delays every socket. With CONSUMER_DB_THREADS = N > 0, consumer
+calls (see consumers.db_thread) run on a pool of N threads instead:
+
+- Django connections are per thread, so each worker opens and keeps its
+  own connection; plan for N connections per process in the database's
+  connection limit.
+- close_old_connections() runs before and after every call, exactly as
+  database_sync_to_async does, so CONN_MAX_AGE and CONN_HEALTH_CHECKS are
+  honoured per worker and a broken connection is replaced on next use.
+- Calls from one socket still run one at a time (a consumer awaits each
+  handler), but calls from different sockets run concurrently, so code
+  behind db_thread must not rely on being serialized with other sockets.
+
+0 (the default) keeps the shared thread. SQLite allows one writer at a
+time: in SQLite embedded mode (utils/sqlite_mode.py) writes leave the
+pool for the single writer thread (write_to_async), so the pool serves
+reads only.
+"""
+
+import asyncio
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import sqlite_mode
+
+logger = logging.getLogger(__name__)
+
+_pools = {}
+_lock = threading.Lock()
+
+
+def pool_size():
+    return max(0, int(getattr(settings, 'CONSUMER_DB_THREADS', 0) or 0))
+
+
+def _get_pool(size):
+    with _lock:
+        pool = _pools.get(size)
+        if pool is None:
+            from django.db import connection
+            if connection.vendor == 'sqlite' and size > 1 and not sqlite_mode.writer_enabled():
+                logger.warning("CONSUMER_DB_THREADS=%s on SQLite: concurrent writes "
+                               "can fail with 'database is locked'", size)
+            pool = _pools[size] = ThreadPoolExecutor(
+                max_workers=size, thread_name_prefix='chat-db')
+        return pool
+
+
+def sync_to_async(fn):
+    """database_sync_to_async(fn), on the worker pool when one is configured"""
+    size = pool_size()
+    if not size:
+        return database_sync_to_async(fn)
+    return database_sync_to_async(fn, thread_sensitive=False, executor=_get_pool(size))
+
+
+def write_to_async(fn):
+    """sync_to_async(fn), except through the SQLite writer queue in embedded mode"""
+    if not sqlite_mode.writer_enabled():
+        return sync_to_async(fn)
+
+    async def call(*args, **kwargs):
+        return await asyncio.wrap_future(sqlite_mode.writer().submit(fn, *args, **kwargs))
+    return call
+
+
+def _close_connections(barrier):
+    from django.db import connections
+    try:
+        # Holding every worker at the barrier puts one job on each thread
+        barrier.wait(timeout=5)
+    except threading.BrokenBarrierError:
+        pass
+    connections.close_all()
+
+
+def shutdown():
+    """Close every worker's connections and stop the pools (and the SQLite writer)"""
+    sqlite_mode.shutdown()
+    with _lock:
+        pools = list(_pools.items())
+        _pools.clear()
+    for size, pool in pools:
+        barrier = threading.Barrier(size)
+        for _ in range(size):
+            pool.submit(_close_connections, barrier)
+        pool.shutdown(wait=True)
@@ -1,11 +1,248 @@
-from cryptography.fernet import Fernet
+"""
+Message body encryption.
+
+Stored format (raw bytes in Message.encrypted_text):
+
+    v3:     0x03 | key id (4 bytes) | flags (1 byte) | nonce (12 bytes) | ciphertext + tag
+    v2:     0x02 | key id (4 bytes) | nonce (12 bytes) | AES-256-GCM ciphertext + tag
+    v1:     0x01 | nonce (12 bytes) | AES-256-GCM ciphertext + tag (16 bytes)
+    legacy: Fernet token (urlsafe base64 text, always starts with b'g')
+
+New writes use v2 (or v3, below) with the primary key (settings.MESSAGE_KEYS[0]). Every
+configured key can decrypt, so a key is rotated by putting the new secret
+first, running 'manage.py rotate_message_keys', and only then removing the
+old one. Older formats and keys are also rewritten lazily the next time a
+Message is saved (see Message.save).
+
+Bodies of at least settings.MESSAGE_COMPRESSION_THRESHOLD bytes are zlib
+compressed before encryption (optionally with a preset dictionary trained
+by 'manage.py train_message_dict') and stored as v3, whose flags byte says
+how to decompress; it is authenticated as associated data. Shorter bodies,
+or ones that do not shrink, stay v2. Compression makes ciphertext length
+depend on content, so the threshold also keeps short messages out of it.
+"""
+
+import hashlib
+import os
+import struct
+import zlib
+
+from cryptography.fernet import Fernet, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from chat.metrics import ENCRYPT, perf_counter
+
+VERSION_AESGCM = 0x01
+VERSION_KEYED = 0x02
+VERSION_COMPRESSED = 0x03
+NONCE_SIZE = 12
+KEY_ID_SIZE = 4
+
+# v3 flags
+COMPRESS_ZLIB = 0x01
+
+# Upper bound on a decompressed body (far above MAX_MESSAGE_LENGTH)
+MAX_BODY_BYTES = 1024 * 1024
+
+_V1 = bytes((VERSION_AESGCM,))
+_V2 = bytes((VERSION_KEYED,))
+_V3 = bytes((VERSION_COMPRESSED,))
+_V2_HEADER = 1 + KEY_ID_SIZE
+_V3_HEADER = _V2_HEADER + 1
+
+
+def _derive_aead_key(secret: bytes) -> bytes:
+    """AES-256 key for the AEAD envelopes, derived from a configured secret"""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b'teams-chat message v1 aes-256-gcm',
+    ).derive(secret)
+
+
+def _key_id(key: bytes) -> bytes:
+    """Short public fingerprint of a derived key, stored in v2 envelopes"""
+    return hashlib.sha256(b'teams-chat key id' + key).digest()[:KEY_ID_SIZE]
+
+
+class Compressor:
+    """
+    zlib compression of message bodies above a size threshold (0 = off).
+
+    `dictionaries` are preset dictionaries, newest first: the first is used
+    for compression, and any of them can decompress (zlib records the
+    dictionary's Adler-32 in the stream header).
+    """
+
+    def __init__(self, threshold, level=6, dictionaries=()):
+        self.threshold = threshold
+        self.level = level
+        self.zdict = dictionaries[0] if dictionaries else None
+        self.dictionaries = {zlib.adler32(d): d for d in dictionaries}
+
+    @classmethod
+    def from_settings(cls):
+        threshold = getattr(settings, 'MESSAGE_COMPRESSION_THRESHOLD', 0)
+        dictionaries = []
+        for path in getattr(settings, 'MESSAGE_COMPRESSION_DICTS', []):
+            try:
+                with open(path, 'rb') as fh:
+                    dictionaries.append(fh.read())
+            except OSError as e:
+                raise ImproperlyConfigured(f"Cannot read message compression dictionary: {e}")
+        return cls(threshold, dictionaries=dictionaries)
+
+    @staticmethod
+    def train(samples, size=32 * 1024):
+        """
+        Build a zlib preset dictionary from sample bodies (bytes).
+
+        zlib has no trainer of its own, so this keeps the lines and words
+        that recur across samples, scored by bytes saved, with the most
+        valuable ones last (closest to the data, cheapest to reference).
+        """
+        counts = {}
+        for sample in samples:
+            pieces = set(sample.splitlines(keepends=True))
+            pieces.update(w for w in sample.split() if len(w) >= 4)
+            for piece in pieces:
+                counts[piece] = counts.get(piece, 0) + 1
+        scored = sorted(
+            ((n * len(piece), piece) for piece, n in counts.items() if n > 1 and len(piece) < 256),
+            reverse=True,
+        )
+        chosen, total = [], 0
+        for _, piece in scored:
+            if total + len(piece) > size:
+                continue
+            chosen.append(piece)
+            total += len(piece)
+        return b''.join(reversed(chosen))
+
+    def compress(self, data: bytes):
+        """Compressed bytes, or None when not worth it"""
+        if not self.threshold or len(data) < self.threshold:
+            return None
+        if self.zdict is None:
+            packed = zlib.compress(data, self.level)
+        else:
+            c = zlib.compressobj(self.level, zdict=self.zdict)
+            packed = c.compress(data) + c.flush()
+        return packed if len(packed) < len(data) else None
+
+    def decompress(self, packed: bytes) -> bytes:
+        zdict = None
+        if len(packed) >= 6 and packed[1] & 0x20:  # FDICT: DICTID follows the header
+            dict_id = struct.unpack('>I', packed[2:6])[0]
+            zdict = self.dictionaries.get(dict_id)
+            if zdict is None:
+                raise KeyError(f"unknown compression dictionary {dict_id:08x}")
+        d = zlib.decompressobj(zdict=zdict) if zdict is not None else zlib.decompressobj()
+        data = d.decompress(packed, MAX_BODY_BYTES)
+        if d.unconsumed_tail:
+            raise ValueError("decompressed message body too large")
+        return data
+
+
+class Keyring:
+    """
+    The configured message keys. The first one encrypts; all of them decrypt.
+
+    Each entry of `secrets` is a base64 urlsafe Fernet key string, e.g.
+    Fernet.generate_key().decode().
+    """
+
+    def __init__(self, secrets, compressor=None):
+        secrets = [s.encode() if isinstance(s, str) else s for s in secrets]
+        if not secrets:
+            raise ValueError("at least one message key is required")
+        self.fernet = MultiFernet([Fernet(s) for s in secrets])
+        self.aeads = {}
+        self.ordered = []
+        for secret in secrets:
+            key = _derive_aead_key(secret)
+            kid, aead = _key_id(key), AESGCM(key)
+            self.aeads.setdefault(kid, aead)
+            self.ordered.append(aead)
+        self.primary_id = _key_id(_derive_aead_key(secrets[0]))
+        self.primary = self.aeads[self.primary_id]
+        self.prefix = _V2 + self.primary_id
+        self.compressed_prefix = _V3 + self.primary_id
+        self.compressor = compressor or Compressor(0)
+
+    def encrypt(self, text: str) -> bytes:
+        data = text.encode()
+        nonce = os.urandom(NONCE_SIZE)
+        packed = self.compressor.compress(data)
+        if packed is None:
+            return self.prefix + nonce + self.primary.encrypt(nonce, data, None)
+        header = self.compressed_prefix + bytes((COMPRESS_ZLIB,))
+        return header + nonce + self.primary.encrypt(nonce, packed, header)
+
+    def _aead_for(self, token):
+        aead = self.aeads.get(token[1:_V2_HEADER])
+        if aead is None:
+            raise KeyError(f"unknown message key id {token[1:_V2_HEADER].hex()}")
+        return aead
+
+    def decrypt(self, token: bytes) -> str:
+        version = token[:1]
+        if version == _V3:
+            header, flags = token[:_V3_HEADER], token[_V2_HEADER]
+            nonce = token[_V3_HEADER:_V3_HEADER + NONCE_SIZE]
+            data = self._aead_for(token).decrypt(nonce, token[_V3_HEADER + NONCE_SIZE:], header)
+            if flags & COMPRESS_ZLIB:
+                data = self.compressor.decompress(data)
+            return data.decode()
+        if version == _V2:
+            nonce = token[_V2_HEADER:_V2_HEADER + NONCE_SIZE]
+            return self._aead_for(token).decrypt(nonce, token[_V2_HEADER + NONCE_SIZE:], None).decode()
+        if version == _V1:
+            # v1 carries no key id: try each key (a wrong key fails the tag check)
+            nonce, body = token[1:1 + NONCE_SIZE], token[1 + NONCE_SIZE:]
+            error = None
+            for aead in self.ordered:
+                try:
+                    return aead.decrypt(nonce, body, None).decode()
+                except Exception as e:
+                    error = e
+            raise error
+        return self.fernet.decrypt(token).decode()
+
+    def needs_upgrade(self, token: bytes) -> bool:
+        if not token:
+            return False
+        head = token[:_V2_HEADER]
+        return head != self.prefix and head != self.compressed_prefix
+
+
+keyring = Keyring(settings.MESSAGE_KEYS, Compressor.from_settings())
+
+# Legacy Fernet tokens (kept for reads and benchmarks)
+f = keyring.fernet
 
-# settings.FERNET_KEY must be a base64 urlsafe key string, e.g. Fernet.generate_key().decode()
-f = Fernet(settings.FERNET_KEY.encode())
 
 def encrypt_message(text: str) -> bytes:
-    return f.encrypt(text.encode())
+    start = perf_counter()
+    token = keyring.encrypt(text)
+    ENCRYPT.observe(perf_counter() - start)
+    return token
+
 
 def decrypt_message(token: bytes) -> str:
-    return f.decrypt(token).decode()
+    return keyring.decrypt(token)
+
+
+def needs_upgrade(token: bytes) -> bool:
+    """True for ciphertexts written in an older format or with a non-primary key"""
+    return keyring.needs_upgrade(token)
+
+
+def upgrade_token(token: bytes) -> bytes:
+    """Re-encrypt a ciphertext in the current format with the primary key"""
+    return encrypt_message(decrypt_message(token))
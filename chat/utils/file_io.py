@@ -0,0 +1,63 @@
+"""
+Bounded thread pool for file I/O started from async code.
+
+database_sync_to_async is thread-sensitive: every consumer in a process
+shares one thread for its ORM calls. Decoding an inline upload and writing
+it to storage there stalls everybody else's queries for as long as the
+write takes, so consumers run that part here and the ORM step only links
+the stored blob.
+
+FILE_IO_WORKERS threads do the work. At most FILE_IO_MAX_PENDING jobs are
+queued or running at once; further callers wait on the event loop instead
+of piling file contents up in memory.
+"""
+
+import asyncio
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from chat import metrics
+
+_executor = None
+_lock = threading.Lock()
+# One semaphore per event loop (asyncio primitives are loop-bound)
+_limits = weakref.WeakKeyDictionary()
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=max(1, getattr(settings, 'FILE_IO_WORKERS', 4)),
+                thread_name_prefix='chat-file-io')
+        return _executor
+
+
+def _limit(loop):
+    limit = _limits.get(loop)
+    if limit is None:
+        limit = _limits[loop] = asyncio.Semaphore(
+            max(1, getattr(settings, 'FILE_IO_MAX_PENDING', 16)))
+    return limit
+
+
+async def run(fn, *args, op='io'):
+    """Run fn(*args) on the I/O pool; `op` labels the timing histograms"""
+    loop = asyncio.get_running_loop()
+    wait, work = metrics.FILE_IO_WAIT.labels(op), metrics.FILE_IO.labels(op)
+    queued = metrics.perf_counter()
+
+    def job():
+        started = metrics.perf_counter()
+        wait.observe(started - queued)
+        try:
+            return fn(*args)
+        finally:
+            work.observe(metrics.perf_counter() - started)
+
+    async with _limit(loop):
+        return await loop.run_in_executor(_get_executor(), job)
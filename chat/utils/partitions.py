@@ -0,0 +1,211 @@
+"""
+Monthly range partitions of chat_message on PostgreSQL.
+
+`manage.py message_partitions --convert` turns chat_message into a table
+partitioned by RANGE ("timestamp"), one partition per calendar month (UTC) named
+chat_message_pYYYY_MM plus chat_message_default for anything outside
+them. Postgres requires the partition key in every unique constraint, so
+the primary key becomes (id, timestamp) and nothing may hold a database
+foreign key to chat_message (MessageSearchToken.message and
+Message.reply_to are ORM-only references; migration 0014 drops those
+constraints, and only that). The ORM still treats `id` as
+the key: ids stay unique because they come from one sequence.
+
+Partitions have to exist before their month starts, otherwise new rows
+land in the default partition and stay there:
+
+    python manage.py message_partitions --ahead 3    # e.g. daily from cron
+
+create_partition() also moves rows already in the default partition, so
+running it late is safe. archive_messages detaches and drops whole
+partitions once they are archived (utils/archive.py).
+
+SQLite (and any other backend) is left unpartitioned; every function
+here is then a no-op.
+"""
+
+import datetime
+import logging
+
+from django.db import connection as default_connection, transaction
+
+logger = logging.getLogger(__name__)
+
+TABLE = 'chat_message'
+DEFAULT_PARTITION = 'chat_message_default'
+
+
+def supported(connection=None):
+    return (connection or default_connection).vendor == 'postgresql'
+
+
+def month_start(value):
+    """First instant (UTC) of the month containing a date/datetime"""
+    return datetime.datetime(value.year, value.month, 1, tzinfo=datetime.timezone.utc)
+
+
+def next_month(start):
+    return (start + datetime.timedelta(days=32)).replace(day=1)
+
+
+def partition_name(start):
+    return f"{TABLE}_p{start.year:04d}_{start.month:02d}"
+
+
+def is_partitioned(connection=None):
+    connection = connection or default_connection
+    if not supported(connection):
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [TABLE])
+        row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+
+def partitions(connection=None):
+    """{month start: partition name} of the attached monthly partitions"""
+    connection = connection or default_connection
+    if not is_partitioned(connection):
+        return {}
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+        """, [TABLE])
+        names = [row[0] for row in cursor.fetchall()]
+    found = {}
+    for name in names:
+        try:
+            year, month = name[len(TABLE) + 2:].split('_')
+            found[datetime.datetime(int(year), int(month), 1, tzinfo=datetime.timezone.utc)] = name
+        except ValueError:
+            continue  # the default partition
+    return found
+
+
+def create_partition(start, connection=None):
+    """Partition for the month starting at `start`; False if it already exists"""
+    connection = connection or default_connection
+    name, end = partition_name(start), next_month(start)
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", [name])
+        if cursor.fetchone()[0]:
+            return False
+        cursor.execute(
+            f'CREATE TABLE "{name}" (LIKE "{TABLE}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+        # Rows that already landed in the default partition move first,
+        # or attaching would fail on them
+        cursor.execute(f"""
+            WITH moved AS (
+                DELETE FROM "{DEFAULT_PARTITION}"
+                WHERE "timestamp" >= %s AND "timestamp" < %s RETURNING *
+            )
+            INSERT INTO "{name}" SELECT * FROM moved
+        """, [start, end])
+        cursor.execute(
+            f'ALTER TABLE "{TABLE}" ATTACH PARTITION "{name}" FOR VALUES FROM (%s) TO (%s)',
+            [start, end])
+    logger.info("partitions: created %s", name)
+    return True
+
+
+def ensure_partitions(ahead=3, since=None, connection=None):
+    """Create the partitions from `since` (default: this month) to `ahead` months on"""
+    connection = connection or default_connection
+    if not is_partitioned(connection):
+        return []
+    now = datetime.datetime.now(datetime.timezone.utc)
+    start, stop = month_start(since or now), month_start(now)
+    for _ in range(ahead):
+        stop = next_month(stop)
+    created = []
+    while start <= stop:
+        if create_partition(start, connection):
+            created.append(partition_name(start))
+        start = next_month(start)
+    return created
+
+
+def drop_partition(start, connection=None):
+    """Detach and drop the month's partition; False if there is none"""
+    connection = connection or default_connection
+    name = partitions(connection).get(start)
+    if name is None:
+        return False
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE "{TABLE}" DETACH PARTITION "{name}"')
+        cursor.execute(f'DROP TABLE "{name}"')
+    logger.info("partitions: dropped %s", name)
+    return True
+
+
+def partition_table(connection=None, ahead=3):
+    """
+    Rebuild an ordinary chat_message as a partitioned table, in one
+    transaction; the number of rows copied, or None if there was nothing
+    to do (not Postgres, or already partitioned).
+
+    Copies every row, so it takes as long as a full table rewrite and holds
+    an exclusive lock on chat_message meanwhile.
+    """
+    connection = connection or default_connection
+    if not supported(connection) or is_partitioned(connection):
+        return None
+    with transaction.atomic(using=connection.alias):
+        return _partition_table(connection, ahead)
+
+
+def _partition_table(connection, ahead):
+    with connection.cursor() as cursor:
+        # Secondary indexes and outgoing foreign keys, recreated on the new table
+        cursor.execute("""
+            SELECT pg_get_indexdef(x.indexrelid) FROM pg_index x
+            WHERE x.indrelid = to_regclass(%s) AND NOT x.indisprimary
+        """, [TABLE])
+        index_defs = [row[0] for row in cursor.fetchall()]
+        cursor.execute("""
+            SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE conrelid = to_regclass(%s) AND contype = 'f'
+        """, [TABLE])
+        foreign_keys = cursor.fetchall()
+        cursor.execute(f'SELECT min("timestamp") FROM "{TABLE}"')
+        oldest = cursor.fetchone()[0]
+
+        cursor.execute(f'ALTER TABLE "{TABLE}" RENAME TO "{TABLE}_unpartitioned"')
+        cursor.execute(f"""
+            CREATE TABLE "{TABLE}" (LIKE "{TABLE}_unpartitioned"
+                INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE)
+            PARTITION BY RANGE ("timestamp")
+        """)
+        cursor.execute(f'ALTER TABLE "{TABLE}" ADD PRIMARY KEY (id, "timestamp")')
+        cursor.execute(f'CREATE TABLE "{DEFAULT_PARTITION}" PARTITION OF "{TABLE}" DEFAULT')
+    ensure_partitions(ahead=ahead, since=oldest, connection=connection)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'INSERT INTO "{TABLE}" SELECT * FROM "{TABLE}_unpartitioned"')
+        copied = cursor.rowcount
+        # Identity columns cannot be partitioned before Postgres 17: ids come
+        # from a sequence owned by the new table (a serial's own sequence,
+        # or a new one continuing after the identity's last value)
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [f'{TABLE}_unpartitioned'])
+        sequence = cursor.fetchone()[0]
+        cursor.execute(
+            "SELECT attidentity FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = 'id'",
+            [f'{TABLE}_unpartitioned'])
+        if cursor.fetchone()[0]:
+            sequence = f'"{TABLE}_id_partitioned_seq"'
+            cursor.execute(f'CREATE SEQUENCE {sequence}')
+            cursor.execute(f'ALTER TABLE "{TABLE}" ALTER COLUMN id SET DEFAULT nextval(%s)',
+                           [sequence.strip('"')])
+            cursor.execute(f"""
+                SELECT setval(%s, COALESCE((SELECT max(id) FROM "{TABLE}"), 0) + 1, false)
+            """, [sequence.strip('"')])
+        if sequence:
+            cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY "{TABLE}".id')
+        cursor.execute(f'DROP TABLE "{TABLE}_unpartitioned"')
+        for index_def in index_defs:
+            cursor.execute(index_def)
+        for name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{name}" {definition}')
+    logger.info("partitions: converted %s (%s rows)", TABLE, copied)
+    return copied
@@ -0,0 +1,141 @@
+"""
+Retention purge: delete messages older than their conversation's
+RetentionPolicy.keep_days.
+
+Message.delete() (and QuerySet.delete()) loads every row to run the
+pre_delete receiver and Django's SET_NULL/CASCADE handling, one instance
+at a time. A purge can cover millions of rows, so purge() instead works
+in primary-key batches of at most batch_size messages of one conversation
+(the (conversation_key, timestamp, id) index), each in its own short
+transaction:
+
+- search tokens of the batch, then the rows themselves, are deleted with
+  one statement each, without loading instances or sending signals;
+- replies pointing into the batch get reply_to = NULL (what SET_NULL would
+  have done);
+- Attachment.ref_count is decremented once per attachment, and the
+  attachments that reach zero are deleted in bulk;
+- the storage names to remove (legacy message files, released blobs and
+  their thumbnails) are handed to a FileReaper after commit, which unlinks
+  them on a background thread while the next batch runs.
+
+Messages moved to cold storage (utils/archive.py) are not touched.
+"""
+
+import collections
+import datetime
+import itertools
+import logging
+import queue
+import threading
+import time
+
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class FileReaper:
+    """Deletes storage files queued with put() on one background thread"""
+
+    def __init__(self, storage=None):
+        self.storage = storage or default_storage
+        self.deleted = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name='chat-file-reaper', daemon=True)
+        self._thread.start()
+
+    def put(self, names):
+        if names:
+            self._queue.put(list(names))
+
+    def close(self):
+        """Wait for everything queued so far"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while (names := self._queue.get()) is not None:
+            for name in names:
+                try:
+                    self.storage.delete(name)
+                    self.deleted += 1
+                except Exception:
+                    logger.exception("retention: could not delete %s", name)
+
+
+def purge(policy, batch_size=1000, now=None, reaper=None, pause=0.0, dry_run=False):
+    """Delete the policy's expired messages; returns how many (would be) deleted"""
+    from chat.models import Message, RetentionPolicy
+
+    now = now or timezone.now()
+    expired = Message.objects.in_conversation(policy.conversation_key).filter(
+        timestamp__lt=now - datetime.timedelta(days=policy.keep_days))
+    if dry_run:
+        return expired.count()
+
+    total = 0
+    while ids := list(expired.order_by('id').values_list('id', flat=True)[:batch_size]):
+        with transaction.atomic():
+            files = _delete_batch(ids)
+            RetentionPolicy.objects.filter(pk=policy.pk).update(
+                purged_count=F('purged_count') + len(ids), last_purged_at=now)
+            if reaper is not None:
+                transaction.on_commit(lambda files=files: reaper.put(files))
+        total += len(ids)
+        if pause:
+            time.sleep(pause)
+    if total:
+        logger.info("retention: %s: purged %s message(s)", policy.conversation_key, total)
+    else:
+        RetentionPolicy.objects.filter(pk=policy.pk).update(last_purged_at=now)
+    return total
+
+
+def _delete_batch(ids):
+    """Delete messages `ids` and what hangs off them; storage names to unlink"""
+    from chat.models import Attachment, Message, MessageSearchToken
+    from chat.utils.thumbnails import thumbnail_name
+
+    rows = list(Message.objects.filter(id__in=ids).values_list('attachment_id', 'file'))
+    files = [name for attachment_id, name in rows if not attachment_id and name]
+    refs = collections.Counter(attachment_id for attachment_id, _ in rows if attachment_id)
+
+    MessageSearchToken.objects.filter(message_id__in=ids).delete()
+    Message.objects.filter(reply_to_id__in=ids).exclude(id__in=ids).update(reply_to=None)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {Message._meta.db_table} WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+
+    for count, group in itertools.groupby(sorted(refs, key=refs.get), key=refs.get):
+        Attachment.objects.filter(id__in=list(group)).update(
+            ref_count=Greatest(F('ref_count') - count, Value(0)))
+    released = list(
+        Attachment.objects.filter(id__in=list(refs), ref_count=0)
+        .exclude(id__in=Message.objects.filter(attachment_id__in=list(refs)).values('attachment_id'))
+        .only('sha256', 'blob', 'thumbnails'))
+    for attachment in released:
+        files.append(attachment.blob.name)
+        files.extend(thumbnail_name(attachment.sha256, size) for size in attachment.thumbnails or [])
+    Attachment.objects.filter(id__in=[a.id for a in released]).delete()
+    return files
+
+
+def purge_all(batch_size=1000, now=None, pause=0.0, dry_run=False):
+    """Run purge() for every policy; {conversation_key: count} and files deleted"""
+    from chat.models import RetentionPolicy
+
+    reaper = None if dry_run else FileReaper()
+    counts = {}
+    try:
+        for policy in RetentionPolicy.objects.order_by('id').iterator():
+            counts[policy.conversation_key] = purge(
+                policy, batch_size=batch_size, now=now, reaper=reaper, pause=pause, dry_run=dry_run)
+    finally:
+        if reaper is not None:
+            reaper.close()
+    return counts, reaper.deleted if reaper is not None else 0
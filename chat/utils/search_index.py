@@ -0,0 +1,92 @@
+"""
+Blind index for keyword search over encrypted messages.
+
+Each message's text is split into normalized words and every word is stored
+as a keyed HMAC (MessageSearchToken.digest). A query is hashed the same way
+and matched by digest, so the database never sees plaintext words and only
+the page of matching messages has to be decrypted.
+
+Matching is on whole words (case- and accent-insensitive); substring and
+prefix search are deliberately not supported, since they would leak far
+more about the plaintext.
+
+The HMAC key comes from settings.SEARCH_INDEX_KEY and is independent of
+MESSAGE_KEYS, so rotating message keys does not invalidate the index.
+"""
+
+import hashlib
+import hmac
+import re
+import unicodedata
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 64
+MAX_TOKENS_PER_MESSAGE = 256
+DIGEST_HEX_LENGTH = 32
+
+_WORD = re.compile(r'\w+')
+
+
+def _derive_index_key(secret: bytes) -> bytes:
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b'teams-chat search index hmac-sha256',
+    ).derive(secret)
+
+
+_index_key = _derive_index_key(settings.SEARCH_INDEX_KEY.encode())
+
+
+def normalize(text: str):
+    """Distinct search words of `text`, in first-seen order"""
+    if not text:
+        return []
+    folded = unicodedata.normalize('NFKD', text.casefold())
+    folded = ''.join(c for c in folded if not unicodedata.combining(c))
+    seen = {}
+    for word in _WORD.findall(folded):
+        if MIN_TOKEN_LENGTH <= len(word) <= MAX_TOKEN_LENGTH:
+            seen.setdefault(word, None)
+            if len(seen) >= MAX_TOKENS_PER_MESSAGE:
+                break
+    return list(seen)
+
+
+def digest(word: str) -> str:
+    mac = hmac.new(_index_key, word.encode(), hashlib.sha256)
+    return mac.hexdigest()[:DIGEST_HEX_LENGTH]
+
+
+def message_digests(text: str):
+    """Digests to index for a message body"""
+    return [digest(word) for word in normalize(text)]
+
+
+def query_digests(query: str):
+    """Digests a message must all contain to match `query`"""
+    return [digest(word) for word in normalize(query)]
+
+
+def index_message(message, text=None, created=False):
+    """
+    Replace the search tokens of a saved message.
+
+    `text` is the plaintext when the caller already has it, which saves a
+    decryption on the write path; `created` skips deleting old tokens.
+    """
+    from chat.models import MessageSearchToken
+
+    if text is None:
+        text = message.text
+    if not created:
+        MessageSearchToken.objects.filter(message_id=message.pk).delete()
+    MessageSearchToken.objects.bulk_create([
+        MessageSearchToken(message_id=message.pk, digest=d)
+        for d in message_digests(text)
+    ])
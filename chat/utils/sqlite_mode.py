@@ -0,0 +1,161 @@
+"""
+Embedded mode for the SQLite default database (SQLITE_EMBEDDED = True).
+
+SQLite allows one writer at a time. With several consumer threads (or
+Daphne workers) writing at once, each write waits for the file lock and
+gives up with "database is locked" after the timeout. Embedded mode:
+
+- configures every new file-backed connection (connection_created):
+  WAL journal, so readers never block the writer and vice versa;
+  synchronous=NORMAL (durable at checkpoints, safe with WAL);
+  busy_timeout, cache_size, mmap_size and temp_store from SQLITE_PRAGMAS.
+- runs every consumer write (consumers.db_write) on one writer thread.
+  The writer takes whatever is queued, up to SQLITE_WRITER_MAX_BATCH
+  jobs, and runs them in one transaction with a savepoint each. A job
+  that raises is rolled back alone; the others commit together, and
+  their callers get their results only after the commit.
+- leaves reads on the CONSUMER_DB_THREADS pool, which runs them
+  concurrently against the WAL snapshot.
+
+In-memory databases (the test database) cannot use WAL and are left
+alone. Within one process the writer serializes writes; several
+processes on one file still take turns on the lock, helped by
+busy_timeout.
+"""
+
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+from chat import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,       # ms
+    'cache_size': -64000,       # KiB (negative) = 64 MB page cache
+    'mmap_size': 268435456,     # 256 MB
+    'temp_store': 'MEMORY',
+}
+
+
+def enabled():
+    return bool(getattr(settings, 'SQLITE_EMBEDDED', False))
+
+
+def _file_backed(conn):
+    return conn.vendor == 'sqlite' and not conn.is_in_memory_db()
+
+
+def configure_connection(sender, connection, **kwargs):
+    """connection_created receiver: apply SQLITE_PRAGMAS to new SQLite connections"""
+    if not enabled() or not _file_backed(connection):
+        return
+    pragmas = {**DEFAULT_PRAGMAS, **getattr(settings, 'SQLITE_PRAGMAS', {})}
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+def writer_enabled():
+    return enabled() and _file_backed(connection)
+
+
+# ====================== WRITER QUEUE ======================
+
+class WriterQueue:
+    """One thread committing queued write jobs in grouped transactions"""
+
+    def __init__(self, max_batch=100):
+        self.max_batch = max_batch
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """Future for fn(*args, **kwargs), resolved after its transaction commits"""
+        future = Future()
+        self._queue.put((future, metrics.perf_counter(), fn, args, kwargs))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='chat-db-writer', daemon=True)
+                self._thread.start()
+        return future
+
+    def stop(self):
+        """Finish what is queued, close the writer's connection and end the thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [job for job in batch if job is not None]
+            if batch:
+                self._commit(batch)
+        connection.close()
+
+    def _commit(self, batch):
+        close_old_connections()
+        started = metrics.perf_counter()
+        done = []
+        try:
+            with transaction.atomic():
+                for future, queued, fn, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    metrics.SQLITE_WRITE_WAIT.observe(started - queued)
+                    try:
+                        with transaction.atomic():
+                            result = fn(*args, **kwargs)
+                    except Exception as e:
+                        future.set_exception(e)
+                        continue
+                    done.append((future, result))
+        except Exception as e:
+            logger.exception("sqlite writer: commit of %s job(s) failed", len(done))
+            for future, _ in done:
+                future.set_exception(e)
+        else:
+            for future, result in done:
+                future.set_result(result)
+        metrics.SQLITE_WRITE_BATCH.observe(len(batch))
+        metrics.SQLITE_WRITE_COMMIT.observe(metrics.perf_counter() - started)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = WriterQueue(int(getattr(settings, 'SQLITE_WRITER_MAX_BATCH', 100)))
+        return _writer
+
+
+def shutdown():
+    global _writer
+    with _writer_lock:
+        current, _writer = _writer, None
+    if current is not None:
+        current.stop()
@@ -0,0 +1,236 @@
+"""
+WebP thumbnails for image attachments.
+
+When a new image Attachment is stored, render_thumbnails() runs in a
+process pool (spawned workers, so nothing is forked from a threaded
+server) and returns one WebP per size in THUMBNAIL_SIZES plus the image
+dimensions. Orientation from EXIF is applied and no metadata is written
+to the thumbnails; the original blob is content-addressed and left as is.
+
+The parent process writes the files next to the blob's hash
+(thumbnails/ab/cd/<sha256>_<size>.webp) and records the finished sizes on
+the Attachment. Anything missing is scheduled again the next time a
+message using the attachment is serialized.
+
+Only formats Pillow decodes (DECODABLE_TYPES) are attempted; SVG and the
+like get no thumbnails. A failed render (corrupt file, decompression
+bomb) is recorded in Attachment.thumbnails_failed_at and not retried for
+THUMBNAIL_RETRY_AFTER seconds. Blobs without a local path are read on a
+background thread, never on the thread that serializes the message.
+"""
+
+import io
+import logging
+import os
+import threading
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = (160, 480, 1024)
+DEFAULT_RETRY_AFTER = 24 * 3600
+WEBP_QUALITY = 80
+DECODABLE_TYPES = frozenset({
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff',
+})
+
+_pool = None
+_reader = None
+_pool_lock = threading.Lock()
+_pending = set()
+
+
+def sizes():
+    from django.conf import settings
+    return tuple(getattr(settings, 'THUMBNAIL_SIZES', DEFAULT_SIZES))
+
+
+def supported(content_type):
+    """Whether thumbnails are made for this content type"""
+    return (content_type or '').split(';')[0].strip().lower() in DECODABLE_TYPES
+
+
+def retry_due(attachment):
+    """False while a recent failure for this attachment is backing off"""
+    import datetime
+
+    from django.conf import settings
+    from django.utils import timezone
+
+    if attachment.thumbnails_failed_at is None:
+        return True
+    retry_after = getattr(settings, 'THUMBNAIL_RETRY_AFTER', DEFAULT_RETRY_AFTER)
+    return timezone.now() - attachment.thumbnails_failed_at >= datetime.timedelta(seconds=retry_after)
+
+
+def thumbnail_name(sha256, size):
+    return os.path.join('thumbnails', sha256[:2], sha256[2:4], f"{sha256}_{size}.webp")
+
+
+def render_thumbnails(source, sizes):
+    """
+    Pool worker: path or bytes of an image -> (width, height, {size: webp bytes}).
+
+    Pure Pillow; does not touch Django, the database or storage.
+    """
+    from PIL import Image, ImageOps
+
+    with warnings.catch_warnings():
+        # Past MAX_IMAGE_PIXELS: fail instead of decoding with a warning
+        warnings.simplefilter('error', Image.DecompressionBombWarning)
+        with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as img:
+            width, height = img.size
+            if img.getexif().get(0x0112) in (5, 6, 7, 8):  # rotated by 90 degrees
+                width, height = height, width
+            # JPEG can decode at reduced scale straight away
+            img.draft('RGB', (max(sizes), max(sizes)))
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+
+            out = {}
+            for size in sorted(sizes, reverse=True):
+                thumb = img.copy()
+                thumb.thumbnail((size, size), Image.LANCZOS)
+                buf = io.BytesIO()
+                thumb.save(buf, 'WEBP', quality=WEBP_QUALITY, method=4)
+                out[size] = buf.getvalue()
+    return width, height, out
+
+
+def _get_pool(workers):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'))
+        return _pool
+
+
+def _get_reader(workers):
+    """Threads fetching blobs from storages without local paths"""
+    global _reader
+    with _pool_lock:
+        if _reader is None:
+            _reader = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat-thumbnail-read')
+        return _reader
+
+
+def _source_for(attachment):
+    """A local path when the storage has one, else the blob's bytes"""
+    try:
+        return attachment.blob.path
+    except NotImplementedError:
+        with attachment.blob.open('rb') as fh:
+            return fh.read()
+
+
+def _store(attachment_pk, result):
+    """Write rendered thumbnails and record them on the Attachment"""
+    from django.core.files.base import ContentFile
+
+    from chat.models import Attachment
+
+    width, height, rendered = result
+    attachment = Attachment.objects.filter(pk=attachment_pk).first()
+    if attachment is None:
+        return
+    storage = attachment.blob.storage
+    for size, data in rendered.items():
+        name = thumbnail_name(attachment.sha256, size)
+        if storage.exists(name):
+            storage.delete(name)
+        storage.save(name, ContentFile(data))
+    done = sorted(set(attachment.thumbnails or []) | set(rendered))
+    Attachment.objects.filter(pk=attachment_pk).update(
+        width=width, height=height, thumbnails=done, thumbnails_failed_at=None)
+
+
+def _failed(attachment_pk):
+    from django.utils import timezone
+
+    from chat.models import Attachment
+
+    logger.exception("thumbnails: failed for attachment %s", attachment_pk)
+    Attachment.objects.filter(pk=attachment_pk).update(thumbnails_failed_at=timezone.now())
+
+
+def generate(attachment):
+    """Render and store thumbnails synchronously (commands, tests, THUMBNAIL_WORKERS=0)"""
+    _store(attachment.pk, render_thumbnails(_source_for(attachment), sizes()))
+
+
+def schedule(attachment):
+    """
+    Queue thumbnail generation for an image Attachment (at most once at a
+    time per process). Returns True if it already ran synchronously.
+    """
+    from django.conf import settings
+
+    if not supported(attachment.content_type):
+        return False
+    workers = getattr(settings, 'THUMBNAIL_WORKERS', 2)
+    if workers <= 0:
+        try:
+            generate(attachment)
+        except Exception:
+            _failed(attachment.pk)
+        return True
+
+    pk = attachment.pk
+    with _pool_lock:
+        if pk in _pending:
+            return False
+        _pending.add(pk)
+
+    scheduler = threading.get_ident()
+
+    def done(future):
+        # Normally runs on the pool's result thread, which owns its DB connection
+        from django.db import connection
+        try:
+            _store(pk, future.result())
+        except Exception:
+            _failed(pk)
+        finally:
+            if threading.get_ident() != scheduler:
+                connection.close()
+            with _pool_lock:
+                _pending.discard(pk)
+
+    try:
+        pool = _get_pool(workers)
+        try:
+            future = pool.submit(render_thumbnails, attachment.blob.path, sizes())
+        except NotImplementedError:
+            # Remote storage: fetch the bytes on a reader thread, which then
+            # waits for the render
+            future = _get_reader(workers).submit(
+                lambda: pool.submit(render_thumbnails, _source_for(attachment), sizes()).result())
+    except Exception:
+        with _pool_lock:
+            _pending.discard(pk)
+        raise
+    future.add_done_callback(done)
+    return False
+
+
+def urls(attachment):
+    """
+    {size: url} of finished thumbnails (None if the type gets none);
+    schedules missing ones unless the last attempt failed recently
+    """
+    if not supported(attachment.content_type):
+        return None
+    wanted = sizes()
+    if not set(attachment.thumbnails or []).issuperset(wanted) and retry_due(attachment):
+        try:
+            if schedule(attachment):
+                attachment.refresh_from_db(fields=['thumbnails', 'width', 'height', 'thumbnails_failed_at'])
+        except Exception:
+            logger.exception("thumbnails: could not schedule attachment %s", attachment.pk)
+    ready = set(attachment.thumbnails or [])
+    storage = attachment.blob.storage
+    return {str(size): storage.url(thumbnail_name(attachment.sha256, size))
+            for size in wanted if size in ready}
@@ -0,0 +1,384 @@
+"""
+Streaming export and import of conversations (manage.py export_chats /
+import_chats).
+
+An export is a directory:
+
+    users.jsonl        username, email and names of every user
+    projects.jsonl     name, description, creator and member usernames
+    messages.jsonl     one message per line in id order, with its plaintext
+    attachments.tar    the attachment blobs those messages reference
+                       (attachments/<sha256>.<ext>) and pre-attachment
+                       message files (files/<storage name>)
+
+Users and projects are referred to by username / name, so an export can
+be loaded into another installation: missing users are created with
+unusable passwords and missing projects by name. Bodies are decrypted on
+export and re-encrypted with the importing side's primary key, both on a
+process pool; the import also writes the search tokens. Messages already
+moved to cold storage (utils/archive.py) are not exported.
+
+Both directions stream: rows are read with .iterator(chunk_size) or line
+by line, handled batch_size at a time and written before the next batch
+is read, so memory stays flat whatever the history size. The one thing an
+import has to remember is the new id of each exported message, for
+replies; it keeps the last REPLY_WINDOW of them, and a reply to anything
+older is imported without its reply_to (counted as `unresolved_replies`).
+Importing the same export twice duplicates its messages (and stores its
+pre-attachment files again, under new names: an existing file with the
+exported name is never assumed to be the same one).
+"""
+
+import collections
+import itertools
+import json
+import logging
+import os
+import tarfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.utils.dateparse import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+USERS = 'users.jsonl'
+PROJECTS = 'projects.jsonl'
+MESSAGES = 'messages.jsonl'
+ATTACHMENTS = 'attachments.tar'
+
+REPLY_WINDOW = 100000
+
+# pax header carrying an attachment's content type in attachments.tar
+CONTENT_TYPE_HEADER = 'CHAT.content_type'
+
+MESSAGE_COLUMNS = (
+    'id', 'sender__username', 'receiver__username', 'project__name', 'encrypted_text',
+    'kind', 'meeting_id', 'attachment__sha256', 'file', 'file_name', 'reply_to_id',
+    'is_read', 'timestamp',
+)
+
+
+class Progress:
+    """Row counters plus a rate; `report` is called with it after every batch"""
+
+    def __init__(self, report=None):
+        self.counts = collections.Counter()
+        self.started = time.monotonic()
+        self._report = report
+
+    def add(self, **counts):
+        self.counts.update(counts)
+        if self._report is not None:
+            self._report(self)
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rows_per_sec(self):
+        return self.counts['messages'] / self.elapsed if self.elapsed > 0 else 0.0
+
+
+# ====================== WORKERS ======================
+
+def _decrypt(tokens):
+    """Worker: ciphertexts -> plaintexts (None where there is none or it fails)"""
+    from chat.utils.encryption import decrypt_message
+    texts = []
+    for token in tokens:
+        try:
+            texts.append(decrypt_message(token) if token else None)
+        except Exception:
+            texts.append(None)
+    return texts
+
+
+def _encrypt(texts):
+    """Worker: plaintexts -> [(ciphertext, search digests)]"""
+    from chat.utils.encryption import encrypt_message
+    from chat.utils.search_index import message_digests
+    return [(encrypt_message(text), message_digests(text)) if text is not None else (None, [])
+            for text in texts]
+
+
+def _map(pool, workers, fn, items):
+    """fn over items, split across the pool's processes, results in order"""
+    if pool is None or len(items) < 2:
+        return fn(items)
+    size = max(1, -(-len(items) // workers))
+    parts = [items[i:i + size] for i in range(0, len(items), size)]
+    return list(itertools.chain.from_iterable(pool.map(fn, parts)))
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def _pool(workers):
+    return ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+
+
+def _write_lines(path, records):
+    with open(path, 'w', encoding='utf-8') as out:
+        for record in records:
+            out.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+
+def _read_lines(path):
+    if not os.path.exists(path):
+        return
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+# ====================== EXPORT ======================
+
+def export_chats(directory, since=None, batch_size=1000, workers=0, report=None):
+    """Write users, projects, messages (timestamp >= since) and their files to `directory`"""
+    from chat.models import Attachment, Message, Project
+
+    os.makedirs(directory, exist_ok=True)
+    progress = Progress(report)
+
+    _write_lines(os.path.join(directory, USERS), (
+        {'username': u.username, 'email': u.email,
+         'first_name': u.first_name, 'last_name': u.last_name}
+        for u in User.objects.order_by('id').iterator(chunk_size=batch_size)))
+    _write_lines(os.path.join(directory, PROJECTS), (
+        {'name': p.name, 'description': p.description,
+         'created_by': p.created_by.username if p.created_by else None,
+         'members': [m.username for m in p.members.all()]}
+        for p in Project.objects.select_related('created_by').prefetch_related('members')
+        .order_by('id').iterator(chunk_size=batch_size)))
+
+    messages = Message.objects.order_by('id')
+    if since is not None:
+        messages = messages.filter(timestamp__gte=since)
+
+    pool = _pool(workers)
+    try:
+        with open(os.path.join(directory, MESSAGES), 'w', encoding='utf-8') as out:
+            rows = messages.values_list(*MESSAGE_COLUMNS).iterator(chunk_size=batch_size)
+            for batch in _batches(rows, batch_size):
+                tokens = [bytes(row[4]) if row[4] else None for row in batch]
+                texts = _map(pool, workers, _decrypt, tokens)
+                failed = 0
+                for row, token, text in zip(batch, tokens, texts):
+                    if token and text is None:
+                        failed += 1
+                        logger.warning("export_chats: could not decrypt message %s", row[0])
+                    out.write(json.dumps(_message_record(row, text), ensure_ascii=False,
+                                         separators=(',', ':')) + '\n')
+                progress.add(messages=len(batch), failed=failed)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    with tarfile.open(os.path.join(directory, ATTACHMENTS), 'w', format=tarfile.PAX_FORMAT) as tar:
+        attachments = Attachment.objects.filter(
+            id__in=messages.filter(attachment__isnull=False).values('attachment_id'))
+        for attachment in attachments.order_by('id').iterator(chunk_size=batch_size):
+            name = f"attachments/{os.path.basename(attachment.blob.name)}"
+            headers = {CONTENT_TYPE_HEADER: attachment.content_type}
+            progress.add(attachments=_add_file(tar, attachment.blob.name, name, headers))
+        legacy = (messages.filter(attachment__isnull=True).exclude(file='').exclude(file__isnull=True)
+                  .order_by().values_list('file', flat=True).distinct())
+        for stored in legacy.iterator(chunk_size=batch_size):
+            progress.add(files=_add_file(tar, stored, f"files/{stored}"))
+    return progress
+
+
+def _message_record(row, text):
+    (pk, sender, receiver, project, _, kind, meeting_id, sha256, stored, file_name,
+     reply_to_id, is_read, timestamp) = row
+    return {
+        'id': pk,
+        'sender': sender,
+        'receiver': receiver,
+        'project': project,
+        'text': text,
+        'kind': kind,
+        'meeting': str(meeting_id) if meeting_id else None,
+        'attachment': sha256,
+        'file': stored if stored and not sha256 else None,
+        'file_name': file_name,
+        'reply_to': reply_to_id,
+        'is_read': is_read,
+        'timestamp': timestamp.isoformat(),
+    }
+
+
+def _add_file(tar, stored, name, headers=None):
+    """Copy one storage file into the tar; 0 if it is missing"""
+    try:
+        size = default_storage.size(stored)
+        f = default_storage.open(stored, 'rb')
+    except (OSError, ValueError):
+        logger.warning("export_chats: missing file %s", stored)
+        return 0
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    if headers:
+        info.pax_headers = headers
+    with f:
+        tar.addfile(info, f)
+    return 1
+
+
+# ====================== IMPORT ======================
+
+def import_chats(directory, batch_size=1000, workers=0, report=None):
+    """Load an export_chats directory; returns the Progress counters"""
+    progress = Progress(report)
+    for batch in _batches(_read_lines(os.path.join(directory, USERS)), batch_size):
+        progress.add(users=len(_users(batch)))
+    for record in _read_lines(os.path.join(directory, PROJECTS)):
+        _import_project(record)
+        progress.add(projects=1)
+
+    files = {}  # exported storage name -> name stored under here
+    path = os.path.join(directory, ATTACHMENTS)
+    if os.path.exists(path):
+        with tarfile.open(path, 'r') as tar:
+            for member in tar:
+                if member.isfile():
+                    progress.add(**{_import_file(tar, member, files): 1})
+
+    replies = collections.OrderedDict()
+    pool = _pool(workers)
+    try:
+        for batch in _batches(_read_lines(os.path.join(directory, MESSAGES)), batch_size):
+            payloads = _map(pool, workers, _encrypt, [record['text'] for record in batch])
+            unresolved = _import_messages(batch, payloads, replies, files)
+            progress.add(messages=len(batch), unresolved_replies=unresolved)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return progress
+
+
+def _users(records):
+    """{username: id} for user records (or bare usernames), creating the missing ones"""
+    records = [r if isinstance(r, dict) else {'username': r} for r in records]
+    names = {r['username'] for r in records}
+    existing = set(User.objects.filter(username__in=names).values_list('username', flat=True))
+    missing = []
+    for record in records:
+        if record['username'] in existing:
+            continue
+        existing.add(record['username'])
+        user = User(**{k: record.get(k) or '' for k in ('username', 'email', 'first_name', 'last_name')})
+        user.set_unusable_password()
+        missing.append(user)
+    User.objects.bulk_create(missing, ignore_conflicts=True)
+    return dict(User.objects.filter(username__in=names).values_list('username', 'id'))
+
+
+def _import_project(record):
+    from chat.models import Project
+    users = _users([*record['members'], *filter(None, [record['created_by']])])
+    project, _ = Project.objects.get_or_create(name=record['name'], defaults={
+        'description': record['description'],
+        'created_by_id': users.get(record['created_by']),
+    })
+    project.members.add(*users.values())
+
+
+def _import_file(tar, member, files):
+    """
+    Store one tar member; returns the Progress counter it counts towards.
+    Message files are saved under a name storage picks (a local file may
+    already use the exported one), recorded in `files`.
+    """
+    from chat.models import Attachment, blob_path
+
+    kind, _, name = member.name.partition('/')
+    if kind == 'files':
+        files[name] = default_storage.save(name, File(tar.extractfile(member), name=name))
+        return 'files'
+    if kind != 'attachments':
+        return 'skipped'
+    sha256 = os.path.splitext(name)[0]
+    if not Attachment.objects.filter(sha256=sha256).exists():
+        path = blob_path(sha256, name)
+        if not default_storage.exists(path):
+            path = default_storage.save(path, File(tar.extractfile(member), name=name))
+        Attachment.link(sha256, path, member.size, member.pax_headers.get(CONTENT_TYPE_HEADER, ''))
+    return 'attachments'
+
+
+def _import_messages(records, payloads, replies, files):
+    """bulk_create one batch with its search tokens; returns unresolved replies"""
+    from chat.models import Attachment, Meeting, Message, MessageSearchToken, Project, dm_key, project_key
+
+    users = _users({name for r in records for name in (r['sender'], r['receiver']) if name})
+    projects = dict(Project.objects.filter(name__in={r['project'] for r in records if r['project']})
+                    .values_list('name', 'id'))
+    for name in {r['project'] for r in records if r['project']} - projects.keys():
+        projects[name] = Project.objects.get_or_create(name=name)[0].id
+    attachments = {sha: (pk, blob) for sha, pk, blob in Attachment.objects.filter(
+        sha256__in={r['attachment'] for r in records if r['attachment']}
+    ).values_list('sha256', 'id', 'blob')}
+    meetings = {str(pk) for pk in Meeting.objects.filter(
+        id__in={r['meeting'] for r in records if r['meeting']}).values_list('id', flat=True)}
+
+    messages, pending = [], []
+    for record, (token, _) in zip(records, payloads):
+        project_id = projects.get(record['project'])
+        sender_id, receiver_id = users[record['sender']], users.get(record['receiver'])
+        attachment_id, stored = attachments.get(record['attachment'], (None, files.get(record['file'])))
+        reply_to_id = replies.get(record['reply_to'])
+        message = Message(
+            sender_id=sender_id,
+            receiver_id=None if project_id else receiver_id,
+            project_id=project_id,
+            encrypted_text=token,
+            kind=record['kind'],
+            meeting_id=record['meeting'] if record['meeting'] in meetings else None,
+            attachment_id=attachment_id,
+            file=stored or None,
+            file_name=record['file_name'] or '',
+            reply_to_id=reply_to_id,
+            is_read=record['is_read'],
+            timestamp=parse_datetime(record['timestamp']),
+            conversation_key=project_key(project_id) if project_id else dm_key(sender_id, receiver_id),
+        )
+        if record['reply_to'] is not None and reply_to_id is None:
+            pending.append((message, record['reply_to']))
+        messages.append(message)
+
+    with transaction.atomic():
+        Message.objects.bulk_create(messages)
+        MessageSearchToken.objects.bulk_create([
+            MessageSearchToken(message_id=message.pk, digest=d)
+            for message, (_, digests) in zip(messages, payloads) for d in digests
+        ])
+        refs = collections.Counter(m.attachment_id for m in messages if m.attachment_id)
+        for count, ids in itertools.groupby(sorted(refs, key=refs.get), key=refs.get):
+            Attachment.objects.filter(id__in=list(ids)).update(ref_count=F('ref_count') + count)
+
+        for record, message in zip(records, messages):
+            replies[record['id']] = message.pk
+        # Replies to messages of this same batch
+        resolved = []
+        for message, source in pending:
+            message.reply_to_id = replies.get(source)
+            if message.reply_to_id is not None:
+                resolved.append(message)
+        Message.objects.bulk_update(resolved, ['reply_to'])
+
+    while len(replies) > REPLY_WINDOW:
+        replies.popitem(last=False)
+    return len(pending) - len(resolved)
@@ -0,0 +1,132 @@
+"""
+Streaming, hashing uploads for content-addressed attachments.
+
+HashingUploadHandler spools every uploaded file to a temporary file on disk
+(never to memory, whatever FILE_UPLOAD_MAX_MEMORY_SIZE says) and computes its
+SHA-256 on the way, so storing it as an Attachment needs no second read.
+
+Uploads are referenced from messages through a signed token that binds the
+hash to the uploading user; knowing a file's hash is not enough to attach
+somebody else's upload.
+"""
+
+import hashlib
+from collections import namedtuple
+
+from django.core import signing
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import StopUpload, TemporaryFileUploadHandler
+
+TOKEN_SALT = 'chat.attachment'
+TOKEN_MAX_AGE = 24 * 60 * 60
+
+# A blob written by write_blob(), ready for Attachment.link()
+StoredBlob = namedtuple('StoredBlob', 'sha256 name size content_type')
+
+# Uploads since start by outcome, exported as chat_attachment_uploads_total.
+# Never returned to clients: whether content already existed would tell an
+# uploader that some other user has stored the same file.
+counts = {'stored': 0, 'deduplicated': 0}
+
+
+def count(created):
+    counts['stored' if created else 'deduplicated'] += 1
+
+
+class HashingUploadHandler(TemporaryFileUploadHandler):
+    """Temporary-file upload handler that also hashes and caps the size"""
+
+    def __init__(self, request=None, max_size=None):
+        super().__init__(request)
+        self.max_size = max_size
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hasher = hashlib.sha256()
+        self.received = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.max_size is not None and self.received > self.max_size:
+            self.file.close()
+            raise StopUpload(connection_reset=False)
+        self.hasher.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded = super().file_complete(file_size)
+        uploaded.sha256 = self.hasher.hexdigest()
+        return uploaded
+
+
+def hash_file(f, chunk_size=1024 * 1024):
+    """SHA-256 of a Django File, read in chunks (for uploads not hashed on arrival)"""
+    sha256 = getattr(f, 'sha256', None)
+    if sha256:
+        return sha256
+    hasher = hashlib.sha256()
+    for chunk in f.chunks(chunk_size):
+        hasher.update(chunk)
+    f.seek(0)
+    return hasher.hexdigest()
+
+
+def make_token(attachment, user, name=''):
+    """Signed reference to an upload; also carries the name it was uploaded under"""
+    return signing.dumps({'a': attachment.pk, 'u': user.pk, 'n': name or ''},
+                         salt=TOKEN_SALT, compress=True)
+
+
+def attachment_from_token(token, user):
+    """
+    The Attachment a token grants `user`, or None if invalid/expired/foreign.
+    Its upload_name attribute is the name given at upload time.
+    """
+    from chat.models import Attachment
+
+    try:
+        data = signing.loads(token, salt=TOKEN_SALT, max_age=TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return None
+    if data.get('u') != user.pk:
+        return None
+    attachment = Attachment.objects.filter(pk=data.get('a')).first()
+    if attachment is not None:
+        attachment.upload_name = data.get('n', '')
+    return attachment
+
+
+def store_upload(f, content_type=None):
+    """
+    (attachment, created) for an uploaded or constructed Django File,
+    deduplicated by hash
+    """
+    from chat.models import Attachment
+
+    attachment, created = Attachment.store(
+        f, hash_file(f), f.name or 'file',
+        content_type=content_type or getattr(f, 'content_type', '') or '')
+    count(created)
+    return attachment, created
+
+
+def write_blob(data, name, content_type=''):
+    """
+    Hash `data` and write it to storage under its content-addressed name
+    unless it is already there. Touches no database, so it can run on any
+    thread; the ORM side then only links the result (Attachment.link).
+    A blob that never gets linked is picked up by the next upload of the
+    same content; one the content is already stored under another name
+    for is deleted by Attachment.link.
+    """
+    from chat.models import blob_path
+
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = blob_path(sha256, name or '')
+    if not default_storage.exists(path):
+        saved = default_storage.save(path, ContentFile(data))
+        if saved != path:
+            # Another writer got there first with the same content
+            default_storage.delete(saved)
+    return StoredBlob(sha256, path, len(data), content_type or '')
@@ -0,0 +1,87 @@
+"""
+Cache of serialized user cards (UserSerializer output: user fields plus
+profile, avatar URLs, online state).
+
+Cards live in the USER_CARD_CACHE cache alias ('default': locmem, or
+Redis when REDIS_URL is set; see settings). Each user has two keys:
+
+    chat:user-card-version:<id>   a random token, replaced by bump()
+    chat:user-card:<id>           (version token, card)
+
+A card is only used while its version token matches the current one.
+bump() runs from post_save on User and UserProfile (chat/models.py), so
+a profile change invalidates the card everywhere at once, and a card
+rebuilt from data read before the change is stored under the old token
+and never served. get_many() fetches both keys of every user in one
+cache round-trip and builds only the misses.
+
+When the version key itself is missing (first use, or evicted) a new
+token is made up; a card built concurrently with a change in that window
+can then be served for at most USER_CARD_TTL seconds.
+"""
+
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+DEFAULT_TTL = 300
+
+# Lookups since start, exported as chat_user_card_lookups_total
+counts = {'hit': 0, 'miss': 0}
+
+
+def _cache():
+    return caches[getattr(settings, 'USER_CARD_CACHE', 'default')]
+
+
+def _version_key(user_id):
+    return f"chat:user-card-version:{user_id}"
+
+
+def _card_key(user_id):
+    return f"chat:user-card:{user_id}"
+
+
+def bump(user_id):
+    """Invalidate a user's cached card"""
+    _cache().set(_version_key(user_id), uuid.uuid4().hex[:12], timeout=None)
+
+
+def get_many(users, build):
+    """
+    Cards of `users` in order. `build(missing users)` returns the cards
+    of those not cached (or stale), in the same order; they are stored
+    for the next request.
+    """
+    if not users:
+        return []
+    cache = _cache()
+    ids = {user.pk for user in users}
+    found = cache.get_many([key for pk in ids for key in (_version_key(pk), _card_key(pk))])
+
+    cards, missing = {}, []
+    for user in users:
+        if user.pk in cards:
+            continue
+        version, entry = found.get(_version_key(user.pk)), found.get(_card_key(user.pk))
+        if version is not None and entry is not None and entry[0] == version:
+            cards[user.pk] = entry[1]
+        else:
+            cards[user.pk] = None
+            missing.append(user)
+    counts['hit'] += len(ids) - len(missing)
+    counts['miss'] += len(missing)
+
+    if missing:
+        versions = {_version_key(user.pk): uuid.uuid4().hex[:12]
+                    for user in missing if _version_key(user.pk) not in found}
+        if versions:
+            cache.set_many(versions, timeout=None)
+            found.update(versions)
+        built = build(missing)
+        cache.set_many(
+            {_card_key(user.pk): (found[_version_key(user.pk)], card) for user, card in zip(missing, built)},
+            timeout=getattr(settings, 'USER_CARD_TTL', DEFAULT_TTL))
+        cards.update((user.pk, card) for user, card in zip(missing, built))
+    return [cards[user.pk] for user in users]
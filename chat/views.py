@@ -10,19 +10,26 @@ from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import LoginView
 from django.shortcuts import render, redirect, get_object_or_404
-from django.db.models import Q, F
+from django.db.models import Q, F, Count
 from django.views.generic import TemplateView
 from django.utils.decorators import method_decorator
 from django.utils import timezone
 from django.conf import settings
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-from .models import Message, Project
+from .models import Message, MessageSearchToken, Project, UserProfile, dm_key, project_key
 from .serializers import (
     MessageSerializer, UserSerializer, ProjectSerializer,
-    MessageCreateSerializer, RecentChatSerializer, SidebarItemSerializer
+    MessageCreateSerializer, RecentChatSerializer,
+    ConversationFileSerializer, SerializerConfig, message_data, sidebar_data
 )
 from .forms import SignUpForm
+from .metrics import serialized, serialized_with
+from .routers import reads_from_replica
+from .utils import archive
+from .utils.search_index import query_digests
+from .utils.uploads import HashingUploadHandler, make_token, store_upload
+from .utils.avatars import AVATAR_SIZES, save_avatar, urls as avatar_urls
 from django.contrib.auth import login
 
 # ==================== LOGIN VIEW ====================
@@ -71,6 +78,7 @@ class UserViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticatedPermission]
 
     @action(detail=False, methods=['get'])
+    @reads_from_replica
     def search(self, request):
         """Search users by username or email"""
         q = request.query_params.get('q', '')
@@ -80,13 +88,13 @@ class UserViewSet(viewsets.ModelViewSet):
             Q(username__icontains=q) | Q(email__icontains=q)
         ).exclude(id=request.user.id)[:20]
         serializer = self.get_serializer(users, many=True)
-        return Response(serializer.data)
+        return Response(serialized(serializer))
 
     @action(detail=False, methods=['get'])
     def me(self, request):
         """Get current user info"""
         serializer = self.get_serializer(request.user)
-        return Response(serializer.data)
+        return Response(serialized(serializer))
 
     @action(detail=True, methods=['post'])
     def block(self, request, pk=None):
@@ -117,7 +125,7 @@ class UserViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['post'], parser_classes=[MultiPartParser, FormParser])
     def upload_avatar(self, request):
-        """Upload or update user avatar."""
+        """Upload or update user avatar (stored as square WebP sizes, content-hashed)."""
         user = request.user
         if 'avatar' not in request.FILES:
             return Response({'error': 'No avatar file provided'}, status=status.HTTP_400_BAD_REQUEST)
@@ -130,15 +138,20 @@ class UserViewSet(viewsets.ModelViewSet):
         try:
             profile = user.profile
         except UserProfile.DoesNotExist:
-            from .models import UserProfile
             profile = UserProfile.objects.create(user=user)
 
-        profile.avatar = f
-        profile.save()
+        try:
+            save_avatar(profile, f)
+        except ValueError as e:
+            return Response({'error': f'Invalid image: {e}'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Return the new avatar URL
-        avatar_url = request.build_absolute_uri(profile.avatar.url)
-        return Response({'avatar_url': avatar_url, 'message': 'Avatar updated successfully'})
+        # Return the new avatar URLs (a new avatar always gets new URLs)
+        urls = {size: request.build_absolute_uri(url) for size, url in avatar_urls(profile).items()}
+        return Response({
+            'avatar_url': urls[str(AVATAR_SIZES[-1])],
+            'avatar_urls': urls,
+            'message': 'Avatar updated successfully',
+        })
 
     @action(detail=False, methods=['get'])
     def blocked(self, request):
@@ -176,12 +189,14 @@ class MessageViewSet(viewsets.ModelViewSet):
     - GET /api/messages/project/{id}/ - Get project messages
     - POST /api/messages/send/ - Send message
     - GET /api/messages/recent_chats/ - Get recent conversations
+    - GET /api/messages/search/?q= - Keyword search in visible conversations
     """
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticatedPermission]
     parser_classes = (MultiPartParser, FormParser, JSONParser)
 
     @action(detail=False, methods=['get'], url_path='user/(?P<user_id>[^/.]+)')
+    @reads_from_replica
     def get_user_messages(self, request, user_id=None):
         """Get DM conversation with specific user"""
         try:
@@ -189,20 +204,19 @@ class MessageViewSet(viewsets.ModelViewSet):
         except User.DoesNotExist:
             return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        messages = Message.objects.filter(
-            Q(sender=request.user, receiver=other_user) |
-            Q(sender=other_user, receiver=request.user)
-        ).order_by('timestamp', 'id')
+        key = dm_key(request.user.id, other_user.id)
+        messages = Message.objects.in_conversation(key).select_related(
+            'meeting', 'attachment').order_by('timestamp', 'id')
 
         # Mark as read
-        Message.objects.filter(
-            sender=other_user, receiver=request.user, is_read=False
+        Message.objects.in_conversation(key).filter(
+            receiver=request.user, is_read=False
         ).update(is_read=True)
 
-        serializer = self.get_serializer(messages, many=True)
-        return Response(serializer.data)
+        return self._history(request, key, messages)
 
     @action(detail=False, methods=['get'], url_path='project/(?P<project_id>[^/.]+)')
+    @reads_from_replica
     def get_project_messages(self, request, project_id=None):
         """Get messages for a project"""
         try:
@@ -213,13 +227,42 @@ class MessageViewSet(viewsets.ModelViewSet):
         if request.user not in project.members.all():
             return Response({'error': 'Not a member of this project'}, status=status.HTTP_403_FORBIDDEN)
 
-        messages = project.messages.all().order_by('timestamp', 'id')
+        key = project_key(project.id)
+        messages = Message.objects.in_conversation(key).select_related(
+            'meeting', 'attachment').order_by('timestamp', 'id')
 
         # Mark as read
         messages.filter(is_read=False).exclude(sender=request.user).update(is_read=True)
 
-        serializer = self.get_serializer(messages, many=True)
-        return Response(serializer.data)
+        return self._history(request, key, messages)
+
+    def _history(self, request, key, messages):
+        """
+        The whole live history (oldest first), or with ?limit= (max 200) and
+        ?before=<message id> the page of messages just before the cursor.
+        Pages follow message ids, not timestamps: imported messages keep
+        their original timestamps on new ids (import_chats), and a
+        timestamp order would skip them. Pages continue into the cold archive (utils/archive.py) once the
+        cursor is past the oldest message still in the table.
+        """
+        params = request.query_params
+        if 'limit' not in params and 'before' not in params:
+            return Response(serialized_with(message_data, messages, request))
+        try:
+            limit = min(max(int(params.get('limit', 50)), 1), 200)
+            before = int(params['before']) if params.get('before') else None
+        except ValueError:
+            return Response({'error': 'limit and before must be integers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        page = messages.order_by('-id')
+        if before is not None:
+            page = page.filter(id__lt=before)
+        page = list(page[:limit])
+        if len(page) < limit:
+            page += archive.read(key, before=page[-1].id if page else before, limit=limit - len(page))
+        page.reverse()
+        return Response(serialized_with(message_data, page, request))
 
     @action(detail=False, methods=['post'])
     def send(self, request):
@@ -227,10 +270,50 @@ class MessageViewSet(viewsets.ModelViewSet):
         serializer = MessageCreateSerializer(data=request.data, context={'request': request})
         if serializer.is_valid():
             serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            return Response(serialized(serializer), status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     @action(detail=False, methods=['get'])
+    @reads_from_replica
+    def search(self, request):
+        """
+        Whole-word search over the blind index, newest first.
+
+        ?q=words (all must match), ?limit= (max 100), ?before=<message id>
+        to fetch the next page. Only the returned page is decrypted.
+        """
+        digests = query_digests(request.query_params.get('q', ''))
+        if not digests:
+            return Response({'error': 'Query has no searchable words'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(max(int(request.query_params.get('limit', 20)), 1), 100)
+            before = request.query_params.get('before')
+            before = int(before) if before else None
+        except ValueError:
+            return Response({'error': 'limit and before must be integers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Posting-list intersection: messages holding every query digest
+        matching = (
+            MessageSearchToken.objects.filter(digest__in=set(digests))
+            .values('message_id')
+            .annotate(hits=Count('digest'))
+            .filter(hits=len(set(digests)))
+            .values('message_id')
+        )
+        messages = Message.objects.visible_to(request.user).filter(id__in=matching)
+        if before is not None:
+            messages = messages.filter(id__lt=before)
+        page = list(messages.select_related('sender', 'receiver', 'project', 'meeting', 'attachment').order_by('-id')[:limit + 1])
+
+        return Response({
+            'results': serialized_with(message_data, page[:limit], request),
+            'next_before': page[limit - 1].id if len(page) > limit else None,
+        })
+
+    @action(detail=False, methods=['get'])
+    @reads_from_replica
     def recent_chats(self, request):
         """Get unified recent conversations (DMs and Projects)"""
         
@@ -253,11 +336,9 @@ class MessageViewSet(viewsets.ModelViewSet):
             # Avoid showing blocked users if necessary, but skipping for now to match old logic
             
             if other_user.id not in conversations_dict:
-                unread = Message.objects.filter(
-                    sender=other_user, 
-                    receiver=request.user, 
-                    is_read=False
-                ).count()
+                unread = Message.objects.in_conversation(
+                    dm_key(request.user.id, other_user.id)
+                ).filter(receiver=request.user, is_read=False).count()
                 
                 conversations_dict[other_user.id] = {
                     'type': 'user',
@@ -271,14 +352,16 @@ class MessageViewSet(viewsets.ModelViewSet):
         items.extend(conversations_dict.values())
 
         # 2. PROCESS PROJECTS
-        projects = Project.objects.filter(members=request.user)
+        projects = Project.objects.filter(members=request.user).select_related(
+            'created_by').prefetch_related('members')
         for proj in projects:
-            last_msg = proj.messages.all().order_by('-timestamp', '-id').first()
+            conversation = Message.objects.in_conversation(project_key(proj.id))
+            last_msg = conversation.order_by('-timestamp', '-id').first()
             
             # Count unread messages in project (any message not by me that is unread)
             # Note: Is_read logic in projects might benefit from a separate ReadReceipt model 
             # effectively, currently Message.is_read is global. Assuming simplistic "unread" here.
-            unread = proj.messages.filter(is_read=False).exclude(sender=request.user).count()
+            unread = conversation.filter(is_read=False).exclude(sender=request.user).count()
             
             ts = last_msg.timestamp if last_msg else proj.created_at
             txt = last_msg.text[:200] if last_msg and last_msg.text else ('Attachment' if last_msg and last_msg.file else '')
@@ -302,8 +385,98 @@ class MessageViewSet(viewsets.ModelViewSet):
 
         items.sort(key=get_sort_key, reverse=True)
 
-        serializer = SidebarItemSerializer(items, many=True, context={'request': request})
-        return Response(serializer.data)
+        # Every user card on the page (DM partners, project members) comes
+        # from one cache round-trip
+        return Response(serialized_with(sidebar_data, items))
+
+class AttachmentViewSet(viewsets.ViewSet):
+    """
+    POST /api/attachments/ (multipart, field "file")
+
+    Streams the upload to a temp file while hashing it, stores it once per
+    distinct content, and returns a token to pass as attachment_token when
+    sending the message. Re-uploading known content writes nothing.
+    """
+    permission_classes = [IsAuthenticatedPermission]
+    parser_classes = (MultiPartParser,)
+
+    def initialize_request(self, request, *args, **kwargs):
+        # Must be in place before anything reads the request body
+        request.upload_handlers = [
+            HashingUploadHandler(request, max_size=SerializerConfig.MAX_FILE_SIZE)
+        ]
+        return super().initialize_request(request, *args, **kwargs)
+
+    def create(self, request):
+        f = request.FILES.get('file')
+        if f is None:
+            return Response(
+                {'error': f'No file provided (max {SerializerConfig.MAX_FILE_SIZE // (1024 * 1024)}MB)'},
+                status=status.HTTP_400_BAD_REQUEST)
+        if f.content_type not in SerializerConfig.ALLOWED_FILE_TYPES:
+            return Response({'error': f'File type not allowed: {f.content_type}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        attachment, _ = store_upload(f)
+        return Response({
+            'attachment_token': make_token(attachment, request.user, f.name),
+            'sha256': attachment.sha256,
+            'size': attachment.size,
+            # This upload's type, not the stored row's: that one may come
+            # from another user's earlier upload of the same bytes
+            'content_type': f.content_type,
+        }, status=status.HTTP_201_CREATED)
+
+
+class ConversationViewSet(viewsets.ViewSet):
+    """
+    GET /api/conversations/<user|project>/<id>/files/?limit=&before=
+
+    Files shared in a DM or project, newest first, served from the
+    (conversation, kind, id) indexes without touching message bodies.
+    'count' is the total number of files in the conversation; pass the
+    last message_id of a page as ?before= to get the next one.
+    """
+    permission_classes = [IsAuthenticatedPermission]
+
+    def _messages(self, request, chat_type, chat_id):
+        """Messages of the conversation, or an error Response"""
+        if chat_type == 'user':
+            other = User.objects.filter(id=chat_id).first()
+            if other is None:
+                return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+            return Message.objects.in_conversation(dm_key(request.user.id, other.id))
+        project = Project.objects.filter(id=chat_id).first()
+        if project is None:
+            return Response({'error': 'Project not found'}, status=status.HTTP_404_NOT_FOUND)
+        if not project.members.filter(id=request.user.id).exists():
+            return Response({'error': 'Not a member of this project'}, status=status.HTTP_403_FORBIDDEN)
+        return Message.objects.in_conversation(project_key(project.id))
+
+    @action(detail=False, methods=['get'],
+            url_path=r'(?P<chat_type>user|project)/(?P<chat_id>\d+)/files')
+    def files(self, request, chat_type=None, chat_id=None):
+        messages = self._messages(request, chat_type, chat_id)
+        if isinstance(messages, Response):
+            return messages
+        try:
+            limit = min(max(int(request.query_params.get('limit', 50)), 1), 200)
+            before = request.query_params.get('before')
+            before = int(before) if before else None
+        except ValueError:
+            return Response({'error': 'limit and before must be integers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        files = messages.filter(kind=Message.KIND_FILE).exclude(file='')
+        page = files.filter(id__lt=before) if before else files
+        page = list(page.select_related('attachment').order_by('-id')[:limit])
+        data = ConversationFileSerializer(page, many=True, context={'request': request}).data
+        return Response({
+            'count': files.count(),
+            'message_count': messages.count(),
+            'results': data,
+            'next_before': page[-1].id if len(page) == limit else None,
+        })
 
 # ==================== PAGE VIEWS ====================
 
@@ -477,7 +650,8 @@ def create_meeting(request):
         try:
             if target_type == 'user':
                 receiver = User.objects.get(id=target_id)
-                msg = Message(sender=request.user, receiver=receiver)
+                msg = Message(sender=request.user, receiver=receiver,
+                              kind=Message.KIND_MEETING_INVITE, meeting=meeting)
                 msg.text = message_text
                 msg.save()
                 
@@ -502,7 +676,8 @@ def create_meeting(request):
                 
             elif target_type == 'project':
                 project = Project.objects.get(id=target_id)
-                msg = Message(sender=request.user, project=project)
+                msg = Message(sender=request.user, project=project,
+                              kind=Message.KIND_MEETING_INVITE, meeting=meeting)
                 msg.text = message_text
                 msg.save()
                 
@@ -548,29 +723,29 @@ def end_meeting(request, meeting_id):
     meet.ended = True
     meet.save()
     
-    match_str = f'"{meet.id}"' 
-    messages = Message.objects.filter(text__contains=match_str, sender=request.user)
+    # Conversations the host invited, via the (meeting, kind) columns
+    targets = (
+        Message.objects.filter(
+            meeting=meet, kind=Message.KIND_MEETING_INVITE, sender=request.user)
+        .order_by()
+        .values_list('receiver_id', 'project_id')
+        .distinct()
+    )
     
-    processed_targets = set()
     channel_layer = get_channel_layer()
     
-    for m in messages:
-        target_key = f"u_{m.receiver_id}" if m.receiver else f"p_{m.project_id}"
-        if target_key in processed_targets:
-            continue
-            
-        processed_targets.add(target_key)
-        
+    for receiver_id, project_id in targets:
         end_payload = json.dumps({"id": str(meet.id)})
         end_text = f"[MEETING_ENDED] {end_payload}"
         
         try:
-            if m.receiver:
-                msg = Message(sender=request.user, receiver=m.receiver)
+            if receiver_id:
+                msg = Message(sender=request.user, receiver_id=receiver_id,
+                              kind=Message.KIND_MEETING_ENDED, meeting=meet)
                 msg.text = end_text
                 msg.save()
                 
-                group_name = f"chat_dm_{min(request.user.id, m.receiver.id)}_{max(request.user.id, m.receiver.id)}"
+                group_name = f"chat_dm_{min(request.user.id, receiver_id)}_{max(request.user.id, receiver_id)}"
                 async_to_sync(channel_layer.group_send)(group_name, {
                     "type": "chat_message",
                     "id": msg.id,
@@ -579,22 +754,23 @@ def end_meeting(request, meeting_id):
                     "sender_username": request.user.username,
                     "text": msg.text,
                     "timestamp": msg.timestamp.isoformat() if msg.timestamp else timezone.now().isoformat(),
-                    "receiver": m.receiver.id
+                    "receiver": receiver_id
                 })
                 
-            elif m.project:
-                msg = Message(sender=request.user, project=m.project)
+            elif project_id:
+                msg = Message(sender=request.user, project_id=project_id,
+                              kind=Message.KIND_MEETING_ENDED, meeting=meet)
                 msg.text = end_text
                 msg.save()
                 
-                group_name = f"chat_project_{m.project.id}"
+                group_name = f"chat_project_{project_id}"
                 async_to_sync(channel_layer.group_send)(group_name, {
                     "type": "project_message",
                     "id": msg.id,
                     "sender": request.user.id,
                     "sender_id": request.user.id,
                     "sender_username": request.user.username,
-                    "project_id": m.project.id,
+                    "project_id": project_id,
                     "text": msg.text,
                     "timestamp": msg.timestamp.isoformat() if msg.timestamp else timezone.now().isoformat()
                 })
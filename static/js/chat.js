@@ -123,63 +123,39 @@ async function loadUnifiedChats() {
   }
 }
 
+async function fetchConversationFiles(type, id) {
+  const res = await fetch(`${API_BASE}/conversations/${type}/${id}/files/`, { headers: defaultHeaders() });
+  if (!res.ok) throw new Error(`Status ${res.status}`);
+  const page = await res.json();
+  return {
+    count: page.count,
+    messageCount: page.message_count,
+    files: page.results.map(f => ({
+      name: f.name || extractFileNameFromUrl(f.url),
+      url: f.url,
+      size: f.size || 0,
+      type: f.content_type || '',
+      thumbnails: f.thumbnail_urls,
+      timestamp: f.timestamp
+    }))
+  };
+}
+
 async function loadChatMetadata(type, id) {
   try {
     const key = `${type}_${id}`;
-    // If we have files, assume we loaded full metadata
-    if (chatMetadata.has(key) && chatMetadata.get(key).files.length > 0) return;
-
-    let url = '';
-    if (type === 'user') {
-      url = `${API_BASE}/messages/user/${id}/`;
-    } else {
-      url = `${API_BASE}/messages/project/${id}/`;
-    }
-
-    const res = await fetch(url, { headers: defaultHeaders() });
-    if (!res.ok) throw new Error(`Status ${res.status}`);
-    const messages = await res.json();
-
-    let filesCount = 0;
-    let lastActivityTime = null;
-    let lastMessageText = '';
-    const files = [];
-
-    if (Array.isArray(messages)) {
-      messages.forEach(msg => {
-        if (msg.file_url) {
-          filesCount++;
-          files.push({
-            name: msg.file_name || extractFileNameFromUrl(msg.file_url),
-            url: msg.file_url,
-            size: msg.file_size || 0,
-            type: msg.file_type || '',
-            timestamp: msg.timestamp
-          });
-        }
-        if (msg.timestamp && (!lastActivityTime || new Date(msg.timestamp) > new Date(lastActivityTime))) {
-          lastActivityTime = msg.timestamp;
-          if (msg.text === '[PROJECT_MEETING_INVITE]') lastMessageText = '🎥 Meeting Started';
-          else if (msg.text === '[PROJECT_MEETING_ENDED]') lastMessageText = '🏁 Meeting Ended';
-          else lastMessageText = msg.text || (msg.file_url ? '📎 Attachment' : '');
-        }
-      });
-    }
+    // Files come from the per-conversation files index, not the full history
+    const { count, messageCount, files } = await fetchConversationFiles(type, id);
+    const previous = chatMetadata.get(key) || {};
 
     chatMetadata.set(key, {
-      filesCount,
-      lastActivity: lastActivityTime,
-      lastMessage: lastMessageText,
-      messageCount: messages.length,
+      filesCount: count,
+      lastActivity: previous.lastActivity || null,
+      lastMessage: previous.lastMessage || '',
+      messageCount: messageCount,
       files: files
     });
 
-    // Update preview if element specifically exists for projects
-    if (type === 'project') {
-      const previewEl = document.getElementById(`project-preview-${id}`);
-      if (previewEl && lastMessageText) previewEl.textContent = lastMessageText;
-    }
-
   } catch (err) {
     console.error('❌ Error loading chat metadata:', err);
   }
@@ -675,24 +651,7 @@ async function renderMediaGallery(type, id) {
     if (meta && Array.isArray(meta.files) && meta.files.length > 0) {
       files = meta.files;
     } else {
-      // Fallback to fetch if not in cache (or empty cache but maybe server has new?)
-      // Actually strictly relying on cache if populated is safer, but let's fetch if allow
-      let url = '';
-      if (type === 'user') {
-        url = `${API_BASE}/messages/user/${id}/`;
-      } else {
-        url = `${API_BASE}/messages/project/${id}/`;
-      }
-
-      const res = await fetch(url, { headers: defaultHeaders() });
-      const messages = res.ok ? await res.json() : [];
-      files = messages.filter(m => m.file_url).map(m => ({
-        name: m.file_name || extractFileNameFromUrl(m.file_url),
-        url: m.file_url,
-        size: m.file_size || 0,
-        type: m.file_type || '', // Serializer doesn't provide this yet
-        timestamp: m.timestamp
-      }));
+      files = (await fetchConversationFiles(type, id)).files;
     }
   } catch (e) {
     grid.innerHTML = '<div class="media-empty">Failed to load media</div>';
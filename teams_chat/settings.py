@@ -20,7 +20,26 @@ CSRF_TRUSTED_ORIGINS = [
 ]
 if RENDER_EXTERNAL_HOSTNAME:
     CSRF_TRUSTED_ORIGINS.append(f'https://{RENDER_EXTERNAL_HOSTNAME}')
-FERNET_KEY = "Cl6ELr31JUC0z8zmfjTXOKS9dmYKQTx7esJ5Zv065MM="
+FERNET_KEY = os.environ.get('FERNET_KEY', "Cl6ELr31JUC0z8zmfjTXOKS9dmYKQTx7esJ5Zv065MM=")
+
+# Message encryption keys, newest first: the first encrypts, all of them decrypt.
+# Rotate by prepending a new key, running 'manage.py rotate_message_keys',
+# then dropping the old one.
+MESSAGE_KEYS = [k.strip() for k in os.environ.get('MESSAGE_KEYS', '').split(',') if k.strip()] \
+    or [FERNET_KEY]
+
+# HMAC key of the message search index; independent of MESSAGE_KEYS so that
+# rotating those does not require reindexing
+SEARCH_INDEX_KEY = os.environ.get('SEARCH_INDEX_KEY', FERNET_KEY)
+
+# Message bodies of at least this many bytes are zlib compressed before
+# encryption (0 disables). Optional preset dictionaries, newest first, from
+# 'manage.py train_message_dict'; keep old ones listed while rows use them.
+MESSAGE_COMPRESSION_THRESHOLD = int(os.environ.get('MESSAGE_COMPRESSION_THRESHOLD', 512))
+MESSAGE_COMPRESSION_DICTS = [p.strip() for p in os.environ.get('MESSAGE_COMPRESSION_DICTS', '').split(',') if p.strip()]
+
+# Bearer token for Prometheus scrapes of /metrics (staff sessions also work)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
 
 # -------------------------------
 # Installed Apps
@@ -60,6 +79,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'chat.metrics.MetricsMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -94,17 +114,74 @@ ASGI_APPLICATION = 'teams_chat.asgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
+# SQLite embedded mode (chat/utils/sqlite_mode.py): WAL and tuned pragmas
+# on every connection, persistent connections, and consumer writes batched
+# through one writer thread while reads run on the consumer DB pool
+SQLITE_EMBEDDED = os.environ.get('SQLITE_EMBEDDED', 'True').lower() == 'true'
+SQLITE_PRAGMAS = {}  # overrides, e.g. {'synchronous': 'FULL'}
+SQLITE_WRITER_MAX_BATCH = int(os.environ.get('SQLITE_WRITER_MAX_BATCH', 100))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': None if SQLITE_EMBEDDED else 0,
     }
 }
 
 # Render PostgreSQL database (overrides sqlite if DATABASE_URL is present)
 database_url = os.environ.get('DATABASE_URL')
 if database_url:
-    DATABASES['default'] = dj_database_url.parse(database_url, conn_max_age=600)
+    DATABASES['default'] = dj_database_url.parse(
+        database_url, conn_max_age=600, conn_health_checks=True)
+
+# Process-wide connection pool for Postgres (see chat/dbpool/__init__.py).
+# Django then opens/closes per request, so CONN_MAX_AGE must be 0.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 0))
+if DB_POOL_SIZE and DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql':
+    DATABASES['default'].update({
+        'ENGINE': 'chat.dbpool',
+        'CONN_MAX_AGE': 0,
+        'POOL': {
+            'size': DB_POOL_SIZE,
+            'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+            'max_lifetime': float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800)),
+            'ping_after': float(os.environ.get('DB_POOL_PING_AFTER', 1)),
+        },
+    })
+
+# Read replicas (comma separated URLs): history, sidebar, search and admin
+# list reads go there; a user's own writes pin their reads to the primary
+# for REPLICA_STICKY_SECONDS (see chat/routers.py). Pins are kept in the
+# cache, which is Redis whenever REDIS_URL is set.
+DATABASE_ROUTERS = ['chat.routers.ReplicaRouter']
+READ_REPLICAS = []
+for i, replica_url in enumerate(u.strip() for u in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')):
+    if replica_url:
+        alias = f'replica{i + 1}'
+        DATABASES[alias] = dj_database_url.parse(
+            replica_url, conn_max_age=600, conn_health_checks=True)
+        DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+        READ_REPLICAS.append(alias)
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+
+# Serialized user cards (chat/utils/user_cards.py): cache alias and lifetime
+USER_CARD_CACHE = 'default'
+USER_CARD_TTL = int(os.environ.get('USER_CARD_TTL', 300))
+
+# Consumer ORM calls: 0 = Channels' single shared DB thread; N = a pool of
+# N threads, each with its own connection (see chat/utils/db_executor.py)
+CONSUMER_DB_THREADS = int(os.environ.get(
+    'CONSUMER_DB_THREADS',
+    4 if SQLITE_EMBEDDED and DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3' else 0))
 
 # -------------------------------
 # Password Validation
@@ -139,11 +216,31 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Let a fronting proxy send media after chat.media authorizes the request:
+# nginx: internal location mapped to MEDIA_ROOT, e.g. '/protected-media/'
+MEDIA_X_ACCEL_REDIRECT_PREFIX = os.environ.get('MEDIA_X_ACCEL_REDIRECT_PREFIX')
+# Apache mod_xsendfile / lighttpd
+MEDIA_X_SENDFILE = os.environ.get('MEDIA_X_SENDFILE', 'False').lower() == 'true'
+
+# WebP thumbnails of image attachments (longest edge, px), rendered by a
+# process pool of this many workers (0 = inline, used by tests); a failed
+# render is retried after THUMBNAIL_RETRY_AFTER seconds
+THUMBNAIL_SIZES = (160, 480, 1024)
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+THUMBNAIL_RETRY_AFTER = int(os.environ.get('THUMBNAIL_RETRY_AFTER', 24 * 3600))
+
+# Threads that decode and store files sent over WebSockets, off the shared
+# database_sync_to_async thread; further callers wait once this many
+# writes are queued or running
+FILE_IO_WORKERS = int(os.environ.get('FILE_IO_WORKERS', 4))
+FILE_IO_MAX_PENDING = int(os.environ.get('FILE_IO_MAX_PENDING', 16))
+
 # -------------------------------
 # Upload Limits
 # -------------------------------
 MAX_UPLOAD_SIZE = 52428800  # 50MB
-FILE_UPLOAD_MAX_MEMORY_SIZE = 52428800
+# Larger uploads spool to a temp file instead of sitting in worker memory
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440  # 2.5MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 52428800
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
@@ -197,6 +294,18 @@ else:
                 },
             },
         }
+    elif DATABASES['default']['ENGINE'] in ('django.db.backends.postgresql', 'chat.dbpool'):
+        # No Redis, but Postgres is available: LISTEN/NOTIFY keeps
+        # multi-instance deploys talking to each other
+        CHANNEL_LAYERS = {
+            'default': {
+                'BACKEND': 'chat.layers.PostgresChannelLayer',
+                'CONFIG': {
+                    'capacity': 1500,
+                    'expiry': 10,
+                },
+            },
+        }
     else:
         # Fallback to In-Memory if no Redis (works for single instance)
         CHANNEL_LAYERS = {
@@ -1,10 +1,12 @@
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib.auth import views as auth_views
 from django.views.generic import RedirectView
 from chat.views import CustomLoginView, signup_view
+from chat.metrics import metrics_view
+from chat.media import media_view
 
 urlpatterns = [
     path('', RedirectView.as_view(url='/chat/', permanent=False), name='home'),
@@ -16,8 +18,12 @@ urlpatterns = [
     path('logout/', auth_views.LogoutView.as_view(next_page='login'), name='logout'),
 
     path('chat/', include('chat.urls')),
+
+    path('metrics', metrics_view, name='metrics'),
+
+    # Uploaded media, with access checks (also in production)
+    re_path(r'^%s(?P<path>.+)$' % settings.MEDIA_URL.lstrip('/'), media_view, name='media'),
 ]
 
 if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)